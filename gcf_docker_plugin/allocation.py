@@ -0,0 +1,116 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import threading
+from dockermaster import DockerMaster
+
+class AllocationIndex(object):
+    """
+        The resources of the aggregate that can host a requested node, indexed by sliver_type and by component_id
+        (the id of a single resource, or of a container of a DockerMaster).
+        Claiming a resource is atomic: the containers are taken from the pool of their DockerMaster under its lock,
+        and single resources are marked unavailable under the lock of the index.
+    """
+    def __init__(self, resources):
+        self._lock = threading.Lock()
+        self._version = 0
+        self.dockermasters = list()
+        self.by_sliver_type = dict() #sliver_type => resources supporting it (DockerMasters first)
+        self.by_component_id = dict() #component_id => resource (the DockerMaster of a container)
+        for resource in sorted(resources, key=lambda r: not isinstance(r, DockerMaster)):
+            if isinstance(resource, DockerMaster):
+                self.dockermasters.append(resource)
+                for container in resource.containers:
+                    self.by_component_id[container.id] = resource
+            self.by_component_id[resource.id] = resource
+            for sliver_type in resource.supported_sliver_types:
+                self.by_sliver_type.setdefault(sliver_type, list()).append(resource)
+
+    #Resources to try for a node
+    def candidates(self, sliver_type, component_id=None):
+        if component_id is not None:
+            resource = self.by_component_id.get(component_id)
+            return [resource] if resource is not None else []
+        return list(self.by_sliver_type.get(sliver_type, []))
+
+    #Take a matching resource from resource (see ExtendedResource.matchResource()), or return None
+    def claim(self, resource, sliver_type=None, component_id=None, exclusive=None):
+        if isinstance(resource, DockerMaster):
+            return resource.matchResource(sliver_type, component_id, exclusive)
+        with self._lock:
+            if not resource.available:
+                return None
+            match = resource.matchResource(sliver_type, component_id, exclusive)
+            if match is not None:
+                match.available = False
+                self._version += 1
+            return match
+
+    #Give back a claimed resource that has not been used
+    def release(self, resource):
+        resource.deallocate()
+        dockermaster = getattr(resource, 'dockermaster', None)
+        if dockermaster is not None:
+            dockermaster.onResetChild(resource)
+        else:
+            self.changed()
+
+    #Single resources have been freed by other means (deletion of slivers)
+    def changed(self):
+        with self._lock:
+            self._version += 1
+
+    def version(self):
+        """
+            Version of the inventory: increases whenever a resource is claimed or freed, so the advertisement
+            RSpec only has to be generated again when the version has changed
+        """
+        return self._version + sum([d.version for d in self.dockermasters])
+
+    def newReservation(self):
+        return Reservation(self)
+
+class Reservation(object):
+    """
+        The resources claimed by one Allocate call: either all of them are allocated, or they are all given back
+    """
+    def __init__(self, index):
+        self.index = index
+        self.resources = list()
+
+    def claim(self, resource, sliver_type=None, component_id=None, exclusive=None):
+        match = self.index.claim(resource, sliver_type, component_id, exclusive)
+        if match is not None:
+            self.resources.append(match)
+        return match
+
+    #Add a resource claimed by other means (the proxy container for example)
+    def add(self, resource):
+        self.resources.append(resource)
+
+    def rollback(self):
+        for resource in self.resources:
+            self.index.release(resource)
+        del self.resources[:]
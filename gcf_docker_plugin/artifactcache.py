@@ -0,0 +1,165 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import atexit
+import errno
+import hashlib
+import logging
+import os
+import threading
+import urllib2
+import uuid
+from diskcache import BudgetedCache
+
+#Size of the chunks read from the downloads
+CHUNK_SIZE = 65536
+#Index of the cache, in its directory
+INDEX_FILE = "index.json"
+
+class ArtifactCache(object):
+    """
+        The files of the install services, on the docker host: each file is downloaded once, kept as it was
+        downloaded, then shared by all the containers installing it. Entries are keyed by URL and by the validators
+        given by the server (ETag, Last-Modified, size), so a file changed on the server is downloaded again.
+        Entries in use are never evicted, the others are evicted least recently used first when over the disk budget.
+        The directory and its index are only created when the first file is downloaded.
+    """
+    def __init__(self, directory, budget, timeout):
+        """
+        :param budget: disk budget, in bytes
+        :param timeout: seconds without data before a download is aborted
+        """
+        self.directory = directory
+        self.budget = budget
+        self.timeout = timeout
+        self.cache = None
+        self._setup_lock = threading.Lock()
+        self._locks_lock = threading.Lock()
+        self._locks = dict() #key => lock held while the file is downloaded
+
+    def setBudget(self, budget):
+        self.budget = budget
+        if self.cache is not None:
+            self.cache.budget = budget
+
+    #Move the cache to directory, only possible before its first use
+    def setDirectory(self, directory):
+        with self._setup_lock:
+            if self.cache is not None and directory != self.directory:
+                logging.getLogger('gcf.am3').warn("The artifact cache is already used in %s, not moving it to %s", self.directory, directory)
+                return
+            self.directory = directory
+
+    def _index(self):
+        with self._setup_lock:
+            if self.cache is None:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                self.cache = BudgetedCache(os.path.join(self.directory, INDEX_FILE), self.budget, self._remove)
+                atexit.register(self.cache.flush)
+                #The owners are the installs in progress, none of them survived the restart
+                for entry in self.cache.entries.values():
+                    del entry["owners"][:]
+            return self.cache
+
+    def _remove(self, key, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                return False
+        with self._locks_lock:
+            self._locks.pop(key, None)
+        return True
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    #The ETag, Last-Modified and Content-Length of url, without downloading it, or None if the server doesn't tell
+    def _validators(self, url):
+        request = urllib2.Request(url)
+        request.get_method = lambda: "HEAD"
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except (urllib2.URLError, ValueError, IOError):
+            return None
+        try:
+            validators = [response.info().getheader(h) for h in ("ETag", "Last-Modified", "Content-Length")]
+        finally:
+            response.close()
+        if all([v is None for v in validators]):
+            return None
+        return validators
+
+    def open(self, url, owner):
+        """
+            Open the file of url, downloading it first if it isn't in the cache.
+            The entry is not evicted until release(owner) is called.
+
+            :return: the file, a file object
+        """
+        cache = self._index()
+        validators = self._validators(url)
+        if validators is None:
+            #Nothing tells if a cached copy would still be valid: download it for this install only
+            path = os.path.join(self.directory, str(uuid.uuid4()))
+            try:
+                self._download(url, path)
+                return open(path, "rb")
+            finally:
+                #Deleted once closed, or at once if the download failed
+                for p in (path, path + ".part"):
+                    if os.path.exists(p):
+                        os.remove(p)
+        key = "\n".join([url] + [v or "" for v in validators])
+        with self._lock(key):
+            filename = cache.get(key, owner)
+            if filename is not None and os.path.exists(os.path.join(self.directory, filename)):
+                return open(os.path.join(self.directory, filename), "rb")
+            filename = hashlib.sha256(key.encode("utf-8")).hexdigest()
+            size = self._download(url, os.path.join(self.directory, filename))
+            cache.put(key, filename, size, owner)
+        cache.evict()
+        return open(os.path.join(self.directory, filename), "rb")
+
+    def release(self, owner):
+        if self.cache is not None:
+            self.cache.release(owner)
+
+    #Download url to path, returns its size
+    def _download(self, url, path):
+        tmp = path + ".part"
+        response = urllib2.urlopen(url, timeout=self.timeout)
+        try:
+            with open(tmp, "wb") as f:
+                for data in iter(lambda: response.read(CHUNK_SIZE), ""):
+                    f.write(data)
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            response.close()
+        return os.path.getsize(path)
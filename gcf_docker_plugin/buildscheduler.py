@@ -0,0 +1,177 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+
+import collections
+import logging
+import threading
+import time
+
+#Number of image builds running at the same time on a docker host
+MAX_CONCURRENT_BUILDS = 2
+#Seconds after which a build is cancelled
+BUILD_TIMEOUT = 1800
+#Number of output lines kept for the status of a build
+PROGRESS_LINES = 20
+
+class BuildCancelled(Exception):
+    pass
+
+class Build(object):
+    """
+        One image build, shared by all the slices waiting for the same image
+    """
+    def __init__(self, key, timeout):
+        self.key = key
+        self.owners = set()
+        self.state = "queued" #queued, building, ready, failed or cancelled
+        self.progress = collections.deque(maxlen=PROGRESS_LINES)
+        self.result = None
+        self.cache_key = None
+        self.error = None
+        self.timeout = timeout
+        self.deadline = None #Set once the build starts
+        self.cancel_reason = None
+        self._stream = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def log(self, text):
+        for line in text.splitlines():
+            if len(line.strip()) > 0:
+                self.progress.append(line.rstrip())
+
+    #Stream (see dockerapi.StreamResponse) to abort if the build is cancelled
+    def attach(self, stream):
+        with self._lock:
+            self._stream = stream
+        if self.cancel_reason is not None:
+            stream.abort()
+
+    #Raise BuildCancelled if the build has been cancelled
+    def check(self):
+        if self.cancel_reason is not None:
+            raise BuildCancelled(self.cancel_reason)
+
+    def cancel(self, reason):
+        if self._done.is_set():
+            return
+        self.cancel_reason = reason
+        with self._lock:
+            stream = self._stream
+        if stream is not None:
+            stream.abort()
+
+    def finished(self):
+        return self._done.is_set()
+
+    #Wait until the build is finished, returns False after timeout seconds
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    #Wait until the build is finished, returns False if it is still running grace seconds after its deadline
+    def join(self, grace=30):
+        while not self.wait(1):
+            if self.deadline is not None and time.time() > self.deadline + grace:
+                return False
+        return True
+
+    def status(self):
+        return dict(state=self.state, progress=list(self.progress), error=self.error, name=self.result)
+
+class BuildScheduler(object):
+    """
+        Runs the image builds of a docker host: a single build at a time for each key (the later requests wait for
+        the running one), at most max_concurrent builds at once, each one cancelled after its timeout or once all
+        the slices waiting for it are deleted
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_BUILDS, timeout=BUILD_TIMEOUT):
+        self.timeout = timeout
+        self.builds = dict() #key => last Build
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrent)
+
+    def submit(self, key, owner, target):
+        """
+            Start target(build) for key, unless a build of key is already queued or running
+
+            :param owner: who waits for the build (for example "slice_urn::image"), None if it can't be cancelled
+            :param target: function building the image, returns True (once build.result is the image name) or an error message
+            :return: the Build
+        """
+        with self._lock:
+            build = self.builds.get(key)
+            if build is None or build.finished():
+                build = Build(key, self.timeout)
+                self.builds[key] = build
+                t = threading.Thread(target=self._run, args=[build, target])
+                t.daemon = True
+                t.start()
+            if owner is not None:
+                build.owners.add(owner)
+            return build
+
+    def get(self, key):
+        with self._lock:
+            return self.builds.get(key)
+
+    #owner doesn't need its builds anymore: cancel the builds nobody else waits for
+    def cancelOwner(self, owner):
+        with self._lock:
+            builds = [b for b in self.builds.values() if owner in b.owners]
+            for build in builds:
+                build.owners.discard(owner)
+        for build in builds:
+            if len(build.owners) == 0:
+                build.cancel("Cancelled: the slice has been deleted")
+
+    def _run(self, build, target):
+        timer = None
+        try:
+            with self._slots:
+                build.check()
+                build.state = "building"
+                build.deadline = time.time() + build.timeout
+                timer = threading.Timer(build.timeout, build.cancel,
+                                        ["Cancelled: the build took more than %d seconds" % build.timeout])
+                timer.daemon = True
+                timer.start()
+                out = target(build)
+            build.check()
+            if out is True:
+                build.state = "ready"
+            else:
+                build.state = "failed"
+                build.error = out
+        except BuildCancelled as e:
+            build.state = "cancelled"
+            build.error = str(e)
+        except Exception as e:
+            logging.getLogger('gcf.am3').error("Build of %s failed: %s", build.key, e)
+            build.state = "failed"
+            build.error = "Error : "+str(e)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            build._done.set()
@@ -23,6 +23,7 @@
 
 
 from gcf_to_docker import DockerManager
+import gcf_to_docker
 import Pyro4
 from optparse import OptionParser
 import logging
@@ -34,6 +35,9 @@ parser = OptionParser()
 parser.add_option("--host", dest="host", help="Accesssible IP from the AM", metavar="IP")
 parser.add_option("--password", dest="password", help="Passphrase to preventing arbitrary connections", metavar="PASSPHRASE")
 parser.add_option("--port", dest="port", default=11999, help="Port to listen to", metavar="PORT")
+parser.add_option("--image-cache-budget", dest="image_cache_budget", type="int", help="Disk space kept for the images of deleted slices, in MB", metavar="MB")
+parser.add_option("--artifact-cache-budget", dest="artifact_cache_budget", type="int", help="Disk space kept for the files of the install services, in MB", metavar="MB")
+parser.add_option("--artifact-cache-dir", dest="artifact_cache_dir", help="Directory of the files of the install services", metavar="DIR")
 (options, args) = parser.parse_args()
 
 logging.basicConfig()
@@ -49,6 +53,13 @@ if not options.port:
 else:
     port = options.port
 
+if options.image_cache_budget is not None:
+    gcf_to_docker.image_cache.budget = options.image_cache_budget*1024*1024
+if options.artifact_cache_budget is not None:
+    gcf_to_docker.artifact_cache.setBudget(options.artifact_cache_budget*1024*1024)
+if options.artifact_cache_dir is not None:
+    gcf_to_docker.artifact_cache.setDirectory(options.artifact_cache_dir)
+
 daemon = Pyro4.Daemon(port=int(options.port), host=options.host)
 
 if not options.password:
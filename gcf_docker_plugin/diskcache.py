@@ -0,0 +1,145 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import json
+import logging
+import os
+import threading
+import time
+
+#Seconds between two saves of the index for changes that don't add or remove entries (last use, owners)
+SAVE_INTERVAL = 30
+
+class BudgetedCache(object):
+    """
+        Index of things stored on the disk of the docker host (images, downloads, ...), shared between their users.
+        Each entry is referenced by its owners (for example the slices using it) and is only evicted once it
+        has no owner left and the entries use more than the disk budget, least recently used first.
+        The index is saved as JSON in state_file, so it survives restarts: at once when an entry is added or removed,
+        at most every SAVE_INTERVAL seconds for the last uses and the released owners (kept in memory meanwhile).
+    """
+    def __init__(self, state_file, budget, remove):
+        """
+        :param budget: disk budget, in bytes
+        :param remove: function called with (key, value) to delete an evicted entry, returns True if it was deleted
+        """
+        self.state_file = state_file
+        self.budget = budget
+        self.remove = remove
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._saved = time.time()
+        self.entries = dict()
+        try:
+            with open(self.state_file) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _save(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, self.state_file)
+        self._dirty = False
+        self._saved = time.time()
+
+    #Save the changes made since the last save, if it was more than SAVE_INTERVAL seconds ago
+    def _touch(self):
+        self._dirty = True
+        if time.time() - self._saved >= SAVE_INTERVAL:
+            self._save()
+
+    #Save the pending changes now (shutdown)
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    #Return the value of key (and add owner to its owners), or None if it is not cached
+    def get(self, key, owner=None):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry["last_used"] = time.time()
+            if owner is not None and owner not in entry["owners"]:
+                entry["owners"].append(owner)
+                self._save() #A new owner protects the entry from eviction, even after a restart
+            else:
+                self._touch()
+            return entry["value"]
+
+    def put(self, key, value, size, owner=None):
+        with self._lock:
+            owners = self.entries.get(key, dict(owners=[]))["owners"]
+            if owner is not None and owner not in owners:
+                owners.append(owner)
+            self.entries[key] = dict(value=value, size=size, last_used=time.time(), owners=owners)
+            self._save()
+
+    def discard(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    #Return the key of an entry owned by owner, or None
+    def keyOf(self, owner):
+        with self._lock:
+            for key, entry in self.entries.items():
+                if owner in entry["owners"]:
+                    return key
+            return None
+
+    def release(self, owner):
+        with self._lock:
+            for entry in self.entries.values():
+                if owner in entry["owners"]:
+                    entry["owners"].remove(owner)
+            self._touch()
+
+    def usage(self):
+        with self._lock:
+            return sum([e["size"] for e in self.entries.values()])
+
+    #Delete unused entries, least recently used first, until the cache fits in its budget
+    def evict(self):
+        with self._lock:
+            usage = self.usage()
+            unused = sorted([(e["last_used"], k) for k, e in self.entries.items() if len(e["owners"]) == 0])
+            evicted = False
+            for _, key in unused:
+                if usage <= self.budget:
+                    break
+                entry = self.entries[key]
+                try:
+                    removed = self.remove(key, entry["value"])
+                except Exception as e:
+                    logging.getLogger('gcf.am3').error("Failed to evict %s from the cache: %s", key, e)
+                    removed = False
+                if removed:
+                    usage -= entry["size"]
+                    del self.entries[key]
+                    evicted = True
+            if evicted:
+                self._save()
@@ -0,0 +1,298 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import httplib
+import socket
+import json
+import struct
+import urllib
+import Queue
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+#Engine API version used for every call (Docker 1.12 or newer)
+DOCKER_API_VERSION = "1.24"
+
+class DockerAPIError(Exception):
+    def __init__(self, status, explanation):
+        super(DockerAPIError, self).__init__(status, explanation)
+        self.status = status
+        self.explanation = explanation
+
+    def __str__(self):
+        return "Docker API error %d: %s" % (self.status, self.explanation)
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+        HTTP/1.1 connection to the docker daemon over its unix socket
+    """
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+class StreamResponse(object):
+    """
+        A streamed reply of the docker daemon (build output, exec output, events, ...)
+        The connection goes back to the pool once the stream is fully read, and is dropped if close() is called before
+    """
+    def __init__(self, client, conn, response):
+        self._client = client
+        self._conn = conn
+        self.response = response
+        self.status = response.status
+        self._done = False
+
+    def iterRaw(self):
+        try:
+            if self.response.chunked:
+                fp = self.response.fp
+                while True:
+                    line = fp.readline()
+                    if not line:
+                        break
+                    size = int(line.split(";", 1)[0], 16)
+                    if size == 0:
+                        #Skip the trailers
+                        while line and line != "\r\n":
+                            line = fp.readline()
+                        self._done = True
+                        break
+                    data = fp.read(size)
+                    fp.read(2)
+                    yield data
+            else:
+                while True:
+                    data = self.response.read(4096)
+                    if not data:
+                        self._done = True
+                        break
+                    yield data
+        finally:
+            self.close()
+
+    #Iterate over the JSON messages of the stream (build, pull and events endpoints)
+    def iterJson(self):
+        decoder = json.JSONDecoder()
+        buf = ""
+        for data in self.iterRaw():
+            buf += data
+            while True:
+                buf = buf.lstrip()
+                if len(buf) == 0:
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break #Incomplete message, wait for the next chunk
+                buf = buf[end:]
+                yield obj
+
+    #Iterate over (stream, data) frames of a multiplexed stdout/stderr stream (exec and attach endpoints)
+    def iterFrames(self):
+        buf = ""
+        for data in self.iterRaw():
+            buf += data
+            while len(buf) >= 8:
+                stream, size = struct.unpack(">BxxxL", buf[:8])
+                if len(buf) < 8 + size:
+                    break
+                yield stream, buf[8:8+size]
+                buf = buf[8+size:]
+
+    #Interrupt the reading of the stream from another thread (the daemon stops what it was doing when the client disconnects)
+    def abort(self):
+        try:
+            sock = self._conn.sock or self.response.fp._sock
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.response.close()
+        if self._done and not self.response.will_close:
+            self._client._release(self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+class DockerClient(object):
+    """
+        Client for the Docker Engine API, with a pool of keep-alive connections shared by all the threads
+    """
+    def __init__(self, socket_path=DEFAULT_DOCKER_SOCKET, pool_size=32, timeout=120):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue(pool_size)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            return UnixHTTPConnection(self.socket_path, self.timeout), False
+
+    def _release(self, conn):
+        conn.setTimeout(self.timeout)
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def _send(self, conn, method, url, body, headers):
+        if body is None or isinstance(body, basestring):
+            conn.request(method, url, body, headers)
+            return
+        #File object or iterable of strings: stream it with the chunked transfer encoding
+        conn.putrequest(method, url, skip_accept_encoding=True)
+        for k, v in headers.items():
+            conn.putheader(k, v)
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        if hasattr(body, "read"):
+            f = body
+            body = iter(lambda: f.read(65536), "")
+        for chunk in body:
+            if chunk:
+                conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+        conn.send("0\r\n\r\n")
+
+    def request(self, method, path, params=None, body=None, headers=None, stream=False, timeout=-1):
+        """
+            Send a request to the docker daemon
+
+            :param body: a dict/list (sent as JSON), a string, a file object or an iterable of strings (streamed)
+            :param stream: return a StreamResponse instead of reading the whole reply
+            :param timeout: socket timeout for this request, None to wait forever, -1 for the client default
+            :return: the decoded JSON reply, the raw reply or a StreamResponse
+        """
+        url = "/v" + DOCKER_API_VERSION + path
+        if params:
+            url += "?" + urllib.urlencode(params)
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn, reused = self._acquire()
+        conn.setTimeout(self.timeout if timeout == -1 else timeout)
+        try:
+            self._send(conn, method, url, body, headers)
+            response = conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused or (body is not None and not isinstance(body, basestring)):
+                raise
+            #The daemon closed the idle keep-alive connection: retry once on a new one
+            conn, reused = UnixHTTPConnection(self.socket_path, self.timeout if timeout == -1 else timeout), False
+            self._send(conn, method, url, body, headers)
+            response = conn.getresponse()
+        if stream and response.status < 400:
+            return StreamResponse(self, conn, response)
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        if response.status >= 400:
+            try:
+                explanation = json.loads(data)["message"]
+            except (ValueError, KeyError, TypeError):
+                explanation = data.strip()
+            raise DockerAPIError(response.status, explanation)
+        if response.getheader("Content-Type", "").startswith("application/json") and len(data) > 0:
+            return json.loads(data)
+        return data
+
+    def get(self, path, params=None, **kwargs):
+        return self.request("GET", path, params=params, **kwargs)
+
+    def post(self, path, params=None, body=None, **kwargs):
+        return self.request("POST", path, params=params, body=body, **kwargs)
+
+    def delete(self, path, params=None, **kwargs):
+        return self.request("DELETE", path, params=params, **kwargs)
+
+    def ping(self):
+        return self.get("/_ping") == "OK"
+
+    def inspectContainer(self, container_id):
+        return self.get("/containers/%s/json" % container_id)
+
+    def inspectImage(self, name):
+        return self.get("/images/%s/json" % name)
+
+    def imageExists(self, name):
+        try:
+            self.inspectImage(name)
+            return True
+        except DockerAPIError as e:
+            if e.status == 404:
+                return False
+            raise
+
+    def execRun(self, container_id, cmd, timeout=None):
+        """
+            Run cmd (a list of arguments) in a running container, like "docker exec"
+
+            :return: tuple (exit code, stdout and stderr output)
+        """
+        e = self.post("/containers/%s/exec" % container_id,
+                      body={"AttachStdin": False, "AttachStdout": True, "AttachStderr": True,
+                            "Tty": False, "Cmd": cmd})
+        out = self.post("/exec/%s/start" % e["Id"], body={"Detach": False, "Tty": False},
+                        stream=True, timeout=timeout)
+        output = "".join([data for _, data in out.iterFrames()])
+        return self.get("/exec/%s/json" % e["Id"])["ExitCode"], output
+
+    #Start cmd (a list of arguments) in a running container without waiting for it, like "docker exec -d"
+    def execDetached(self, container_id, cmd):
+        e = self.post("/containers/%s/exec" % container_id,
+                      body={"AttachStdin": False, "AttachStdout": False, "AttachStderr": False,
+                            "Tty": False, "Cmd": cmd})
+        self.post("/exec/%s/start" % e["Id"], body={"Detach": True, "Tty": False})
+        return e["Id"]
+
+    #Extract the tar archive tar_data in the container at path, like "docker cp"
+    def putArchive(self, container_id, path, tar_data, timeout=None):
+        self.request("PUT", "/containers/%s/archive" % container_id, params={"path": path},
+                     body=tar_data, headers={"Content-Type": "application/x-tar"}, timeout=timeout)
+
+    def build(self, context, tag, dockerfile="Dockerfile", timeout=None):
+        """
+            Build an image from a tar build context (string, file object or iterable of strings)
+
+            :return: a StreamResponse with the JSON progress messages
+        """
+        return self.post("/build", params={"t": tag, "dockerfile": dockerfile, "forcerm": 1, "rm": 1},
+                         body=context, headers={"Content-Type": "application/x-tar"},
+                         stream=True, timeout=timeout)
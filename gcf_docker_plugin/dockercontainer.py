@@ -29,8 +29,10 @@ from extendedresource import ExtendedResource
 from gcf.geni.am.resource import Resource
 from lxml import etree
 import uuid
-import subprocess
-import time
+import readiness
+
+#Seconds between two refreshes of the build progress of a custom image in the sliver status
+IMAGE_POLL_INTERVAL = 5
 
 class DockerContainer(ExtendedResource):
 
@@ -51,19 +53,37 @@ class DockerContainer(ExtendedResource):
         self.image = None
         self.error = ''
         self.DockerManager = dockermanager
-        self.mac = self.DockerManager.randomMacAddress()
-        if ipv6_prefix is not None and len(ipv6_prefix)>0:
-            self.ipv6 = self.DockerManager.computeIpV6(ipv6_prefix, self.mac)
-        else:
-            self.ipv6=None
+        self.ipv6_prefix = ipv6_prefix
+        self.setMacAddress(self.DockerManager.randomMacAddress())
+        self.warm_container = None
+        #Placement hints of the request (see placement.py)
+        self.affinity = None
+        self.anti_affinity = None
+        #True from the deletion of the sliver until its docker container is removed (see teardown.py)
+        self.tearing_down = False
         self.DockerManager.checkDocker()
         self.is_proxy = False
 
+    def setMacAddress(self, mac):
+        self.mac = mac
+        if self.ipv6_prefix is not None and len(self.ipv6_prefix)>0:
+            self.ipv6 = self.DockerManager.computeIpV6(self.ipv6_prefix, self.mac)
+        else:
+            self.ipv6=None
+
     def deprovision(self):
         """Deprovision this resource at the resource provider."""
         super(DockerContainer, self).deprovision()
-        self.DockerManager.releasePort(self.ssh_port)
-        self.DockerManager.removeContainer(self.id)
+        if self.ssh_port!=22: #Else nothing has been started, or it has already been removed
+            names = [self.id]
+            if self.warm_container is not None: #Claimed but never renamed
+                names.append(self.warm_container['name'])
+            #The port is released once the containers are removed
+            self.DockerManager.removeContainers(names, [self.ssh_port])
+        self.onDeprovisioned()
+
+    def onDeprovisioned(self):
+        self.warm_container = None
         self.user_keys_dict = dict()
         self.ssh_port=22
         
@@ -77,32 +97,77 @@ class DockerContainer(ExtendedResource):
     def getUsers(self):
         return self.user_keys_dict.keys()
 
-    def preprovision(self, extra_user_keys_dict):
+    #reserve_port : False if the SSH port is checked and reserved by the caller (see DockerMaster.preprovisionContainers())
+    def preprovision(self, extra_user_keys_dict, reserve_port=True):
         super(DockerContainer, self).preprovision(extra_user_keys_dict)
         self.user_keys_dict.update(extra_user_keys_dict)
+        if self.ssh_port==22 and self.image is None and self.warm_container is None and self.dockermaster is not None:
+            #Use a started container of the warm pool of the DockerMaster if there is one
+            self.warm_container = self.dockermaster.claimWarmContainer(self.chosen_sliver_type)
+            if self.warm_container is not None:
+                self.ssh_port = self.warm_container['port']
+                self.setMacAddress(self.warm_container['mac'])
+                return
+        if not reserve_port:
+            return
         if self.ssh_port==22 or not self.DockerManager.isContainerUp(self.ssh_port):
+            if self.ssh_port!=22:
+                self.DockerManager.releasePort(self.ssh_port)
             self.ssh_port = self.DockerManager.reserveNextPort(self.starting_ipv4_port)
 
     def provision(self):
+        spec = self.startSpec()
+        if spec is None:
+            return False
+        if not self.onStarted(self.DockerManager.startContainers([spec])[0]):
+            return False
+        self.onSetup(self.DockerManager.setupContainer(self.id, self.user_keys_dict))
+        return True
+
+    #First step of provision(): wait for the custom image, and return the spec of the container to give to
+    #DockerManager.startContainers(), or None if the image can't be built
+    def startSpec(self):
         super(DockerContainer, self).provision()
-        if self.DockerManager.isContainerUp(self.ssh_port):
-            self.DockerManager.removeContainer(self.id)
-        out = self.DockerManager.startNew(container_id=self.id,
-                                          sliver_type=self.chosen_sliver_type,
-                                          ssh_port=self.ssh_port,
-                                          mac_address=self.mac,
-                                          image=self.image)
+        if self.image is not None:
+            out = self.waitForImage()
+            if out is not True:
+                self.error = out
+                return None
+        spec = dict(container_id=self.id,
+                    sliver_type=self.chosen_sliver_type,
+                    ssh_port=self.ssh_port,
+                    mac_address=self.mac,
+                    image=self.image)
+        if self.warm_container is not None:
+            spec['warm'] = self.warm_container['name']
+            self.warm_container = None
+        return spec
+
+    #Result of startContainers() for this container, returns False if it failed
+    def onStarted(self, out):
         if out is not True:
             self.error = out
             return False
-        else:
-            self.error=''
-        out = self.DockerManager.setupContainer(self.id, self.user_keys_dict)
+        self.error = ''
+        return True
+
+    #Result of setupContainer() for this container
+    def onSetup(self, out):
         if out is not True:
             self.error = out
         else:
             self.error=''
-        return True
+
+    #Wait for the build of the custom image, showing its progress in the sliver status
+    def waitForImage(self):
+        while True:
+            status = self.DockerManager.waitImage(self.image, IMAGE_POLL_INTERVAL)
+            if status["state"] == "ready":
+                return True
+            if status["state"] in ["failed", "cancelled"]:
+                return status["error"]
+            progress = status["progress"][-1] if len(status["progress"]) > 0 else ""
+            self.error = "Image %s: %s" % (status["state"], progress)
 
     def restart(self):
         """
@@ -112,12 +177,16 @@ class DockerContainer(ExtendedResource):
         self.DockerManager.restartContainer(self.id)
 
     def updateUser(self, new_user_keys_dict, force=False):
+        to_update = dict()
         for user, keys in new_user_keys_dict.items():
             if force or user not in self.user_keys_dict.keys():
-                res = self.DockerManager.setupUser(self.id, user, keys)
-                if res is not True:
-                    return res
-                self.user_keys_dict[user]=keys
+                to_update[user] = keys
+        if len(to_update) == 0:
+            return True
+        res = self.DockerManager.setupContainer(self.id, to_update)
+        if res is not True:
+            return res
+        self.user_keys_dict.update(to_update)
         return True
 
     def manifestAuth(self):
@@ -142,6 +211,8 @@ class DockerContainer(ExtendedResource):
                     ret.append(auth)
             return ret
 
+    def manifestFingerprint(self):
+        return super(DockerContainer, self).manifestFingerprint() + (getattr(self, 'ipv6', None),)
             
     def genAdvertNode(self, _urn_authority, _my_urn):
         r = super(DockerContainer, self).genAdvertNode(_urn_authority, _my_urn)
@@ -154,6 +225,9 @@ class DockerContainer(ExtendedResource):
         # self._agg.deallocate(container=None, resources=[self])
         self.image = None
         self.error = ''
+        self.warm_container = None
+        self.affinity = None
+        self.anti_affinity = None
         #let the DockerMaster know that this resource is available again
         if (self.dockermaster is not None):
             self.dockermaster.onResetChild(self)
@@ -164,29 +238,27 @@ class DockerContainer(ExtendedResource):
         :rtype: bool
         """
         super(DockerContainer, self).waitForSshConnection()
-        connect = False
-        cmd = "nc -z "+self.host+" "+str(self.ssh_port)
-        retry = 20
-        while not connect and retry > 0:
-            try:
-                subprocess.check_output(['bash', '-c', cmd])
-                connect=True
-            except:
-                print "Retry connection to "+self.host+" on port "+str(self.ssh_port)
-                retry -= 1
-                time.sleep(3)
-                pass
-        if not connect:
+        if not readiness.waitForSsh(self.host, self.ssh_port):
+            self.error = self.sshTimeoutError()
             return False
-        try:
-            cmd = "ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null root@"+self.host+" -p "+str(self.ssh_port)+" 'test'"
-            subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
-        except:
-            pass
         return True
 
+    #The callback is called by the readiness watcher thread (see readiness.py)
+    def watchSshConnection(self, callback):
+        def ready(ok):
+            if not ok:
+                self.error = self.sshTimeoutError()
+            callback(ok)
+        readiness.watchSsh(self.host, self.ssh_port, ready)
+
+    def sshTimeoutError(self):
+        return "No SSH server answering on "+self.host+":"+str(self.ssh_port)+" after "+str(readiness.SSH_READY_TIMEOUT)+" seconds"
+
     def installCommand(self, url, install_path):
         return self.DockerManager.installCommand(self.id, url, install_path)
 
-    def executeCommand(self, shell, cmd):
-        return self.DockerManager.executeCommand(self.id, shell, cmd)
+    def executeCommand(self, shell, cmd, index):
+        return self.DockerManager.executeCommand(self.id, shell, cmd, index)
+
+    def executeCommands(self, commands):
+        return self.DockerManager.executeCommands(self.id, commands)
@@ -27,35 +27,88 @@ from dockercontainer import DockerContainer
 
 from gcf.geni.am.resource import Resource
 from lxml import etree
+import collections
 import uuid
+import threading
+import logging
+import readiness
 from urllib2 import urlopen
-from gcf_to_docker import DockerManager
+from gcf_to_docker import DockerManager, DEFAULT_STARTING_PORT
 from extendedresource import ExtendedResource
+from pyropool import callAsync
 
 class DockerMaster(ExtendedResource):
-    def __init__(self, max_slots, host=None, ipv6_prefix=None, starting_ipv4_port=None, dockermanager=None):
+    def __init__(self, max_slots, host=None, ipv6_prefix=None, starting_ipv4_port=None, dockermanager=None,
+                 warm_pool=None, warm_pool_min_free_memory=512):
+        """
+        :param warm_pool: number of started containers to keep ready for each sliver_type, for example {'docker-container': 4}
+        :type warm_pool: dict
+        :param warm_pool_min_free_memory: the warm pool shrinks when the docker host has less free memory (in MB)
+        :type warm_pool_min_free_memory: int
+        """
         super(DockerMaster, self).__init__(str(uuid.uuid4()),
                                            [ 'docker-container',
                                              'docker-container_100M',
                                              'docker-container-with-tunnel' ])
         if starting_ipv4_port is None or starting_ipv4_port<=1024:
-            starting_ipv4_port=12000 #Default
+            starting_ipv4_port=DEFAULT_STARTING_PORT
         if dockermanager is None:
             dockermanager = DockerManager()
         if host is None or len(host)==0:
             host = urlopen('http://ip.42.pl/raw').read()
-        self.pool = [DockerContainer(self, starting_ipv4_port, dockermanager, host, ipv6_prefix)
-                     for _ in range(max_slots)]
+        #All the containers of this DockerMaster
+        self.containers = [DockerContainer(self, starting_ipv4_port, dockermanager, host, ipv6_prefix)
+                           for _ in range(max_slots)]
+        #The free containers: by id, and in the order they are handed out (claimed containers are skipped lazily)
+        self.free = dict([(c.id, c) for c in self.containers])
+        self.pool = collections.deque(self.containers)
+        #Incremented at each change of the free containers (see AllocationIndex.version())
+        self.version = 0
+        self.dockermanager = dockermanager
+        self.host = host
+        self.starting_ipv4_port = starting_ipv4_port
+        self.warm_pool_size = dict(warm_pool or {})
+        for sliver_type in self.warm_pool_size.keys():
+            if sliver_type not in self.supported_sliver_types:
+                raise Exception("Invalid config: unknown sliver_type \"%s\" in warm_pool" % sliver_type)
+        self.warm_pool_min_free_memory = warm_pool_min_free_memory
+        #Running default image containers, ready to be claimed: sliver_type => list of dict(name, port, mac)
+        self.warm = dict([(t, list()) for t in self.supported_sliver_types])
+        self._lock = threading.Lock()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    #A container is free again: only once (it may be reset several times), and only once its docker container is removed
     def onResetChild(self, childResource):
-        self.pool.append(childResource)
+        if childResource.tearing_down:
+            return
+        with self._lock:
+            if childResource.id in self.free:
+                return
+            self.free[childResource.id] = childResource
+            self.pool.append(childResource)
+            self.version += 1
+
+    #Recompute the free containers from their availability (after the state journal is replayed)
+    def rebuildPool(self):
+        with self._lock:
+            self.free = dict([(c.id, c) for c in self.containers if c.available and not c.tearing_down])
+            self.pool = collections.deque([c for c in self.containers if c.id in self.free])
+            self.version += 1
 
     def genAdvertNode(self, _urn_authority, _my_urn):
         r = super(DockerMaster, self).genAdvertNode(_urn_authority, _my_urn)
         r.set("exclusive", "false")
         hardware = etree.SubElement(r, "hardware_type")
         hardware.set("name", "docker_cluster")
-        etree.SubElement(hardware, "{http://www.protogeni.net/resources/rspec/ext/emulab/1}node_type").set("type_slots", str(len(self.pool)))
+        etree.SubElement(hardware, "{http://www.protogeni.net/resources/rspec/ext/emulab/1}node_type").set("type_slots", str(self.size()))
         return r
         
     def matchResource(self, sliver_type=None, component_id=None, exclusive=None):
@@ -64,15 +117,144 @@ class DockerMaster(ExtendedResource):
         #do not allow exclusive resources, but do allow non exclusive resources
         if exclusive is not None and exclusive:
             return None
-        if len(self.pool) == 0:
-            return None
-        if component_id is not None:
-            for r in self.pool:
-                if r.id == component_id:
-                    self.pool.remove(r)
+        with self._lock:
+            if component_id is not None:
+                r = self.free.pop(component_id, None) #Its entry in self.pool is skipped later
+                if r is not None:
+                    self.version += 1
+                return r
+            while len(self.pool) > 0:
+                r = self.pool.popleft()
+                if self.free.get(r.id) is r:
+                    del self.free[r.id]
+                    self.version += 1
                     return r
-            return None #No id match
-        return self.pool.pop(0)
+            return None
 
+    #The free slots, including the ones holding a warm container (see claimWarmContainer())
     def size(self):
-        return len(self.pool)
+        return len(self.free)
+
+    #Bulk versions of the DockerContainer methods, used when a whole slice is provisioned or deleted: they do one
+    #call to the DockerManager for each step instead of one call for each container
+
+    #containers : list of (DockerContainer, user_keys_dict)
+    def preprovisionContainers(self, containers):
+        check = list()
+        for container, user_keys_dict in containers:
+            container.preprovision(user_keys_dict, reserve_port=False)
+            if container.warm_container is None:
+                check.append(container)
+        started = [c for c in check if c.ssh_port!=22]
+        statuses = self.dockermanager.statusMany([c.id for c in started]) if len(started) > 0 else []
+        up = set([c.id for c, status in zip(started, statuses) if status['running'] and status['ssh_port']==c.ssh_port])
+        need_port = [c for c in check if c.id not in up]
+        released = [c.ssh_port for c in need_port if c.ssh_port!=22]
+        if len(released) > 0:
+            self.dockermanager.releasePorts(released)
+        if len(need_port) > 0:
+            for container, port in zip(need_port, self.dockermanager.reservePorts(self.starting_ipv4_port, len(need_port))):
+                container.ssh_port = port
+
+    #Returns True, or False (and the error of the container is set) for each container
+    def provisionContainers(self, containers):
+        #Start all the builds before waiting for any of them
+        for future in [callAsync(self.dockermanager, "prepareImage", image)
+                       for image in set([c.image for c in containers if c.image is not None])]:
+            future.value
+        specs = [c.startSpec() for c in containers]
+        todo = [(c, spec) for c, spec in zip(containers, specs) if spec is not None]
+        results = dict()
+        if len(todo) > 0:
+            for (container, _), out in zip(todo, self.dockermanager.startContainers([spec for _, spec in todo])):
+                results[container.id] = container.onStarted(out)
+        started = [c for c in containers if results.get(c.id, False)]
+        if len(started) > 0:
+            outs = self.dockermanager.setupContainers([dict(container_id=c.id, user_keys_dict=c.user_keys_dict)
+                                                       for c in started])
+            for container, out in zip(started, outs):
+                container.onSetup(out)
+        return [results.get(c.id, False) for c in containers]
+
+    #Names of the docker containers and SSH ports of containers to tear down (see teardown.py)
+    def removalSpec(self, containers):
+        names = list()
+        ports = list()
+        for container in [c for c in containers if c.ssh_port!=22]:
+            names.append(container.id)
+            if container.warm_container is not None:
+                names.append(container.warm_container['name'])
+            ports.append(container.ssh_port)
+        return names, ports
+
+    #Remove docker containers and release their ports, returns True or the errors
+    def removeContainers(self, names, ports):
+        if len(names) == 0:
+            self.dockermanager.releasePorts(ports)
+            return True
+        errors = [str(out) for out in self.dockermanager.removeContainers(names, ports) if out is not True]
+        if len(errors) > 0:
+            return "\n".join(errors)
+        return True
+
+    def warmCount(self):
+        with self._lock:
+            return sum([len(l) for l in self.warm.values()])
+
+    #Take a started container of the warm pool, or return None if there is none for this sliver_type
+    def claimWarmContainer(self, sliver_type):
+        with self._lock:
+            if len(self.warm.get(sliver_type, [])) == 0:
+                return None
+            return self.warm[sliver_type].pop(0)
+
+    def _removeWarmContainer(self, warm):
+        self.dockermanager.removeContainers([warm['name']], [warm['port']])
+
+    def refillWarmPool(self):
+        """
+            Start containers until the warm pool of each sliver_type reaches its target size,
+            without using more than the free slots, and shrink it when it is over its target size (after a change
+            of the config), over the free slots or when the docker host is short of memory.
+            Called periodically by the AM.
+            Returns True if the warm pool has changed.
+        """
+        if len(self.warm_pool_size) == 0 and self.warmCount() == 0:
+            return False
+        changed = False
+        for sliver_type in self.warm.keys():
+            while True:
+                with self._lock:
+                    if len(self.warm[sliver_type]) <= self.warm_pool_size.get(sliver_type, 0):
+                        break
+                    warm = self.warm[sliver_type].pop()
+                logging.getLogger('gcf.am3').info("Shrinking warm pool: removing container %s", warm['name'])
+                self._removeWarmContainer(warm)
+                changed = True
+        while self.warmCount() > 0 and \
+                (self.warmCount() > self.size() or
+                 self.dockermanager.getFreeMemory() < self.warm_pool_min_free_memory):
+            with self._lock:
+                sliver_type = max(self.warm.keys(), key=lambda t: len(self.warm[t]))
+                warm = self.warm[sliver_type].pop()
+            logging.getLogger('gcf.am3').info("Shrinking warm pool: removing container %s", warm['name'])
+            self._removeWarmContainer(warm)
+            changed = True
+        for sliver_type, target in self.warm_pool_size.items():
+            while len(self.warm[sliver_type]) < target and self.warmCount() < self.size() and \
+                    self.dockermanager.getFreeMemory() >= self.warm_pool_min_free_memory:
+                warm = dict(name="warm-"+str(uuid.uuid4()),
+                            port=self.dockermanager.reserveNextPort(self.starting_ipv4_port),
+                            mac=self.dockermanager.randomMacAddress())
+                out = self.dockermanager.startNew(container_id=warm['name'],
+                                                  sliver_type=sliver_type,
+                                                  ssh_port=warm['port'],
+                                                  mac_address=warm['mac'])
+                if out is not True or not readiness.waitForSsh(self.host, warm['port']):
+                    logging.getLogger('gcf.am3').error("Failed to start warm %s container: %s", sliver_type, out)
+                    self._removeWarmContainer(warm)
+                    break
+                with self._lock:
+                    self.warm[sliver_type].append(warm)
+                changed = True
+        return changed
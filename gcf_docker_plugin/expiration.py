@@ -0,0 +1,95 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+class ExpirationScheduler(object):
+    """
+        Calls expire(slivers) from a single thread as soon as slivers reach their expiration time.
+        The slivers are kept in a min-heap of expiration times; rescheduling a sliver leaves its old entry
+        in the heap, where it is skipped when it comes out (the current expiration of each sliver is kept aside).
+    """
+    def __init__(self, expire):
+        self.expire = expire
+        self._heap = list() #(expiration, sequence number, sliver)
+        self._expirations = dict() #sliver urn => expiration of its valid heap entry
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    #Add slivers, or update them after a change of their expiration
+    def schedule(self, slivers):
+        with self._cond:
+            for sliver in slivers:
+                expiration = sliver.expiration()
+                if self._expirations.get(sliver.urn()) == expiration:
+                    continue
+                self._expirations[sliver.urn()] = expiration
+                heapq.heappush(self._heap, (expiration, next(self._sequence), sliver))
+            self._cond.notify()
+
+    #Forget deleted slivers
+    def cancel(self, slivers):
+        with self._cond:
+            for sliver in slivers:
+                self._expirations.pop(sliver.urn(), None)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._expirations)
+
+    def _due(self):
+        now = datetime.datetime.utcnow()
+        due = list()
+        while len(self._heap) > 0:
+            expiration, _, sliver = self._heap[0]
+            if self._expirations.get(sliver.urn()) != expiration:
+                heapq.heappop(self._heap) #Rescheduled or cancelled
+                continue
+            if expiration > now:
+                break
+            heapq.heappop(self._heap)
+            del self._expirations[sliver.urn()]
+            due.append(sliver)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due()
+                while len(due) == 0:
+                    timeout = None
+                    if len(self._heap) > 0:
+                        timeout = max(0, (self._heap[0][0] - datetime.datetime.utcnow()).total_seconds())
+                    self._cond.wait(timeout)
+                    due = self._due()
+            try:
+                self.expire(due)
+            except Exception as e:
+                logging.getLogger('gcf.am3').error("Failed to expire slivers: %s", e)
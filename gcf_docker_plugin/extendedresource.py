@@ -206,6 +206,13 @@ class ExtendedResource(Resource):
             # self.logger.debug('addManifestProxyServiceElements for resource without proxy_resource')
             pass
 
+    #Changes whenever manifestAuth() or addManifestProxyServiceElements() would return something else (see Slice.manifest())
+    def manifestFingerprint(self):
+        proxy = None
+        if self.proxy_resource:
+            proxy = (self.proxy_resource.host, self.proxy_resource.getPort())
+        return (self.host, self.getPort(), tuple(sorted(self.getUsers())), proxy)
+
     #Only used if your resource is a pool of resource, like DockerMaster
     def size(self):
         return 1
@@ -220,10 +227,26 @@ class ExtendedResource(Resource):
     def waitForSshConnection(self):
         pass
 
+    #Non-blocking version of waitForSshConnection(): calls callback(True) once the resource is ready, or callback(False)
+    #By default, it waits in the calling thread
+    def watchSshConnection(self, callback):
+        callback(self.waitForSshConnection() is True)
+
     #Decompress the target of the url to install_path on the resource
     def installCommand(self, url, install_path):
         pass
 
     #Executes the command given with the shell provided of the resource
-    def executeCommand(self, shell, cmd):
+    #index : position of the execute service in the node, used to name its log files
+    def executeCommand(self, shell, cmd, index):
         pass
+
+    #Executes the commands (list of (shell, cmd, index)) one after the other, in the background if the resource can
+    #Returns True or an error message
+    def executeCommands(self, commands):
+        errors = list()
+        for shell, cmd, index in commands:
+            out = self.executeCommand(shell, cmd, index)
+            if out is not None and out is not True:
+                errors.append(str(out))
+        return True if len(errors) == 0 else "\n".join(errors)
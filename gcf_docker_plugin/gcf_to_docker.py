@@ -22,6 +22,7 @@
 #----------------------------------------------------------------------
 
 import subprocess
+import pipes
 import re
 import os
 import uuid
@@ -33,52 +34,177 @@ import tempfile
 import hashlib
 import zipfile
 import shutil
+import tarfile
 import time
+import atexit
 import logging
+import socket
+import httplib
 import Pyro4
+from StringIO import StringIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from urllib2 import urlopen, URLError, HTTPError
+from dockerapi import DockerClient, DockerAPIError
+import portpool
+from diskcache import BudgetedCache
+from artifactcache import ArtifactCache
+from buildscheduler import BuildScheduler, Build, BUILD_TIMEOUT
+from inventory import ContainerInventory
 
-locked_port = list()
-lock = threading.Lock()
-building = dict()
+#All the images built by the AM are tagged with this prefix
+IMAGE_TAG_PREFIX = "gcf_"
+#First SSH port of the containers started without a given port
+DEFAULT_STARTING_PORT = 12000
+IMAGE_CACHE_FILE = "image-cache.json"
+#Default disk budget of the images kept after their slices are deleted, in MB
+IMAGE_CACHE_BUDGET = 20480
+#Seconds without data before a download is aborted
+DOWNLOAD_TIMEOUT = 60
+#Maximum size of a downloaded image (Dockerfile or zip), in MB
+MAX_IMAGE_DOWNLOAD = 1024
+#Size of the chunks read from the downloads and from the build contexts
+CHUNK_SIZE = 65536
+#Downloaded URL images up to this size (bytes) are kept in memory, larger ones are spooled to a temporary file
+DOWNLOAD_SPOOL_SIZE = 1024*1024
+#Default directory of the files of the install services (and of their index)
+ARTIFACT_CACHE_DIR = "artifact-cache"
+#Default disk budget of the files of the install services kept on the docker host, in MB
+ARTIFACT_CACHE_BUDGET = 20480
+#Number of containers handled at the same time by the bulk methods of the DockerManager
+BULK_THREADS = 16
+
+#Shared by all DockerManager instances (and all the Pyro4 threads of the daemon)
+docker_client = DockerClient()
+
+#Remove an image evicted from the image cache, unless a container still uses it
+def removeCachedImage(key, tag):
+    try:
+        docker_client.delete("/images/%s" % tag)
+        return True
+    except DockerAPIError as e:
+        return e.status == 404
+
+#Images built by the AM, keyed by content (build context hash or Docker Hub name@id), referenced by the "slice::image" using them
+image_cache = BudgetedCache(IMAGE_CACHE_FILE, IMAGE_CACHE_BUDGET*1024*1024, removeCachedImage)
+atexit.register(image_cache.flush)
+#Files of the install services, downloaded once and copied in each container installing them
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_BUDGET*1024*1024, DOWNLOAD_TIMEOUT)
+#Image builds of the docker host, keyed by the requested image (URL, Docker Hub name or default image)
+build_scheduler = BuildScheduler()
+#Containers of the docker host, followed from the events of the docker daemon once a DockerManager method needs them
+inventory = ContainerInventory(docker_client)
+
+bulk_pool = None
+bulk_pool_lock = threading.Lock()
+
+#Call fn on each item with the threads of bulk_pool, returns the list of results (or of error messages)
+def bulkMap(fn, items):
+    global bulk_pool
+    def call(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return str(e)
+    with bulk_pool_lock:
+        if bulk_pool is None:
+            bulk_pool = ThreadPool(BULK_THREADS)
+    return bulk_pool.map(call, items)
+
+class CommandError(Exception):
+    def __init__(self, returncode, output):
+        super(CommandError, self).__init__(returncode, output)
+        self.returncode = returncode
+        self.output = output
 
 @Pyro4.expose
 class DockerManager(object):
     def __init__(self,
                  default_image="jessie_gcf_ssh",
-                 default_image_dockerfile_dir=os.path.dirname(os.path.realpath(__file__))):
+                 default_image_dockerfile_dir=os.path.dirname(os.path.realpath(__file__)),
+                 image_cache_budget=None,
+                 artifact_cache_budget=None,
+                 artifact_cache_dir=None):
+        """
+        :param image_cache_budget: disk budget of the image cache of the docker host, in MB (None for the default)
+        :param artifact_cache_budget: disk budget of the artifact cache of the docker host, in MB (None for the default)
+        :param artifact_cache_dir: directory of the artifact cache of the docker host (None for the default)
+        """
         self.default_image = default_image
         self.default_image_dockerfile_dir = default_image_dockerfile_dir
+        self.image_cache_budget = image_cache_budget
+        self.artifact_cache_budget = artifact_cache_budget
+        self.artifact_cache_dir = artifact_cache_dir
+        self.applyHostSettings()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.applyHostSettings()
+
+    #The settings of the docker host are shared by all the DockerManager instances of the process
+    def applyHostSettings(self):
+        if self.image_cache_budget is not None:
+            image_cache.budget = self.image_cache_budget*1024*1024
+        if getattr(self, 'artifact_cache_budget', None) is not None:
+            artifact_cache.setBudget(self.artifact_cache_budget*1024*1024)
+        if getattr(self, 'artifact_cache_dir', None) is not None:
+            artifact_cache.setDirectory(self.artifact_cache_dir)
+
+    #Return the memory available for new processes on the host, in MB
+    def getFreeMemory(self):
+        meminfo = dict()
+        with open("/proc/meminfo") as f:
+            for line in f:
+                meminfo[line.split(":")[0]] = int(line.split()[1])
+        if "MemAvailable" in meminfo:
+            return meminfo["MemAvailable"] / 1024
+        return (meminfo["MemFree"] + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)) / 1024
 
     #Return the number of running containers
     def getRunningContainerCount(self):
-        cmd = "docker ps | grep -v '^CONTAINER' | wc -l"
-        output = subprocess.check_output(['bash', '-c', cmd])
-        output=output.strip().decode('utf-8')
-        return int(output)
+        count = inventory.runningCount()
+        if count is None:
+            return len(docker_client.get("/containers/json"))
+        return count
 
-    #Return the next port available on the host using netstat
+    #Return the load of the docker host, used to place the containers (see placement.py)
+    def getHostStats(self):
+        return dict(running=self.getRunningContainerCount(),
+                    mem_free=self.getFreeMemory(),
+                    load=os.getloadavg()[0],
+                    cpus=multiprocessing.cpu_count())
+
+    #Return the next port available on the host
     #starting_port : From which port start to check
     def getNextPort(self, starting_port):
-        _locked_port = list(locked_port)
-        cmd = "netstat -ant 2>/dev/null | awk '{print $4}' | grep -o \":[0-9]\\+$\" | grep -o [0-9]* | sort -n | uniq"
-        output = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-        expected = starting_port
-        busy = list()
-        for line in output.split('\n'):
-            if int(line) >= starting_port:
-                busy.append(int(line))
-        while expected in busy or expected in _locked_port:
-            expected+=1
-        return expected
-
-    #Get the next port with a Lock (avoid concurrency issue) and add it to the locked_port array
+        return portpool.getPool(starting_port).peek()
+
+    #Reserve the next port available (thread-safe), it stays reserved until releasePort() is called
     def reserveNextPort(self, starting_port):
-        lock.acquire()
-        port = self.getNextPort(starting_port)
-        locked_port.append(port)
-        lock.release()
-        return port
+        return portpool.getPool(starting_port).reserve()
+
+    #Create and start a container through the Engine API (the equivalent of "docker run -d -t -P")
+    def runContainer(self, uid, sliver_type, ssh_port, mac_address, imageName):
+        host_config = {"PortBindings": {"22/tcp": [{"HostPort": str(ssh_port)}]},
+                       "PublishAllPorts": True}
+        if sliver_type=="docker-container":
+            pass
+        elif sliver_type == "docker-container_100M":
+            host_config["Memory"] = 100*1024*1024
+        elif sliver_type == "docker-container-with-tunnel":
+            host_config["CapAdd"] = ["NET_ADMIN"]
+            host_config["Devices"] = [{"PathOnHost": "/dev/net/tun",
+                                       "PathInContainer": "/dev/net/tun",
+                                       "CgroupPermissions": "rwm"}]
+        else:
+            raise Exception("Internal error: no known sliver_type chosen: %s" % sliver_type)
+        config = {"Image": imageName,
+                  "Tty": True,
+                  "MacAddress": mac_address,
+                  "ExposedPorts": {"22/tcp": {}},
+                  "HostConfig": host_config}
+        docker_client.post("/containers/create", params={"name": uid}, body=config)
+        docker_client.post("/containers/%s/start" % uid)
 
     #Start a new container
     #container_id : Specific name to give to the container
@@ -88,149 +214,212 @@ class DockerManager(object):
     #image : Specific image to install (See processImage() documentation)
     def startNew(self, container_id=None, sliver_type=None, ssh_port=None, mac_address=None, image=None):
         if ssh_port is None:
-            ssh_port = self.reserveNextPort()
+            ssh_port = self.reserveNextPort(DEFAULT_STARTING_PORT)
         uid = str(uuid.uuid4()) if container_id == None else container_id
         imageName = self.default_image
         if image is not None:
             imageName=self.processImage(image)
-            if not re.match(r'[a-fA-F0-9]{40}', imageName) and image.split("::")[1]!=imageName: #An error occured during processImage
-                raise Exception("Invalid image name: %s" % imageName)
-        if sliver_type=="docker-container":
-            cmd = "docker run -d --mac-address "+mac_address+" --name "+uid+" -p " + str(ssh_port) + ":22 -P -t "+imageName+" 2>&1"
-        elif sliver_type == "docker-container_100M":
-            cmd = "docker run -d --mac-address "+mac_address+" --name "+uid+" -p " + str(ssh_port) + ":22 -m 100M -P -t "+imageName+" 2>&1"
-        elif sliver_type == "docker-container-with-tunnel":
-            cmd = "docker run -d --mac-address "+mac_address+" --name "+uid+" -p " + str(ssh_port) + ":22 --cap-add=NET_ADMIN --device=/dev/net/tun -P -t "+imageName+" 2>&1"
-        else:
-            raise Exception("Internal error: no known sliver_type chosen: %s" % sliver_type)
+            if not imageName.startswith(IMAGE_TAG_PREFIX): #An error occured during processImage
+                return imageName
         try:
-            subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
-        except Exception as e:
-            if "Unable to find image" not in e.output:
-                return e.output
+            self.runContainer(uid, sliver_type, ssh_port, mac_address, imageName)
+        except DockerAPIError as e:
+            if e.status != 404 or imageName != self.default_image:
+                return str(e)
             #This should only be reached if the default_image itself is not yet built.
             #  So we try building it, then retry the command, and fail if that still fails
-            build = "docker build -t "+self.default_image+" " + self.default_image_dockerfile_dir
+            def buildDefaultImage(build):
+                build.result = self.default_image
+                if docker_client.imageExists(self.default_image):
+                    return True
+                return self.buildImage(self.tarDirectory(self.default_image_dockerfile_dir), self.default_image, build)
+            build = build_scheduler.submit(self.default_image, None, buildDefaultImage)
+            if not build.join() or build.state != "ready":
+                return build.error or "Error : build of %s timed out" % self.default_image
             try:
-                if building.get(imageName, None) is None:
-                    building[imageName] = threading.Lock()
-                building[imageName].acquire() #Don't run multiple build at the same time
-                subprocess.check_output(['bash', '-c', build]).decode('utf-8').strip()
-                subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
-            except subprocess.CalledProcessError, e:
-                return e.output
-            finally:
-                building[imageName].release()
-        if ssh_port in locked_port:
-            i=0
-            while self.isContainerUp(ssh_port) == False: #Wait the container to listen before release the port
-                i+=1
-                time.sleep(1)
-                if i==45:
-                    return "Container not up after 45 seconds. Something went wrong"
-            locked_port.remove(ssh_port)
+                self.runContainer(uid, sliver_type, ssh_port, mac_address, imageName)
+            except DockerAPIError as e:
+                return str(e)
+        #Readiness of sshd is checked by the caller (see readiness.py)
         return True
 
     def restartContainer(self, container_id):
-        cmd = "docker restart " + str(container_id) + " 2>&1"
         try:
-            subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
+            docker_client.post("/containers/%s/restart" % container_id)
             return True
-        except Exception as e:
+        except (DockerAPIError, socket.error, httplib.HTTPException) as e:
+            logging.getLogger('gcf.am3').error("Failed to restart container %s: %s", container_id, e)
             return False
 
-    #Remove a port from locked ports list
-    #Have to be done if container start failed
+    #Give back a port reserved with reserveNextPort()
+    #Have to be done once the container is removed, or if container start failed
     def releasePort(self, port):
-        if port in locked_port:
-            locked_port.remove(port)
+        for pool in portpool.poolsFor(port):
+            pool.release(port)
+
+    def renameContainer(self, container_id, new_name):
+        try:
+            docker_client.post("/containers/%s/rename" % container_id, params={"name": new_name})
+            return True
+        except DockerAPIError as e:
+            return str(e)
 
     def stopContainer(self, container_id):
-        cmd = "docker stop " + str(container_id)
         try:
-            subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
+            docker_client.post("/containers/%s/stop" % container_id)
             return True
-        except Exception as e:
+        except (DockerAPIError, socket.error, httplib.HTTPException) as e:
+            logging.getLogger('gcf.am3').error("Failed to stop container %s: %s", container_id, e)
             return False
 
     def removeContainer(self, container_id):
-        cmd = "docker rm -f " + str(container_id)
+        inventory.forgetUsers(container_id)
         try:
-            subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
+            docker_client.delete("/containers/%s" % container_id, params={"force": 1})
             return True
-        except Exception as e:
-            return e.output
+        except DockerAPIError as e:
+            if e.status == 404: #Already removed
+                return True
+            return str(e)
 
-    #Check if a container is up using netstat
-    #In fact, check if the port is listenning
+    #Check if a container is up
+    #In fact, check if the port is listenning on the host
     def isContainerUp(self, port):
-        cmd = "netstat -ant 2>/dev/null | awk '{print $4}' | grep '.*:"+str(port)+"$'"
-        try:
-            out=subprocess.check_output(['bash', '-c', cmd]).decode('utf-8').strip()
-            return True
-        except subprocess.CalledProcessError:
-            return False
+        return port in portpool.readHostPorts(listening_only=True)
 
     def resetContainer(self, container_id):
         self.stopContainer(container_id)
         self.removeContainer(container_id)
         self.startNew(container_id)
 
+    #Bulk methods: one call for all the containers of a slice (one RPC with a remote DockerManager)
+
+    #Reserve count ports with reserveNextPort()
+    def reservePorts(self, starting_port, count):
+        return [self.reserveNextPort(starting_port) for _ in range(count)]
+
+    def releasePorts(self, ports):
+        for port in ports:
+            self.releasePort(port)
+
+    #Returns a dict(running, ssh_port) for each container (running is False if the container doesn't exist)
+    def statusMany(self, container_ids):
+        def status(container_id):
+            entry = inventory.lookup(container_id)
+            if entry is not None and entry['running']:
+                return dict(running=True, ssh_port=entry['ssh_port'])
+            try:
+                state = docker_client.inspectContainer(container_id)
+            except DockerAPIError:
+                return dict(running=False, ssh_port=None)
+            return dict(running=state['State']['Running'], ssh_port=self.getPort(container_id))
+        return bulkMap(status, container_ids)
+
+    #Start the containers described by specs, each one a dict with the arguments of startNew(), and optionally
+    #"warm": the name of a started container (of the warm pool) to rename instead of starting a new one
+    #Returns True or an error message for each container
+    def startContainers(self, specs):
+        def start(spec):
+            self.removeContainer(spec['container_id']) #Left by a previous provision
+            if spec.get('warm') is not None:
+                if self.renameContainer(spec['warm'], spec['container_id']) is True:
+                    return True
+                self.removeContainer(spec['warm']) #Start a new container on the same port instead
+            return self.startNew(container_id=spec['container_id'],
+                                 sliver_type=spec.get('sliver_type'),
+                                 ssh_port=spec.get('ssh_port'),
+                                 mac_address=spec.get('mac_address'),
+                                 image=spec.get('image'))
+        return bulkMap(start, specs)
+
+    #Set up the users of the containers, specs is a list of dict(container_id, user_keys_dict)
+    #Returns True or an error message for each container
+    def setupContainers(self, specs):
+        return bulkMap(lambda spec: self.setupContainer(spec['container_id'], spec['user_keys_dict']), specs)
+
+    #Remove the containers, then release the ports they used
+    #Returns True or an error message for each container
+    def removeContainers(self, container_ids, ports=None):
+        out = bulkMap(self.removeContainer, container_ids)
+        self.releasePorts(ports or [])
+        return out
+
+    #Run a shell command in the container, like "docker exec container_id sh -c cmd"
+    #Returns the output, or raises CommandError if the command fails
+    def execShell(self, container_id, cmd):
+        code, output = docker_client.execRun(container_id, ["sh", "-c", cmd])
+        if code != 0:
+            raise CommandError(code, output)
+        return output
+
     #Setup a user in the container
     #ssh_keys : Array of public ssh keys to allow (authorized_keys file)
     def setupUser(self, container_id, username, ssh_keys):
-        try:
-            cmd_create_user = "docker exec " + container_id + " sh -c 'grep \'^" + username + ":\' /etc/passwd ; if [ $? -ne 0 ] ; then useradd -m -d /home/" + username + " " + username + " && mkdir -p /home/" + username + "/.ssh ; fi' 2>&1"
-            out = subprocess.check_output(['bash', '-c', cmd_create_user])
-            cmd_add_key = "docker exec " + container_id + " sh -c \"echo '' > /home/" + username + "/.ssh/authorized_keys\" 2>&1"
-            out = subprocess.check_output(['bash', '-c', cmd_add_key])
-            for key in ssh_keys:
-                cmd_add_key = "docker exec " + container_id + " sh -c \"echo '" + key + "' >> /home/" + username + "/.ssh/authorized_keys\" 2>&1"
-                out = subprocess.check_output(['bash', '-c', cmd_add_key])
-            cmd_set_rights = "docker exec " + container_id + " sh -c 'chown -R " + username + ": /home/" + username + " && chmod 700 /home/" + username + "/.ssh && chmod 644 /home/" + username + "/.ssh/authorized_keys' 2>&1"
-            out = subprocess.check_output(['bash', '-c', cmd_set_rights])
-            return True
-        except subprocess.CalledProcessError, e:
-            return e.output
+        return self.setupContainer(container_id, {username: ssh_keys})
 
+    #Setup all the users of user_keys_dict (username => array of public ssh keys) with a single script run in the container
     def setupContainer(self, container_id, user_keys_dict):
+        script = ["set -e"]
         for username, ssh_keys in user_keys_dict.items():
-            res = self.setupUser(container_id, username, ssh_keys)
-            if res is not True:
-                return res
-        return True
+            home = pipes.quote("/home/" + username)
+            user = pipes.quote(username)
+            script.append("grep -q '^'" + user + "':' /etc/passwd || useradd -m -d " + home + " " + user)
+            script.append("mkdir -p " + home + "/.ssh")
+            script.append("printf '%s\\n' '' " + " ".join([pipes.quote(key) for key in ssh_keys]) + " > " + home + "/.ssh/authorized_keys")
+            script.append("chown -R " + user + ": " + home + " && chmod 700 " + home + "/.ssh && chmod 644 " + home + "/.ssh/authorized_keys")
+        try:
+            self.execShell(container_id, "\n".join(script))
+            inventory.addUsers(container_id, user_keys_dict.keys())
+            return True
+        except CommandError as e:
+            return e.output
+        except DockerAPIError as e:
+            return str(e)
 
     #Get the ssh_port used by a specific container
+    #Read from the inventory for a running container, a container it doesn't know yet (just started) is inspected
     def getPort(self, container_id):
-        cmd = "docker ps --format {{.Names}}//{{.Ports}} --no-trunc | grep " + container_id
-        output = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-        m = re.search(':([0-9]*)->', output)
-        if m!=None:
-            return int(m.group(1))
-        else:
+        entry = inventory.lookup(container_id)
+        if entry is not None and entry['running'] and entry['ssh_port'] is not None:
+            return entry['ssh_port']
+        try:
+            ports = docker_client.inspectContainer(container_id)['NetworkSettings']['Ports']
+            return int(ports['22/tcp'][0]['HostPort'])
+        except (DockerAPIError, KeyError, IndexError, TypeError):
             return None
 
     #Get list of user with an account in the container (with a home and authorized ssh key)
+    #The users set up by setupContainer() are remembered, the container is only searched for the other ones
     def getUsers(self, container_id):
-        cmd = "docker exec " + container_id + " find /home -name \"authorized_keys\" | grep \"/home/.*/.ssh/authorized_keys\" | cut -d'/' -f 3"
-        out = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-        return filter(None, out.split('\n')) #Remove empty elements
+        users = inventory.users(container_id)
+        if users is not None:
+            return users
+        _, out = docker_client.execRun(container_id, ["find", "/home", "-name", "authorized_keys"])
+        users = list()
+        for line in out.split('\n'):
+            m = re.match(r'^/home/([^/]+)/\.ssh/authorized_keys$', line.strip())
+            if m is not None:
+                users.append(m.group(1))
+        if len(users) > 0:
+            inventory.addUsers(container_id, users)
+        return users
+
+    #Wait up to timeout seconds for changes of the containers of the docker host after the sequence number since
+    #Returns dict(epoch, seq, synced, full, changes), see ContainerInventory.waitChanges()
+    def waitEvents(self, since=0, timeout=30, epoch=None):
+        return inventory.waitChanges(since, timeout, epoch)
 
     #Check if docker is installed and accessible by the AM
     def checkDocker(self):
-        cmd = "docker ps"
         try:
-            subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
+            docker_client.ping()
         except Exception, e:
             sys.stderr.write('Docker is not installed OR this user is not in the docker group OR the docker daemon is not started\n')
             exit(1)
 
     #Get IPv6 of a container
     def getIpV6(self, container_id):
-        cmd = "docker inspect " + container_id
-        output = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-        output = json.loads(output)
-        return output[0]['NetworkSettings']['GlobalIPv6Address']
+        return docker_client.inspectContainer(container_id)['NetworkSettings']['GlobalIPv6Address']
 
     #Predict Ipv6 using the ipv6 prefix and the mac address
     def computeIpV6(self, prefix, mac):
@@ -246,78 +435,235 @@ class DockerManager(object):
         mac = [0x02, 0x42, 0xac, 0x11, random.randint(0x00, 0xff), random.randint(0x00, 0xff)]
         return ':'.join(map(lambda x: "%02x" % x, mac))
 
-    #Delete a docker built image
+    #Release an image processed for "owner::image": it stays in the image cache, until it is evicted to
+    #keep the cache in its disk budget
+    #Its builds are cancelled if no other slice waits for them
     def deleteImage(self, name):
-        if name.startswith("urn") and len(name.split("::"))==2:
-            name = hashlib.sha1(name).hexdigest()
-        cmd = "docker rmi -f "+name
-        subprocess.check_output(['bash', '-c', cmd])
+        build_scheduler.cancelOwner(name)
+        image_cache.release(name)
+        image_cache.evict()
+
+    #Returns a tar archive (in memory) containing the given files
+    #files : dict of filename => content
+    def tarFiles(self, files):
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode="w")
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = time.time()
+            info.mode = 0644
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        return buf.getvalue()
 
-    #Build a docker hub image with an OpenSSH server
-    def buildSshImage(self, name):
+    #Yields a tar archive of members (iterable of (TarInfo, file object or None)) in chunks, so that a build context
+    #can be streamed to the docker daemon without being written anywhere or held in memory
+    def iterTar(self, members):
+        for info, f in members:
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            if f is not None:
+                for data in iter(lambda: f.read(CHUNK_SIZE), ""):
+                    yield data
+                if info.size % tarfile.BLOCKSIZE > 0:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+    #Returns a temporary file with a tar archive of the directory path, used as a build context
+    def tarDirectory(self, path):
+        tmp = tempfile.TemporaryFile()
+        tar = tarfile.open(fileobj=tmp, mode="w")
+        tar.add(path, arcname=".")
+        tar.close()
+        tmp.seek(0)
+        return tmp
+
+    #Build the image tag from the tar build context
+    #build : the scheduled Build (see buildscheduler.py) receiving the progress, and able to cancel the build
+    #Returns True, or the end of the build output if the build failed
+    def buildImage(self, context, tag, dockerfile="Dockerfile", build=None):
+        if build is None:
+            build = Build(tag, BUILD_TIMEOUT)
         try:
-            cmd = "mktemp"
-            tmpfile = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            cmd = "echo 'FROM " +name+"' > "+tmpfile
-            out = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            cmd = "cat "+os.path.dirname(os.path.abspath(__file__))+"/Dockerfile_template >> "+tmpfile
-            out = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            cmd = "docker build -t "+name+" --force-rm -f "+tmpfile+" /tmp 2>&1"
-            out = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            cmd = "rm -f "+tmpfile
-            out = subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            return True
-        except subprocess.CalledProcessError, e:
-            return e.output
+            stream = docker_client.build(context, tag, dockerfile)
+            build.attach(stream)
+            for msg in stream.iterJson():
+                if "stream" in msg:
+                    build.log(msg["stream"])
+                if "error" in msg:
+                    build.log(msg["error"])
+                    return "Error : build of %s failed:\n%s" % (tag, "\n".join(build.progress))
+        except Exception as e:
+            build.check() #The build was interrupted by its cancellation
+            return "Error : "+str(e)
+        finally:
+            if hasattr(context, "close"):
+                context.close()
+        build.check()
+        return True
 
-    #Build the image given in parameter
+    #Build a docker hub image with an OpenSSH server, tagged tag
+    def buildSshImage(self, name, tag, build=None):
+        with open(os.path.dirname(os.path.abspath(__file__))+"/Dockerfile_template", 'r') as fi:
+            dockerfile = "FROM "+name+"\n"+fi.read()
+        return self.buildImage(self.tarFiles({"Dockerfile": dockerfile}), tag, build=build)
+
+    #Pull the image name from Docker Hub, and return its id (the local image is used if the pull fails)
+    def pullImage(self, name, build):
+        repository, _, tag = name.partition(":")
+        try:
+            stream = docker_client.post("/images/create", params={"fromImage": repository, "tag": tag or "latest"},
+                                        stream=True, timeout=None)
+            build.attach(stream)
+            for msg in stream.iterJson():
+                if "status" in msg and "progress" not in msg:
+                    build.log(msg["status"])
+                if "error" in msg:
+                    logging.getLogger('gcf.am3').warning("Pull of %s failed: %s", name, msg["error"])
+        except Exception as e:
+            build.check()
+            logging.getLogger('gcf.am3').warning("Pull of %s failed: %s", name, e)
+        build.check()
+        return docker_client.inspectImage(name)["Id"]
+
+    #Start (or join) the build of the image given in parameter, without waiting for it
     #image : could be URL to a DockerFile or a zip or just the name from Docker Hub (eg debian:jessie). Always starts with "foo::" (foo is usually the slice urn) to make the name "private"
-    def processImage(self, image):
-        fullName = image.split("::")
-        user = fullName[0]
-        imageName = fullName[1]
-        if imageName.startswith("http://") or imageName.startswith("https://"):
-            image = hashlib.sha1(image).hexdigest() #Hash the "URN::imagename" to avoid issue with docker
-            cmd = "docker images --no-trunc --format {{.Repository}} | grep -x "+image
-            try:
-                subprocess.check_output(['bash', '-c', cmd]).strip().decode('utf-8')
-            except subprocess.CalledProcessError: #Image doesn't exists
-                out = self.buildExternalImage(imageName, image)
-                if out is not True:
-                    return out
-            return image
-        else: #Docker hub image
-            #Check if image exists
-            cmd = "docker images --no-trunc --format {{.Repository}} | grep -x "+imageName
-            try:
-                subprocess.check_output(['bash', '-c', cmd])
-            except subprocess.CalledProcessError:
-                if building.get(image, None) is None:
-                    building[image] = threading.Lock()
-                building[image].acquire()
-                out = self.buildSshImage(imageName)
-                if out is not True:
-                    return out
-                building[image].release()
-            return imageName
-
-    #Build image from a URL and set the name "fullname" in docker
-    def buildExternalImage(self, url, fullName):
-        tmpdir = tempfile.mkdtemp()
-        self.dlfile(url, tmpdir)
+    #Returns the status of the build (see waitImage())
+    def prepareImage(self, image):
+        return self.submitImage(image).status()
+
+    #Returns the status of the last build of image (see waitImage()) without starting one, None if there was none
+    def imageStatus(self, image):
+        build = build_scheduler.get(image.split("::")[1])
+        if build is None:
+            return None
+        return build.status()
+
+    #Wait up to timeout seconds for the build of image
+    #Returns a dict with the state of the build (queued, building, ready, failed or cancelled), the last lines of its
+    #progress, its error message and the name of the built image
+    def waitImage(self, image, timeout=10):
+        build = self.submitImage(image)
+        build.wait(timeout)
+        return build.status()
+
+    def submitImage(self, image):
+        return build_scheduler.submit(image.split("::")[1], image, lambda build: self.buildRequestedImage(image, build))
+
+    #Build the image given in parameter (see prepareImage()) and wait for it
+    #Returns the name of the image to run, or an error message
+    def processImage(self, image, retry=True):
+        build = self.submitImage(image)
+        if not build.join():
+            return "Error : build of %s timed out" % image.split("::")[1]
+        if build.state != "ready":
+            return build.error
+        if docker_client.imageExists(build.result):
+            image_cache.get(build.cache_key, image)
+            image_cache.evict()
+            return build.result
+        if retry: #The image was evicted since its build: build it again
+            return self.processImage(image, retry=False)
+        return "Error : image %s has been removed" % build.result
+
+    #Images are shared by content between slices (see image_cache): a URL image is named after the hash of what is
+    #downloaded, and a Docker Hub image after its name and image id.
+    #Returns True once build.result is the name of the image to run, or an error message
+    def buildRequestedImage(self, image, build):
+        imageName = image.split("::")[1]
+        key = image_cache.keyOf(image)
+        if key is not None: #Already processed for this slice
+            tag = image_cache.get(key, image)
+            if docker_client.imageExists(tag):
+                build.cache_key, build.result = key, tag
+                return True
+            image_cache.discard(key)
+        try:
+            if imageName.startswith("http://") or imageName.startswith("https://"):
+                #Not piped straight to the build: its sha256 names the image (maybe already built), and a zip
+                #can only be read once complete (its directory is at the end)
+                download = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+                try:
+                    build.log("Downloading "+imageName)
+                    digest = self.dlfile(imageName, download)
+                    build.check()
+                    key = "url:"+digest
+                    tag = IMAGE_TAG_PREFIX+"url_"+digest
+                    if image_cache.get(key, image) is None or not docker_client.imageExists(tag):
+                        out = self.buildExternalImage(imageName, tag, download, build)
+                        if out is not True:
+                            return out
+                finally:
+                    download.close()
+            else: #Docker hub image
+                key = imageName+"@"+self.pullImage(imageName, build)
+                tag = IMAGE_TAG_PREFIX+"ssh_"+hashlib.sha1(key).hexdigest()
+                if image_cache.get(key, image) is None or not docker_client.imageExists(tag):
+                    out = self.buildSshImage(imageName, tag, build)
+                    if out is not True:
+                        return out
+        except (DockerAPIError, IOError, URLError) as e:
+            build.check()
+            return "Error : "+str(e)
+        size = docker_client.inspectImage(tag)["Size"]
+        for owner in list(build.owners):
+            image_cache.put(key, tag, size, owner)
+        build.cache_key, build.result = key, tag
+        return True
+
+    #Build image from a URL (downloaded in the file download) and set the name "fullname" in docker
+    #The build context is streamed from the download to the docker daemon, nothing is extracted on the disk
+    def buildExternalImage(self, url, fullName, download, build=None):
+        download.seek(0)
         if os.path.basename(url) == "Dockerfile": #If the target URL is a simple DockerFile
-            pass
+            context = self.tarFiles({"Dockerfile": self.sshDockerfile(download.read())})
         elif os.path.basename(url).split(".")[-1] == "zip": #A zip containing /Dockerfile or /folder/Dockerfile (and other things)
-            zipfile.ZipFile(tmpdir+"/"+os.path.basename(url)).extractall(tmpdir)
-            if len(os.listdir(tmpdir))==2 and "Dockerfile" not in os.listdir(tmpdir): #If the zip contains a subfolder
-                cmd = "mv "+tmpdir+"/*/* "+tmpdir
-                subprocess.check_output(['bash', '-c', cmd])
+            try:
+                archive = zipfile.ZipFile(download)
+            except zipfile.BadZipfile as e:
+                return "Error : "+str(e)
+            names = archive.namelist()
+            prefix = ""
+            top = set([n.split("/")[0] for n in names])
+            if len(top) == 1 and "Dockerfile" not in names: #If the zip contains a subfolder
+                prefix = top.pop()+"/"
+            if prefix+"Dockerfile" not in names:
+                return "Error : no Dockerfile in "+url
+            dockerfile = self.sshDockerfile(archive.read(prefix+"Dockerfile"))
+            context = self.iterTar(self.zipContext(archive, prefix, dockerfile))
         else:
-            shutil.rmtree(tmpdir)
             return "Error : Unsupported URL"
-        #Fix CMD to start SSH daemon and the original command
+        return self.buildImage(context, fullName, build=build)
+
+    #The members of the build context of a zip (see iterTar()): the content of its folder prefix,
+    #with the Dockerfile replaced by dockerfile
+    def zipContext(self, archive, prefix, dockerfile):
+        for member in archive.infolist():
+            name = member.filename[len(prefix):]
+            if not member.filename.startswith(prefix) or name.strip("/") in ("", "Dockerfile"):
+                continue
+            info = tarfile.TarInfo(name.rstrip("/"))
+            info.mtime = time.mktime(member.date_time + (0, 0, -1))
+            mode = (member.external_attr >> 16) & 07777
+            if name.endswith("/"):
+                info.type = tarfile.DIRTYPE
+                info.mode = mode or 0755
+                yield info, None
+            else:
+                info.size = member.file_size
+                info.mode = mode or 0644
+                yield info, archive.open(member)
+        info = tarfile.TarInfo("Dockerfile")
+        info.size = len(dockerfile)
+        info.mtime = time.time()
+        info.mode = 0644
+        yield info, StringIO(dockerfile)
+
+    #Returns the Dockerfile with the commands of Dockerfile_template (OpenSSH server), and a CMD starting
+    #the SSH daemon besides the original command
+    def sshDockerfile(self, dockerfile):
         cmd = ""
-        for line in open(tmpdir+"/Dockerfile"):
+        for line in dockerfile.splitlines():
             if line.startswith("CMD "):
                 cmd = line.strip()[4:]
         if len(cmd) > 0:
@@ -334,81 +680,96 @@ class DockerManager(object):
                 new_cmd = "CMD sh -c '"+cmd+" & /usr/sbin/sshd -D'"
         else: #If no CMD in the Dockerfile
             new_cmd = "CMD [\"/usr/sbin/sshd\", \"-D\"]"
-        with open(tmpdir+"/Dockerfile", 'a') as fo:
-            with open(os.path.dirname(os.path.abspath(__file__))+"/Dockerfile_template", 'r') as fi:
-                fo.write(fi.read())
-        cmd = "sed -i 's/CMD.*//g' "+tmpdir+"/Dockerfile"
-        subprocess.check_output(['bash', '-c', cmd])
-        with open(tmpdir+"/Dockerfile", 'a') as fo:
-            fo.write(new_cmd)
-        cmd = "docker build -t "+fullName+" --force-rm -f "+tmpdir+"/Dockerfile "+tmpdir+" 2>&1"
-        try:
-            subprocess.check_output(['bash', '-c', cmd])
-        except subprocess.CalledProcessError, e:
-            shutil.rmtree(tmpdir)
-            return e.output
-        shutil.rmtree(tmpdir)
-        return True
+        with open(os.path.dirname(os.path.abspath(__file__))+"/Dockerfile_template", 'r') as fi:
+            dockerfile += fi.read()
+        #The CMD lines are emptied, like sed 's/^CMD.*//g'
+        lines = ["" if line.startswith("CMD") else line for line in dockerfile.split("\n")]
+        return "\n".join(lines)+new_cmd
 
-    #Download a file to the given path
+    #Download url to the file object dest, in chunks, up to MAX_IMAGE_DOWNLOAD MB
+    #Returns the sha256 of the file
     def dlfile(self, url, dest):
+        f = urlopen(url, timeout=DOWNLOAD_TIMEOUT)
         try:
-            f = urlopen(url)
-            # Open local file for writing
-            with open(dest+"/"+os.path.basename(url), "wb") as local_file:
-                local_file.write(f.read())
-        #handle errors
-        except HTTPError, e:
-            logging.getLogger('gcf.am3').error("HTTP Error:", e.code, url)
-        except URLError, e:
-            logging.getLogger('gcf.am3').error("HTTP Error:", e.code, url)
-
-    #Extract a tar.gz file given to the install_path in the container id
+            digest = hashlib.sha256()
+            size = 0
+            for data in iter(lambda: f.read(CHUNK_SIZE), ""):
+                size += len(data)
+                if size > MAX_IMAGE_DOWNLOAD*1024*1024:
+                    raise IOError("%s is larger than %d MB" % (url, MAX_IMAGE_DOWNLOAD))
+                digest.update(data)
+                dest.write(data)
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+    #Extract a tar.gz file given to the install_path in the container id (other files are copied as is)
+    #The file comes from the artifact cache of the host, it is copied in the container with a tar stream
     def installCommand(self, container_id, url, install_path):
-        cmd_docker = "docker exec " + container_id + " "
+        owner = str(uuid.uuid4())
         filename = os.path.basename(url)
-        ext = os.path.basename(url).split(".")[-1]
-        cmd = cmd_docker+"mkdir -p "+install_path+" 2>&1"
         try:
-            subprocess.check_output(['bash', '-c', cmd])
-            cmd = cmd_docker+"curl -fsS -o "+install_path+"/"+filename+" "+url+" 2>&1"
-            subprocess.check_output(['bash', '-c', cmd])
-            if filename.split(".")[-1] == "gz" and filename.split(".")[-2] == "tar": # tar.gz file
-                cmd = cmd_docker+"tar xzf "+install_path+"/"+filename+" -C "+install_path+" 2>&1"
-                subprocess.check_output(['bash', '-c', cmd])
-        except subprocess.CalledProcessError as e:
+            self.execShell(container_id, "mkdir -p "+install_path+" 2>&1")
+            with artifact_cache.open(url, owner) as f:
+                info = tarfile.TarInfo(filename)
+                info.size = os.fstat(f.fileno()).st_size
+                info.mtime = time.time()
+                info.mode = 0644
+                docker_client.putArchive(container_id, install_path, self.iterTar([(info, f)]))
+                if filename.split(".")[-1] == "gz" and filename.split(".")[-2] == "tar": # tar.gz file
+                    #Extracted by the docker daemon, like "tar xzf" in the container
+                    f.seek(0)
+                    docker_client.putArchive(container_id, install_path, f)
+        except CommandError as e:
             return e.output.strip()
+        except DockerAPIError as e:
+            return str(e)
+        except (URLError, IOError, OSError) as e:
+            return "Failed to download "+url+": "+str(e)
+        finally:
+            artifact_cache.release(owner)
         return True
 
-    #Executes the command cmd with the shell 'shell' in the container id
-    #Creates 3 files in /tmp of the container : startup-[0-9].(status|txt|sh)
+    #Executes the command cmd with the shell 'shell' in the container id, in a single exec
+    #Creates 3 files in /tmp of the container : startup-[index].(status|txt|sh)
+    #index : position of the execute service in the node (the manifest advertises the same file names)
     #.sh contains the command executed
     #.status contains the return status of the command
     #.txt return the output
-    def executeCommand(self, container_id, shell, cmd):
-        cmd_docker = "docker exec " + container_id + " "
-        log_dir = "/tmp/"
+    def executeCommand(self, container_id, shell, cmd, index):
         if shell not in ['sh', 'bash']:
-            cmd = cmd_docker+"sh -c 'echo \"Invalid shell\" >> /tmp/execute.log '"
-            subprocess.check_output(['bash', '-c', cmd])
-            return
+            try:
+                self.execShell(container_id, "echo \"Invalid shell\" >> /tmp/execute.log")
+            except (CommandError, DockerAPIError) as e:
+                pass
+            return "Invalid shell: "+str(shell)
         try:
-            list_startup = cmd_docker+"sh -c 'ls "+log_dir+" | grep startup-.*.sh | grep -o [0-9]*'"
-            out = subprocess.check_output(['bash', '-c', list_startup]).strip().split('\n')
-            next_nb = int(max(out))+1
-        except subprocess.CalledProcessError as e:
-            next_nb = 0
-        tmp = tempfile.mkstemp()[1]
-        with open(tmp, 'w') as local:
-            local.write(cmd)
-        cmd = "docker cp " + tmp +" " + container_id + ":/" + log_dir + "startup-" + str(next_nb) + ".sh"
+            docker_client.execRun(container_id, ["sh", "-c", self._executeScript(shell, index, 1), "sh", cmd])
+        except DockerAPIError as e:
+            return str(e)
+        return True
+
+    #The script of an execute service, its command being given as the positional parameter number arg,
+    #so it is written as is, without any quoting
+    def _executeScript(self, shell, index, arg):
+        prefix = "/tmp/startup-"+str(index)
+        return "printf '%s' \"${"+str(arg)+"}\" > "+prefix+".sh; "+shell+" "+prefix+".sh > "+prefix+".txt 2>&1; echo $? > "+prefix+".status"
+
+    #Starts the execute services commands (list of (shell, cmd, index)) in a single detached exec, which runs them
+    #one after the other: returns as soon as they are started, with the same log files as executeCommand()
+    def executeCommands(self, container_id, commands):
+        scripts = list()
+        args = list()
+        errors = list()
+        for shell, cmd, index in commands:
+            if shell not in ['sh', 'bash']:
+                scripts.append("echo \"Invalid shell\" >> /tmp/execute.log")
+                errors.append("Invalid shell: "+str(shell))
+                continue
+            args.append(cmd)
+            scripts.append(self._executeScript(shell, index, len(args)))
         try:
-            subprocess.check_output(['bash', '-c', cmd])
-            os.remove(tmp)
-            cmd = cmd_docker+"sudo sh -c '"+shell+" "+log_dir+"startup-"+str(next_nb)+".sh 2>&1 > "+log_dir+"startup-"+str(next_nb)+".txt'"
-            subprocess.check_output(['bash', '-c', cmd])
-            cmd = cmd_docker+"sh -c 'echo \"0\" > "+log_dir+"startup-"+str(next_nb)+".status'"
-            subprocess.check_output(['bash', '-c', cmd])
-        except subprocess.CalledProcessError as e:
-            cmd = cmd_docker+"sh -c 'echo \""+str(e.returncode)+"\" > "+log_dir+"startup-"+str(next_nb)+".status'"
-            subprocess.check_output(['bash', '-c', cmd])
+            docker_client.execDetached(container_id, ["sh", "-c", "; ".join(scripts), "sh"] + args)
+        except DockerAPIError as e:
+            return str(e)
+        return True if len(errors) == 0 else "\n".join(errors)
@@ -0,0 +1,208 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+from dockerapi import DockerAPIError
+
+#Number of changes kept for the AM: an AM further behind gets the whole inventory again
+INVENTORY_CHANGES = 10000
+#Seconds before subscribing again to the events of the docker daemon after an error
+EVENTS_RETRY_DELAY = 5
+#Events after which the container is inspected again (the others, exec_* for example, don't change its state)
+INSPECTED_EVENTS = ("create", "start", "restart", "die", "oom", "kill", "pause", "unpause", "rename", "update")
+#State of a container that doesn't exist anymore
+STATE_REMOVED = "removed"
+
+class ContainerInventory(object):
+    """
+        The containers of a docker host, with their state (running, exit code, killed for lack of memory) and their
+        SSH port, kept up to date from the events stream of the docker daemon so that they are read from memory.
+        Each change gets a sequence number: the AM waits for the changes it hasn't seen yet with waitChanges(),
+        instead of polling the containers. The sequence numbers start again with a new epoch when the process restarts.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.epoch = str(uuid.uuid4())
+        self.synced = False #False until the first listing of the containers, and while the events are not followed
+        self._cond = threading.Condition()
+        self._containers = dict() #container name => entry (see _entry())
+        self._users = dict() #container name => users set up by the DockerManager
+        self._changes = collections.deque(maxlen=INVENTORY_CHANGES) #(sequence number, entry)
+        self._seq = 0
+        self._started = False
+
+    #Start following the events of the docker daemon (once)
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        follower = threading.Thread(target=self._run)
+        follower.daemon = True
+        follower.start()
+
+    def _run(self):
+        while True:
+            try:
+                #Subscribe before listing the containers, so no change is missed in between
+                stream = self.client.get("/events", params={"filters": json.dumps({"type": ["container"]})},
+                                         stream=True, timeout=None)
+                try:
+                    self._sync()
+                    for event in stream.iterJson():
+                        self._onEvent(event)
+                finally:
+                    stream.close()
+                logging.getLogger('gcf.am3').warn("The events stream of the docker daemon has ended")
+            except Exception as e:
+                logging.getLogger('gcf.am3').warn("Lost the events of the docker daemon: %s", e)
+            with self._cond:
+                self.synced = False
+                self._cond.notifyAll()
+            time.sleep(EVENTS_RETRY_DELAY)
+
+    #Returns the entry of a container from its inspection, or None if it doesn't exist anymore
+    def _inspect(self, container_id):
+        try:
+            info = self.client.inspectContainer(container_id)
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+        return self._entry(info)
+
+    def _entry(self, info):
+        state = info["State"]
+        try:
+            ssh_port = int(info["NetworkSettings"]["Ports"]["22/tcp"][0]["HostPort"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            ssh_port = None
+        return dict(name=info["Name"].lstrip("/"),
+                    id=info["Id"],
+                    state=state.get("Status", "running" if state["Running"] else "exited"),
+                    running=state["Running"],
+                    exit_code=state["ExitCode"],
+                    oom_killed=state.get("OOMKilled", False),
+                    ssh_port=ssh_port)
+
+    #Replace the inventory by the current containers, the AM gets all of them with its next waitChanges()
+    def _sync(self):
+        containers = dict()
+        for c in self.client.get("/containers/json", params={"all": 1}):
+            entry = self._inspect(c["Id"])
+            if entry is not None:
+                containers[entry["name"]] = entry
+        with self._cond:
+            self._containers = containers
+            for name in self._users.keys():
+                if name not in containers:
+                    del self._users[name]
+            self._seq += 1
+            self._changes.clear()
+            self.synced = True
+            self._cond.notifyAll()
+
+    def _onEvent(self, event):
+        action = event.get("Action") or event.get("status")
+        actor = event.get("Actor", {})
+        attributes = actor.get("Attributes") or {}
+        if action == "destroy":
+            with self._cond:
+                entry = self._containers.pop(attributes.get("name", ""), None)
+                if entry is not None:
+                    self._users.pop(entry["name"], None)
+                    self._change(dict(entry, state=STATE_REMOVED, running=False))
+        elif action in INSPECTED_EVENTS:
+            entry = self._inspect(actor.get("ID") or event["id"])
+            with self._cond:
+                if action == "rename":
+                    old = self._containers.pop(attributes.get("oldName", "").lstrip("/"), None)
+                    if old is not None:
+                        if old["name"] in self._users:
+                            self._users[attributes.get("name", "")] = self._users.pop(old["name"])
+                        self._change(dict(old, state=STATE_REMOVED, running=False))
+                if entry is not None:
+                    self._containers[entry["name"]] = entry
+                    self._change(entry)
+
+    #Called with _cond held
+    def _change(self, entry):
+        self._seq += 1
+        self._changes.append((self._seq, entry))
+        self._cond.notifyAll()
+
+    def waitChanges(self, since, timeout, epoch=None):
+        """
+            Wait up to timeout seconds for changes after the sequence number since
+
+            :param epoch: the epoch of since, all the containers are returned if it isn't the current one
+            :return: dict(epoch, seq, synced, full, changes): the last sequence number, and the entries of the containers
+            that have changed (all the containers if full is True, the removed ones are then left out)
+        """
+        self.start()
+        with self._cond:
+            deadline = time.time() + timeout
+            while (not self.synced or (epoch == self.epoch and self._seq <= since)) and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            base = self._changes[0][0] - 1 if len(self._changes) > 0 else self._seq
+            full = epoch != self.epoch or since < base or since > self._seq
+            if full:
+                changes = self._containers.values()
+            else:
+                changes = [entry for seq, entry in self._changes if seq > since]
+            return dict(epoch=self.epoch, seq=self._seq, synced=self.synced, full=full, changes=changes)
+
+    #Returns the entry of a container, or None if it isn't known (or if the inventory isn't synced)
+    def lookup(self, name):
+        self.start()
+        with self._cond:
+            if not self.synced:
+                return None
+            return self._containers.get(name)
+
+    #Returns the number of running containers, or None if the inventory isn't synced
+    def runningCount(self):
+        self.start()
+        with self._cond:
+            if not self.synced:
+                return None
+            return len([e for e in self._containers.values() if e["running"]])
+
+    #The users set up in a container (see DockerManager.setupContainer()), None if they aren't known
+    def users(self, name):
+        with self._cond:
+            users = self._users.get(name)
+            return sorted(users) if users is not None else None
+
+    def addUsers(self, name, users):
+        with self._cond:
+            self._users.setdefault(name, set()).update(users)
+
+    def forgetUsers(self, name):
+        with self._cond:
+            self._users.pop(name, None)
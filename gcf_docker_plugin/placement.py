@@ -0,0 +1,141 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from dockermaster import DockerMaster
+from pyropool import callAsync
+
+#Seconds during which the statistics of a docker host are reused
+STATS_TTL = 5
+#Memory (in MB) and CPU load counted for each container placed on a host by the current request
+CONTAINER_MEMORY = 100
+CONTAINER_LOAD = 0.5
+#Namespace of the placement hints of the request RSpec (<node docker:affinity="db" docker:anti_affinity="web">)
+PLACEMENT_NAMESPACE = "http://www.fed4fire.eu/docker_am"
+
+#The policies sort the DockerMasters, the first one is used first
+#stats : the statistics of the host (see DockerManager.getHostStats()), planned : containers placed there by the current request
+
+#Containers running on the host, the warm containers excepted: they stand in free slots (see DockerMaster.size())
+def busy(dockermaster, stats):
+    return max(0, stats['running'] - dockermaster.warmCount())
+
+#Put each container on the host running the fewest containers
+def spread(dockermaster, stats, planned):
+    return (busy(dockermaster, stats) + planned, -dockermaster.size())
+
+#Fill a host before using the next one
+def binpack(dockermaster, stats, planned):
+    return (dockermaster.size(), -(busy(dockermaster, stats) + planned))
+
+#Put each container on the host with the lowest CPU load, then the most free memory
+def leastLoaded(dockermaster, stats, planned):
+    return ((stats['load'] + planned * CONTAINER_LOAD) / max(1, stats['cpus']), -(stats['mem_free'] - planned * CONTAINER_MEMORY))
+
+POLICIES = dict(spread=spread, binpack=binpack, least_loaded=leastLoaded)
+DEFAULT_POLICY = "spread"
+
+class Placement(object):
+    """
+        Chooses the DockerMaster of each requested container, from the statistics of the docker hosts (cached for
+        STATS_TTL seconds) and the affinity hints of the request
+    """
+    def __init__(self, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise Exception("Invalid config: unknown placement_policy \"%s\" (should be one of %s)" % (policy, ", ".join(POLICIES.keys())))
+        self.policy = POLICIES[policy]
+        self._stats = dict() #id(dockermaster) => (time, stats or None if the host didn't answer)
+        self._lock = threading.Lock()
+
+    #Fetch the statistics of the hosts that are not in the cache, in parallel
+    def refresh(self, dockermasters):
+        now = time.time()
+        with self._lock:
+            stale = [d for d in dockermasters if now - self._stats.get(id(d), (0, None))[0] > STATS_TTL]
+        futures = [(d, callAsync(d.dockermanager, "getHostStats")) for d in stale]
+        for dockermaster, future in futures:
+            try:
+                stats = future.value
+            except Exception as e:
+                logging.getLogger('gcf.am3').warning("No statistics from the docker host %s: %s", dockermaster.host, e)
+                stats = None
+            with self._lock:
+                self._stats[id(dockermaster)] = (now, stats)
+
+    def stats(self, dockermaster):
+        with self._lock:
+            return self._stats.get(id(dockermaster), (0, None))[1]
+
+    #Sort the DockerMasters with the policy, the hosts without statistics are used last
+    def sort(self, dockermasters, planned):
+        def key(dockermaster):
+            stats = self.stats(dockermaster)
+            if stats is None:
+                return (True, -dockermaster.size())
+            return (False, self.policy(dockermaster, stats, planned.get(id(dockermaster), 0)))
+        return sorted(dockermasters, key=key)
+
+    #Start the placement of the nodes of an Allocate call
+    #resources : the resources already allocated to the slice
+    def newRequest(self, resources):
+        return PlacementRequest(self, resources)
+
+class PlacementRequest(object):
+    """
+        Placement of the nodes of one Allocate call: remembers the hosts used by the affinity groups of the slice
+        (the nodes of an affinity group go on the same host, the nodes of an anti-affinity group on different hosts)
+    """
+    def __init__(self, placement, resources):
+        self.placement = placement
+        self.planned = dict() #id(dockermaster) => number of containers placed by this request
+        self.affinity = dict() #group => id(dockermaster)
+        self.anti_affinity = dict() #group => set of id(dockermaster)
+        for resource in resources:
+            self.record(resource, count=False)
+
+    #Returns the resources to try for a node, in order (resources that are not DockerMasters are kept after them)
+    def candidates(self, resources, affinity=None, anti_affinity=None):
+        dockermasters = [r for r in resources if isinstance(r, DockerMaster)]
+        others = [r for r in resources if not isinstance(r, DockerMaster)]
+        if affinity in self.affinity:
+            dockermasters = [d for d in dockermasters if id(d) == self.affinity[affinity]]
+        if anti_affinity is not None:
+            dockermasters = [d for d in dockermasters if id(d) not in self.anti_affinity.get(anti_affinity, set())]
+        return self.placement.sort(dockermasters, self.planned) + others
+
+    #Remember where resource (a container with its affinity and anti_affinity attributes) has been placed
+    def record(self, resource, count=True):
+        dockermaster = getattr(resource, 'dockermaster', None)
+        if dockermaster is None:
+            return
+        if count:
+            self.planned[id(dockermaster)] = self.planned.get(id(dockermaster), 0) + 1
+        if getattr(resource, 'affinity', None) is not None:
+            self.affinity.setdefault(resource.affinity, id(dockermaster))
+        if getattr(resource, 'anti_affinity', None) is not None:
+            self.anti_affinity.setdefault(resource.anti_affinity, set()).add(id(dockermaster))
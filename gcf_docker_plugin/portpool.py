@@ -0,0 +1,144 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import threading
+import time
+import logging
+
+PROC_NET_TCP = ["/proc/net/tcp", "/proc/net/tcp6"]
+TCP_LISTEN = "0A"
+LAST_PORT = 65535
+#Seconds between two reconciliations of the pools with the sockets open on the host
+RECONCILE_INTERVAL = 30
+
+pools = dict()
+pools_lock = threading.Lock()
+
+#Return the set of local TCP ports used on this host (what "netstat -ant" shows)
+#listening_only : only return ports with a socket in the LISTEN state
+def readHostPorts(listening_only=False):
+    ports = set()
+    for path in PROC_NET_TCP:
+        try:
+            with open(path) as f:
+                f.readline() #Header
+                for line in f:
+                    fields = line.split()
+                    if listening_only and fields[3] != TCP_LISTEN:
+                        continue
+                    ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except IOError: #No IPv6 for example
+            pass
+    return ports
+
+class PortPool(object):
+    """
+        The ports from starting_port to LAST_PORT, kept as two bitmaps (bit i is port starting_port+i):
+        the ports reserved by the AM, and the ports seen in use on the host at the last reconciliation.
+        A reserved port stays reserved until it is released, even once the container listens on it.
+    """
+    def __init__(self, starting_port):
+        self.starting_port = starting_port
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._busy = 0
+        self.reconcile()
+
+    def _bit(self, port):
+        if port < self.starting_port or port > LAST_PORT:
+            return 0
+        return 1 << (port - self.starting_port)
+
+    #Lowest free bit of the pool (0 if the pool is exhausted)
+    def _lowestFree(self):
+        used = self._reserved | self._busy
+        free = ~used & (used + 1)
+        if free.bit_length() - 1 > LAST_PORT - self.starting_port:
+            return 0
+        return free
+
+    def _port(self, bit):
+        if bit == 0:
+            raise Exception("No port available from %d" % self.starting_port)
+        return self.starting_port + bit.bit_length() - 1
+
+    #Return the first available port, without reserving it
+    def peek(self):
+        with self._lock:
+            return self._port(self._lowestFree())
+
+    #Reserve and return the first available port
+    def reserve(self):
+        with self._lock:
+            bit = self._lowestFree()
+            port = self._port(bit)
+            self._reserved |= bit
+            return port
+
+    #Give back a port: the container using it has been removed
+    def release(self, port):
+        bit = self._bit(port)
+        with self._lock:
+            self._reserved &= ~bit
+            self._busy &= ~bit
+
+    def isReserved(self, port):
+        return self._reserved & self._bit(port) != 0
+
+    #Refresh the ports used on the host from /proc/net/tcp{,6}
+    def reconcile(self, host_ports=None):
+        if host_ports is None:
+            host_ports = readHostPorts()
+        busy = 0
+        for port in host_ports:
+            busy |= self._bit(port)
+        with self._lock:
+            self._busy = busy
+
+#Return the pool starting at starting_port, creating (and seeding) it on first use
+def getPool(starting_port):
+    with pools_lock:
+        pool = pools.get(starting_port)
+        if pool is None:
+            if len(pools) == 0:
+                reconciler = threading.Thread(target=reconcileDaemon)
+                reconciler.daemon = True
+                reconciler.start()
+            pool = PortPool(starting_port)
+            pools[starting_port] = pool
+        return pool
+
+#Pools whose range contains port (all the pools if port is None)
+def poolsFor(port=None):
+    with pools_lock:
+        return [p for p in pools.values() if port is None or p.starting_port <= port]
+
+def reconcileDaemon():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        try:
+            host_ports = readHostPorts()
+            for pool in poolsFor():
+                pool.reconcile(host_ports)
+        except Exception as e:
+            logging.getLogger('gcf.am3').error("Port pool reconciliation failed: %s", e)
@@ -0,0 +1,175 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import collections
+import itertools
+import logging
+import threading
+
+#Number of provisioning jobs run at the same time for each docker host
+PROVISION_WORKERS = 4
+#Slices of at most SMALL_SLICE slivers get ahead of the bigger ones
+SMALL_SLICE = 10
+
+#Priority classes, the lowest first
+PRIORITY_RESTART = 0
+PRIORITY_SMALL = 1
+PRIORITY_LARGE = 2
+_PRIORITIES = 3
+
+PHASE_QUEUED = "queued"
+PHASE_RUNNING = "running"
+
+class ProvisioningJob(object):
+    def __init__(self, lane, slice_urn, sliver_urns, run, priority):
+        self.lane = lane
+        self.slice_urn = slice_urn
+        self.sliver_urns = sliver_urns
+        self.run = run
+        self.priority = priority
+        self.phase = PHASE_QUEUED
+        self.queued = False
+        self.suspended = False
+
+    #Shown in the status of the slivers of the job
+    def setPhase(self, phase):
+        self.phase = phase
+
+    #Called by run() before it returns: the job doesn't hold its worker while it waits for something (the SSH server
+    #of a container for example), and goes on with ProvisioningExecutor.resume()
+    def suspend(self, phase):
+        self.phase = phase
+        self.suspended = True
+
+class _Lane(object):
+    """
+        The jobs of one docker host, one queue per priority class; in each class the slices take turns
+        (round robin), and the jobs of a slice are run in order
+    """
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.queues = [collections.OrderedDict() for _ in range(_PRIORITIES)] #slice urn => deque of jobs
+
+    def put(self, job):
+        job.queued = True
+        self.queues[job.priority].setdefault(job.slice_urn, collections.deque()).append(job)
+        self.cond.notify()
+
+    def take(self):
+        for queue in self.queues:
+            if len(queue) == 0:
+                continue
+            slice_urn, jobs = queue.popitem(last=False)
+            job = jobs.popleft()
+            job.queued = False
+            if len(jobs) > 0:
+                queue[slice_urn] = jobs #Next turn of the slice after the other slices
+            return job
+        return None
+
+    #The queued jobs, in the order they will be run
+    def order(self):
+        ret = list()
+        for queue in self.queues:
+            for turn in itertools.izip_longest(*[list(jobs) for jobs in queue.values()]):
+                ret.extend([job for job in turn if job is not None])
+        return ret
+
+class ProvisioningExecutor(object):
+    """
+        Runs the provisioning work of the slivers (start, install and execute services, restart) with a bounded
+        number of workers for each docker host, instead of a thread per sliver. Restarts come first, then the
+        jobs of small slices; slices of the same class are served in turn so a big slice doesn't hold back the others.
+    """
+    def __init__(self, workers=PROVISION_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._lanes = dict() #host => _Lane
+        self._jobs = dict() #sliver urn => its last job
+
+    def submit(self, host, slice_urn, sliver_urns, run, priority=PRIORITY_LARGE):
+        """
+            :param host: the docker host doing the work (None for the other resources)
+            :param run: function doing the job, called with the ProvisioningJob
+            :return: the ProvisioningJob
+        """
+        with self._lock:
+            lane = self._lanes.get(host)
+            if lane is None:
+                lane = _Lane(self._lock)
+                self._lanes[host] = lane
+                for _ in range(self.workers):
+                    worker = threading.Thread(target=self._run, args=[lane])
+                    worker.daemon = True
+                    worker.start()
+            job = ProvisioningJob(lane, slice_urn, list(sliver_urns), run, priority)
+            for urn in job.sliver_urns:
+                self._jobs[urn] = job
+            lane.put(job)
+            return job
+
+    #Queue a suspended job again, to call run(job) (see ProvisioningJob.suspend())
+    def resume(self, job, run):
+        with self._lock:
+            job.suspended = False
+            job.run = run
+            job.phase = PHASE_QUEUED
+            job.lane.put(job)
+
+    def status(self, sliver_urns):
+        """
+            :return: dict sliver urn => dict(phase, queue_position), for the slivers with a queued or running job.
+            The queue position is the number of jobs of the host to be run first, it is left out once the job is running.
+        """
+        with self._lock:
+            positions = dict()
+            for lane in set([self._jobs[urn].lane for urn in sliver_urns if urn in self._jobs]):
+                for position, job in enumerate(lane.order()):
+                    positions[id(job)] = position
+            ret = dict()
+            for urn in sliver_urns:
+                job = self._jobs.get(urn)
+                if job is not None:
+                    ret[urn] = dict(phase=job.phase)
+                    if id(job) in positions:
+                        ret[urn]["queue_position"] = positions[id(job)]
+            return ret
+
+    def _run(self, lane):
+        while True:
+            with self._lock:
+                job = lane.take()
+                while job is None:
+                    lane.cond.wait()
+                    job = lane.take()
+                job.phase = PHASE_RUNNING
+            try:
+                job.run(job)
+            except Exception as e:
+                logging.getLogger('gcf.am3').error("Provisioning of %s failed: %s", ", ".join(job.sliver_urns), e)
+            with self._lock:
+                if job.suspended or job.queued: #Waiting for resume(), or already resumed
+                    continue
+                for urn in job.sliver_urns:
+                    if self._jobs.get(urn) is job:
+                        del self._jobs[urn]
@@ -0,0 +1,92 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+
+import Queue
+import threading
+import Pyro4
+import Pyro4.errors
+
+#Number of connections opened to each remote DockerManager
+DEFAULT_POOL_SIZE = 8
+
+class DockerManagerPool(object):
+    """
+        Stands for a remote DockerManager (see daemon_dockermanager.py): each call borrows a Pyro4 proxy from a pool
+        and gives it back, so the threads of the AM call the DockerManager in parallel instead of queueing on the
+        connection of a single proxy.
+        Only the URI and the password are pickled, with the rest of the AM state.
+    """
+    def __init__(self, uri, hmac_key=None, size=DEFAULT_POOL_SIZE):
+        self.uri = uri
+        self.hmac_key = hmac_key
+        self.size = size
+        self._setup()
+
+    def _setup(self):
+        self._idle = Queue.LifoQueue()
+        self._available = threading.Semaphore(self.size)
+
+    def __getstate__(self):
+        return dict(uri=self.uri, hmac_key=self.hmac_key, size=self.size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def _borrow(self):
+        self._available.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            proxy = Pyro4.Proxy(self.uri)
+            if self.hmac_key is not None:
+                proxy._pyroHmacKey = self.hmac_key
+            return proxy
+
+    def _giveBack(self, proxy, broken=False):
+        if broken: #Don't reuse a connection in an unknown state
+            proxy._pyroRelease()
+        else:
+            self._idle.put(proxy)
+        self._available.release()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            proxy = self._borrow()
+            broken = False
+            try:
+                return getattr(proxy, name)(*args, **kwargs)
+            except Pyro4.errors.CommunicationError:
+                broken = True
+                raise
+            finally:
+                self._giveBack(proxy, broken)
+        return call
+
+#Call obj.method(*args) in the background (obj is a DockerManager, local or remote, or a DockerMaster for example)
+#Returns a Pyro4 FutureResult: its value attribute waits for the result (or raises the exception of the call)
+def callAsync(obj, method, *args, **kwargs):
+    return Pyro4.Future(getattr(obj, method))(*args, **kwargs)
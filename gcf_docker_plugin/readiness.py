@@ -0,0 +1,186 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+#Seconds to wait for an SSH server before giving up
+SSH_READY_TIMEOUT = 60
+#Seconds between two connection attempts to the same SSH server
+RETRY_INTERVAL = 0.5
+
+class _Probe(object):
+    def __init__(self, address, family, deadline, callback):
+        self.address = address
+        self.family = family
+        self.deadline = deadline
+        self.callback = callback
+        self.next_attempt = 0
+        self.sock = None
+        self.connecting = False
+        self.banner = ""
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class ReadinessWatcher(object):
+    """
+        Waits for SSH servers to accept connections, for all the pending containers at once.
+        A single thread multiplexes non-blocking connections with poll(): a server is ready once
+        it sends its "SSH-" banner (the docker proxy accepts connections before sshd is started).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._new = list()
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+
+    def watch(self, host, port, timeout, callback):
+        """
+            Call callback(True) once an SSH server answers on host:port, or callback(False) after timeout seconds
+        """
+        try:
+            family, _, _, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        except socket.error as e:
+            logging.getLogger('gcf.am3').error("Cannot resolve %s: %s", host, e)
+            callback(False)
+            return
+        with self._lock:
+            self._new.append(_Probe(address, family, time.time() + timeout, callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        os.write(self._wake_w, "x")
+
+    #Blocking version of watch(): returns True if the SSH server is ready, False after timeout seconds
+    def waitFor(self, host, port, timeout=SSH_READY_TIMEOUT):
+        done = threading.Event()
+        result = list()
+        def callback(ready):
+            result.append(ready)
+            done.set()
+        self.watch(host, port, timeout, callback)
+        done.wait(timeout + 5)
+        return len(result) > 0 and result[0]
+
+    def _finish(self, probe, ready):
+        probe.close()
+        try:
+            probe.callback(ready)
+        except Exception as e:
+            logging.getLogger('gcf.am3').error("Readiness callback failed: %s", e)
+
+    def _connect(self, probe, poller, connected):
+        probe.sock = socket.socket(probe.family, socket.SOCK_STREAM)
+        probe.sock.setblocking(0)
+        probe.banner = ""
+        err = probe.sock.connect_ex(probe.address)
+        if err not in (0, errno.EINPROGRESS):
+            self._retry(probe, poller, connected, registered=False)
+            return
+        probe.connecting = True
+        connected[probe.sock.fileno()] = probe
+        poller.register(probe.sock, select.POLLOUT)
+
+    def _retry(self, probe, poller, connected, registered=True):
+        if registered:
+            fd = probe.sock.fileno()
+            poller.unregister(fd)
+            del connected[fd]
+        probe.close()
+        probe.next_attempt = time.time() + RETRY_INTERVAL
+        self._idle.append(probe)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._wake_r, select.POLLIN)
+        connected = dict() #fd => probe
+        self._idle = list() #Probes waiting for their next connection attempt
+        while True:
+            now = time.time()
+            with self._lock:
+                self._idle.extend(self._new)
+                del self._new[:]
+            idle = self._idle
+            self._idle = list()
+            for probe in idle:
+                if now >= probe.deadline:
+                    self._finish(probe, False)
+                elif now >= probe.next_attempt:
+                    self._connect(probe, poller, connected)
+                else:
+                    self._idle.append(probe)
+            for fd, probe in connected.items():
+                if now >= probe.deadline:
+                    poller.unregister(fd)
+                    del connected[fd]
+                    self._finish(probe, False)
+            wakeups = [p.next_attempt for p in self._idle] + [p.deadline for p in connected.values()]
+            timeout = None
+            if len(wakeups) > 0:
+                timeout = max(0, int((min(wakeups) - now) * 1000) + 1)
+            for fd, event in poller.poll(timeout):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                probe = connected.get(fd)
+                if probe is None:
+                    continue
+                if probe.connecting:
+                    if event & (select.POLLERR | select.POLLHUP) or \
+                            probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                        self._retry(probe, poller, connected)
+                        continue
+                    probe.connecting = False
+                    poller.modify(fd, select.POLLIN)
+                    continue
+                try:
+                    data = probe.sock.recv(256)
+                except socket.error:
+                    data = ""
+                probe.banner += data
+                if probe.banner.startswith("SSH-"):
+                    poller.unregister(fd)
+                    del connected[fd]
+                    self._finish(probe, True)
+                elif len(data) == 0 or not "SSH-".startswith(probe.banner[:4]):
+                    self._retry(probe, poller, connected)
+
+watcher = ReadinessWatcher()
+
+#Wait until the SSH server on host:port sends its banner
+def waitForSsh(host, port, timeout=SSH_READY_TIMEOUT):
+    return watcher.waitFor(host, port, timeout)
+
+#Call callback(True) once the SSH server on host:port sends its banner, or callback(False) after timeout seconds
+#The callback is called by the watcher thread: it should only hand the rest of the work to another thread
+def watchSsh(host, port, callback, timeout=SSH_READY_TIMEOUT):
+    watcher.watch(host, port, timeout, callback)
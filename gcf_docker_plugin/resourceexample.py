@@ -126,5 +126,5 @@ class ResourceExample(ExtendedResource):
         pass
 
     #Execute a command with the given shell on the resource
-    def executeCommand(self, shell, cmd):
+    def executeCommand(self, shell, cmd, index):
         pass
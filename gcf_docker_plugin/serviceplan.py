@@ -0,0 +1,136 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import collections
+import logging
+import threading
+from xml.dom import Node
+
+INSTALL = "install"
+EXECUTE = "execute"
+
+#Namespace of the stage attribute of the install services (the same as the placement hints)
+SERVICES_NAMESPACE = "http://www.fed4fire.eu/docker_am"
+#Number of install services of a sliver run at the same time
+INSTALL_CONCURRENCY = 4
+
+class ServiceStep(object):
+    """
+        An install or an execute service of a node of the request
+    """
+    def __init__(self, kind, args, index, stage=None):
+        self.kind = kind
+        self.args = args #(url, install_path) or (shell, command)
+        self.index = index #Position among the services of the same kind, used to name the log files of execute
+        self.stage = stage #Ordering hint of an install: the stages are run one after the other, lowest first (None is stage 0)
+
+    def run(self, resource):
+        if self.kind == INSTALL:
+            return resource.installCommand(*self.args)
+        return resource.executeCommand(*(self.args + (self.index,)))
+
+def _children(element, local_name):
+    return [c for c in element.childNodes
+            if c.nodeType == Node.ELEMENT_NODE and c.localName == local_name and c.namespaceURI == element.namespaceURI]
+
+def _attribute(element, name):
+    value = element.getAttribute(name)
+    return value if value != "" else None
+
+def _stage(element):
+    stage = element.getAttributeNS(SERVICES_NAMESPACE, "stage")
+    try:
+        return int(stage) if stage != "" else None
+    except ValueError:
+        logging.getLogger('gcf.am3').warn("Ignoring the invalid stage \"%s\" of an install service", stage)
+        return None
+
+def compileServicePlan(nodes):
+    """
+        Compile the services of the requested nodes, so the request doesn't have to be parsed again
+        to provision (or reload) the slivers and to generate the manifest
+
+        :param nodes: the node elements (xml.dom.minidom) of the request handled by this AM
+        :return: dict client_id => list of ServiceStep, the install steps first then the execute steps (in request order)
+    """
+    plan = dict()
+    for node in nodes:
+        installs = list()
+        executes = list()
+        services = _children(node, "services")
+        if len(services) > 0:
+            for install in _children(services[0], "install"):
+                installs.append(ServiceStep(INSTALL, (_attribute(install, "url"), _attribute(install, "install_path")),
+                                            len(installs), _stage(install)))
+            for execute in _children(services[0], "execute"):
+                executes.append(ServiceStep(EXECUTE, (_attribute(execute, "shell"), _attribute(execute, "command")),
+                                            len(executes)))
+        plan[node.getAttribute("client_id")] = installs + executes
+    return plan
+
+def runInstalls(steps, resource, done, limit=INSTALL_CONCURRENCY):
+    """
+        Run the install steps of a sliver: the stages one after the other, and the steps of a stage
+        at the same time (at most limit of them), so independent downloads overlap
+
+        :param done: function called with (step, result) once a step has run, one call at a time
+        :return: True if every step succeeded, or the error messages of the failed ones
+    """
+    errors = list()
+    done_lock = threading.Lock()
+    stages = collections.OrderedDict()
+    for step in sorted([s for s in steps if s.kind == INSTALL], key=lambda s: s.stage or 0):
+        stages.setdefault(step.stage or 0, list()).append(step)
+    for group in stages.values():
+        queue = collections.deque(group)
+        lock = threading.Lock()
+        def work():
+            while True:
+                with lock:
+                    if len(queue) == 0:
+                        return
+                    step = queue.popleft()
+                try:
+                    out = step.run(resource)
+                except Exception as e:
+                    out = str(e)
+                with done_lock:
+                    if out is not True:
+                        errors.append(out)
+                    done(step, out)
+        workers = [threading.Thread(target=work) for _ in range(min(limit, len(group)) - 1)]
+        for worker in workers:
+            worker.start()
+        work()
+        for worker in workers:
+            worker.join()
+    if len(errors) > 0:
+        return "\n".join(errors)
+    return True
+
+#Start the execute steps of a sliver, which the resource runs in the background in the order of the request
+def runExecutes(steps, resource):
+    commands = [step.args + (step.index,) for step in steps if step.kind == EXECUTE]
+    if len(commands) == 0:
+        return True
+    return resource.executeCommands(commands)
@@ -0,0 +1,348 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import collections
+import cPickle
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+from cStringIO import StringIO
+
+#Seconds between two fsync of the journal (the records written in between are synced together)
+SYNC_INTERVAL = 0.2
+#Number of records after which the AM writes a new snapshot and truncates the journal
+SNAPSHOT_RECORDS = 10000
+#Default seconds between two records written by a StateWriter
+WRITE_INTERVAL = 1.0
+
+_HEADER = struct.Struct(">I")
+
+#Journal entries, see StateJournal.replay()
+
+#A whole slice (its slivers and request), or its deletion if slyce is None
+def sliceEntry(urn, slyce):
+    return ("slice", urn, slyce)
+
+#The state of a sliver (allocation and operational states, expiration, ...), or its deletion if deleted is True
+def sliverEntry(sliver, deleted=False):
+    slyce = sliver.slice()
+    state = None
+    if not deleted:
+        state = dict([(k, v) for k, v in sliver.__dict__.items() if v is not slyce])
+    return ("sliver", slyce.urn, sliver.urn(), state)
+
+#The state of a resource, or only the given attributes of it
+def resourceEntry(resource, attributes=None):
+    if attributes is not None:
+        state = dict([(a, getattr(resource, a)) for a in attributes])
+    elif hasattr(resource, '__getstate__'):
+        state = resource.__getstate__()
+    else:
+        state = resource.__dict__.copy()
+    return ("resource", resource.id, state)
+
+#The resources allocated to a container of the aggregate (a slice or a user)
+def aggregateEntry(container, resources):
+    return ("agg", container, list(resources))
+
+class StateJournal(object):
+    """
+        Append-only log of the changes made to the AM state since its last snapshot (see DockerAggregateManager.dumpState()).
+        Each record is a list of entries, pickled with the resources and the DockerManagers replaced by references
+        (see register()), so writing a record costs the size of the change and not the size of the whole state.
+        Records are flushed when appended and fsynced in batches by a background thread. On startup, the records are
+        replayed on top of the snapshot; a torn record at the end of the file (crash during a write) is ignored.
+        While a snapshot is written, the records written before it wait in filename.prev.
+    """
+    def __init__(self, filename, snapshot_records=SNAPSHOT_RECORDS):
+        self.filename = filename
+        self.previous = filename + ".prev"
+        self.snapshot_records = snapshot_records
+        self.records = 0
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock() #A single snapshot at a time
+        self._objects = dict() #reference => object
+        self._references = dict() #id(object) => reference
+        self._dirty = False
+        self._full = threading.Event()
+        self._file = open(self.filename, "ab")
+        syncer = threading.Thread(target=self._syncDaemon)
+        syncer.daemon = True
+        syncer.start()
+
+    #Objects pickled by reference in the records: resources (by id) and the DockerManagers of the DockerMasters
+    def register(self, resources):
+        for resource in resources:
+            self._add("r:" + resource.id, resource)
+            dockermanager = getattr(resource, 'dockermanager', None)
+            if dockermanager is not None:
+                self._add("m:" + resource.id, dockermanager)
+
+    def _add(self, reference, obj):
+        if id(obj) not in self._references:
+            self._references[id(obj)] = reference
+        self._objects[reference] = obj
+
+    def _persistentId(self, obj):
+        return self._references.get(id(obj))
+
+    def _persistentLoad(self, reference):
+        return self._objects[reference]
+
+    def append(self, entries):
+        buf = StringIO()
+        p = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+        p.persistent_id = self._persistentId
+        p.dump(entries)
+        data = buf.getvalue()
+        with self._lock:
+            self._file.write(_HEADER.pack(len(data)) + data)
+            self._file.flush()
+            self.records += 1
+            self._dirty = True
+            if self.records >= self.snapshot_records:
+                self._full.set()
+
+    #fsync the records written so far
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            fd = os.dup(self._file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _syncDaemon(self):
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            try:
+                self.sync()
+            except Exception as e:
+                logging.getLogger('gcf.am3').error("Failed to sync the state journal: %s", e)
+
+    #Wait until the journal has snapshot_records records, or timeout seconds
+    def waitFull(self, timeout):
+        self._full.wait(timeout)
+        self._full.clear()
+
+    def snapshot(self, write):
+        """
+            Call write() to save the whole state, then drop the records written before it if it returned True.
+            The lock is only held to move the records to filename.prev and start an empty journal: write() runs while
+            new records are appended, so every change is either in the snapshot or in a record written after it.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                old = self._file
+                records = self.records
+                if os.path.exists(self.previous): #Kept by a failed snapshot: the records stay in order after it
+                    old.close()
+                    with open(self.previous, "ab") as previous, open(self.filename, "rb") as f:
+                        shutil.copyfileobj(f, previous)
+                    old = open(self.previous, "ab")
+                else:
+                    os.rename(self.filename, self.previous)
+                self._file = open(self.filename, "wb")
+                self.records = 0
+                self._dirty = False
+            try:
+                os.fsync(old.fileno())
+            finally:
+                old.close()
+            written = False
+            try:
+                written = write()
+            finally:
+                if not written:
+                    with self._lock:
+                        self.records += records
+            if written:
+                os.remove(self.previous)
+            return written
+
+    def replay(self, slices, aggregate):
+        """
+            Apply the records of the journal to the state restored from the snapshot
+
+            :param slices: the slices of the AM, by urn
+            :param aggregate: the Aggregate of the AM
+            :return: the number of records replayed
+        """
+        count = 0
+        slivers = dict() #sliver urn => sliver, for the slices updated by the records
+        for filename in [self.previous, self.filename]:
+            if os.path.exists(filename):
+                count += self._replayFile(filename, slices, aggregate, slivers)
+        return count
+
+    def _replayFile(self, filename, slices, aggregate, slivers):
+        count = 0
+        with open(filename, "rb") as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                size = _HEADER.unpack(header)[0]
+                data = f.read(size)
+                if len(data) < size:
+                    logging.getLogger('gcf.am3').warn("Ignoring a torn record at the end of the state journal")
+                    break
+                try:
+                    u = cPickle.Unpickler(StringIO(data))
+                    u.persistent_load = self._persistentLoad
+                    entries = u.load()
+                except Exception as e:
+                    logging.getLogger('gcf.am3').warn("Ignoring the end of the state journal: %s", e)
+                    break
+                for entry in entries:
+                    if entry[0] == "slice":
+                        _, urn, slyce = entry
+                        if slyce is None:
+                            slices.pop(urn, None)
+                        else:
+                            slices[urn] = slyce
+                            for sliver in slyce.slivers():
+                                slivers[sliver.urn()] = sliver
+                    elif entry[0] == "sliver":
+                        _, slice_urn, sliver_urn, state = entry
+                        if slice_urn not in slices:
+                            continue
+                        sliver = slivers.get(sliver_urn)
+                        if sliver is None or sliver.slice() is not slices[slice_urn]:
+                            for s in slices[slice_urn].slivers():
+                                slivers[s.urn()] = s
+                            sliver = slivers.get(sliver_urn)
+                        if sliver is None or sliver.slice() is not slices[slice_urn]:
+                            continue
+                        if state is None:
+                            slices[slice_urn].delete_sliver(sliver)
+                            del slivers[sliver_urn]
+                        else:
+                            sliver.__dict__.update(state)
+                    elif entry[0] == "resource":
+                        _, rid, state = entry
+                        resource = self._objects.get("r:" + rid)
+                        if resource is not None:
+                            resource.__dict__.update(state)
+                    elif entry[0] == "agg":
+                        _, container, resources = entry
+                        if len(resources) > 0:
+                            aggregate.containers[container] = resources
+                        else:
+                            aggregate.containers.pop(container, None)
+                count += 1
+        return count
+
+class StateWriter(object):
+    """
+        Writes the changes of the AM state to a StateJournal from a background thread, so that API calls only mark
+        what has changed. The changes marked during an interval are coalesced in one record: an object marked several
+        times is only written once, with its state at the time of the write.
+    """
+    def __init__(self, journal, interval=WRITE_INTERVAL):
+        self.journal = journal
+        self.interval = interval
+        self._lock = threading.Lock() #Protects the pending changes
+        self._write_lock = threading.Lock() #A single write at a time
+        self._pending = collections.OrderedDict() #key => function returning the journal entries of the object
+        self._dirty = threading.Event()
+        self.marks = 0
+        self.writes = 0
+        self.written = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        writer = threading.Thread(target=self._run)
+        writer.daemon = True
+        writer.start()
+
+    def mark(self, key, entries):
+        """
+            Schedule the write of an object that has changed
+
+            :param key: identifies the object, a later mark with the same key replaces this one
+            :param entries: function returning the journal entries of the object, called at write time
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = entries
+            self.marks += 1
+        self._dirty.set()
+
+    def _write(self):
+        with self._write_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = collections.OrderedDict()
+                self._dirty.clear()
+            if len(pending) == 0:
+                return
+            start = time.time()
+            try:
+                entries = list()
+                for fn in pending.values():
+                    entries.extend(fn())
+                self.journal.append(entries)
+            except Exception as e:
+                #Most likely a change during the pickling (RuntimeError): keep the changes for the next write
+                logging.getLogger('gcf.am3').warn("Failed to write the state journal, will retry: %s", e)
+                with self._lock:
+                    for key, fn in pending.items():
+                        self._pending.setdefault(key, fn)
+                    self._dirty.set()
+                return
+            latency = time.time() - start
+            self.writes += 1
+            self.written += len(pending)
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self._total_latency += latency
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            self._write()
+            time.sleep(self.interval)
+
+    #Write the pending changes and fsync them now (when the AM stops)
+    def flush(self):
+        self._write()
+        self.journal.sync()
+
+    def metrics(self):
+        with self._lock:
+            pending = len(self._pending)
+        return dict(marks=self.marks,
+                    writes=self.writes,
+                    written=self.written,
+                    coalesced=self.marks - self.written - pending,
+                    pending=pending,
+                    last_latency_ms=int(self.last_latency * 1000),
+                    max_latency_ms=int(self.max_latency * 1000),
+                    avg_latency_ms=int(self._total_latency * 1000 / self.writes) if self.writes > 0 else 0)
@@ -0,0 +1,100 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import itertools
+import logging
+import Queue
+import threading
+
+#Number of teardown tasks run at the same time
+TEARDOWN_WORKERS = 4
+#Maximum number of containers removed by one task (one call to a DockerManager)
+TEARDOWN_BATCH = 50
+#Attempts of a failed task before giving up
+TEARDOWN_RETRIES = 5
+#Seconds before the first retry of a failed task, doubled after each attempt
+TEARDOWN_RETRY_DELAY = 2
+
+#Containers are removed before images are released
+PRIORITY_CONTAINERS = 0
+PRIORITY_IMAGES = 1
+
+class _Task(object):
+    def __init__(self, name, run, done, priority):
+        self.name = name
+        self.run = run
+        self.done = done
+        self.priority = priority
+        self.attempts = 0
+
+class TeardownQueue(object):
+    """
+        Removes what deleted and expired slivers leave behind (containers, images, ...) in the background,
+        with a bounded number of workers so that a mass expiry doesn't overload the docker hosts.
+        A task is a function returning True or an error message; a failed task is retried later, with a growing delay.
+    """
+    def __init__(self, workers=TEARDOWN_WORKERS, retries=TEARDOWN_RETRIES, retry_delay=TEARDOWN_RETRY_DELAY):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = Queue.PriorityQueue()
+        self._sequence = itertools.count()
+        for _ in range(workers):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, name, run, done=None, priority=PRIORITY_CONTAINERS):
+        """
+            :param run: function doing the task, returns True or an error message
+            :param done: function called once the task has succeeded, or has failed too many times
+        """
+        self._put(_Task(name, run, done, priority))
+
+    def _put(self, task):
+        self._queue.put((task.priority, next(self._sequence), task))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            _, _, task = self._queue.get()
+            try:
+                out = task.run()
+            except Exception as e:
+                out = str(e)
+            task.attempts += 1
+            if out is not True:
+                if task.attempts < self.retries:
+                    delay = self.retry_delay * 2 ** (task.attempts - 1)
+                    logging.getLogger('gcf.am3').warn("Teardown of %s failed, retrying in %s seconds: %s", task.name, delay, out)
+                    retry = threading.Timer(delay, self._put, [task])
+                    retry.daemon = True
+                    retry.start()
+                    continue
+                logging.getLogger('gcf.am3').error("Teardown of %s failed %d times, giving up: %s", task.name, task.attempts, out)
+            if task.done is not None:
+                try:
+                    task.done()
+                except Exception as e:
+                    logging.getLogger('gcf.am3').error("Teardown of %s: %s", task.name, e)
@@ -46,12 +46,14 @@ sys.path.insert(1, '../geni-tools/src')
 
 import base64
 import collections
+import copy
 import datetime
 import os
 import traceback
 import xml.dom.minidom as minidom
 import zlib
 import ConfigParser
+import atexit
 import threading
 import time
 import gcf.geni.am.am3 as am3
@@ -63,6 +65,14 @@ from lxml import etree
 from gcf.geni.am.aggregate import Aggregate
 from dockermaster import DockerMaster
 from gcf_to_docker import DockerManager
+from pyropool import DockerManagerPool, DEFAULT_POOL_SIZE, callAsync
+from placement import Placement, DEFAULT_POLICY, PLACEMENT_NAMESPACE
+from expiration import ExpirationScheduler
+from allocation import AllocationIndex
+from provisioning import ProvisioningExecutor, PROVISION_WORKERS, SMALL_SLICE, PRIORITY_RESTART, PRIORITY_SMALL, PRIORITY_LARGE
+from serviceplan import compileServicePlan, runInstalls, runExecutes, EXECUTE
+from teardown import TeardownQueue, TEARDOWN_BATCH, PRIORITY_IMAGES
+from statejournal import StateJournal, StateWriter, WRITE_INTERVAL, sliceEntry, sliverEntry, resourceEntry, aggregateEntry
 from gcf.geni.util.urn_util import publicid_to_urn
 from gcf.geni.util import urn_util as urn
 
@@ -72,7 +82,6 @@ from gcf.gcf_version import GCF_VERSION
 from gcf.geni.auth.base_authorizer import *
 from gcf.geni.am.api_error_exception import ApiErrorException
 
-from shutil import copyfile
 
 # See sfa/trust/rights.py
 # These are names of operations
@@ -117,15 +126,28 @@ OPSTATE_GENI_READY = am3.OPSTATE_GENI_READY
 OPSTATE_GENI_READY_BUSY = am3.OPSTATE_GENI_READY_BUSY
 OPSTATE_GENI_FAILED = am3.OPSTATE_GENI_FAILED
 
-EXPIRE_LOCK = threading.Lock()
 DUMP_LOCK= threading.Lock()
-ALLOCATE_LOCK = threading.Lock()
+#Protects DockerAggregateManager.advert_cache
+ADVERT_LOCK = threading.Lock()
+#Protects DockerAggregateManager.slice_locks
+SLICE_LOCKS_LOCK = threading.Lock()
 
 RSPEC_V3_NAMESPACE_URI = "http://www.geni.net/resources/rspec/3"
 
 #increment CODE_VERSION whenever changing something that impacts the stored data
-STATE_CODE_VERSION = '1'
+STATE_CODE_VERSION = '4'
 STATE_FILENAME = 'am-state-v{}.dat'.format(STATE_CODE_VERSION)
+#Changes made since the last snapshot in STATE_FILENAME (see statejournal.py)
+JOURNAL_FILENAME = 'am-state-v{}.journal'.format(STATE_CODE_VERSION)
+#Seconds between two snapshots of the AM state (a snapshot is also written when the journal is too long)
+SNAPSHOT_INTERVAL = 600
+
+#Seconds between two refills of the warm pools of containers
+WARM_POOL_INTERVAL = 10
+#Seconds a docker host is waited for changes of its containers (see DockerManager.waitEvents())
+INVENTORY_WAIT = 30
+#Seconds before asking again a docker host that didn't answer
+INVENTORY_RETRY_DELAY = 10
 
 class DockerAggregateManager(am3.ReferenceAggregateManager):
     
@@ -149,9 +171,20 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         self.proxy_dockermaster = None
         self.terms_and_conditions_site_enabled = False
         self.disallow_users_if_terms_and_conditions_not_accepted = False
-        thread_sliver_daemon = threading.Thread(target=self.expireSliversDaemon)
-        thread_sliver_daemon.daemon=True
-        thread_sliver_daemon.start()
+        #Not part of the saved state: the placement policy can be changed by restarting the AM
+        config = ConfigParser.SafeConfigParser()
+        config.read(os.path.dirname(os.path.abspath(__file__))+"/docker_am_config")
+        policy = DEFAULT_POLICY
+        if config.has_option("general", "placement_policy") and len(config.get("general", "placement_policy")) > 0:
+            policy = config.get("general", "placement_policy")
+        self.placement = Placement(policy)
+        self.state_write_interval = WRITE_INTERVAL
+        if config.has_option("general", "state_write_interval") and len(config.get("general", "state_write_interval")) > 0:
+            self.state_write_interval = config.getfloat("general", "state_write_interval")
+        provision_workers = PROVISION_WORKERS
+        if config.has_option("general", "provision_workers") and len(config.get("general", "provision_workers")) > 0:
+            provision_workers = config.getint("general", "provision_workers")
+        self.provisioning = ProvisioningExecutor(provision_workers)
         try:
             self.logger.info("Restoring AM state from \"{}\"...".format(STATE_FILENAME))
             s=open(STATE_FILENAME, 'rb')
@@ -163,9 +196,11 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             self.terms_and_conditions_site_enabled = p.load()
             self.disallow_users_if_terms_and_conditions_not_accepted = p.load()
             s.close()
+            restored = True
         except Exception as e:
             self.logger.info(str(e))
             self.logger.info("Restoring AM state FAILED: Loading new instance...")
+            restored = False
             self._agg = Aggregate()
             config = ConfigParser.SafeConfigParser()
             config.read(os.path.dirname(os.path.abspath(__file__))+"/docker_am_config")
@@ -197,14 +232,22 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                     if config_fetch("dockermaster_pyro4_host") is None:
                         # No host specified, so a new object is created locally,
                         # which means docker runs on the local host instead of on a remote host
-                        dockermanager = DockerManager()
+                        image_cache_budget = config_fetch("image_cache_budget")
+                        if image_cache_budget is not None:
+                            image_cache_budget = int(image_cache_budget)
+                        artifact_cache_budget = config_fetch("artifact_cache_budget")
+                        if artifact_cache_budget is not None:
+                            artifact_cache_budget = int(artifact_cache_budget)
+                        dockermanager = DockerManager(image_cache_budget=image_cache_budget,
+                                                      artifact_cache_budget=artifact_cache_budget,
+                                                      artifact_cache_dir=config_fetch("artifact_cache_dir"))
                     else:
                         # Host specified, so also use a DockerManager object,
                         # but use PYRO to use one on a remote host instead of a local one.
                         # This means that this uses docker on a remote host
                         uri = "PYRO:dockermanager@" + config.get(r, "dockermaster_pyro4_host") + ":" + config.get(r, "dockermaster_pyro4_port")
-                        dockermanager = Pyro4.Proxy(uri)
-                        dockermanager._pyroHmacKey = config.get(r, "dockermaster_pyro4_password")
+                        dockermanager = DockerManagerPool(uri, config_fetch("dockermaster_pyro4_password"),
+                                                          int(config_fetch("dockermaster_pyro4_pool_size", DEFAULT_POOL_SIZE)))
 
                     if r.startswith("proxy"):
                         if self.proxy_dockermaster is not None:
@@ -226,14 +269,20 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                                                               dockermanager)
                         pass
                     else:
+                        warm_pool = dict()
+                        for w in config_fetch("warm_pool", "").split(","):
+                            if len(w.strip()) > 0:
+                                sliver_type, size = w.split(":")
+                                warm_pool[sliver_type.strip()] = int(size)
                         self._agg.add_resources([DockerMaster(int(config_fetch("max_containers", 20)),
                                                               config_fetch("node_ipv4_hostname"),
                                                               config_fetch("ipv6_prefix"),
                                                               int(config_fetch('starting_ipv4_port', '12000')),
-                                                              dockermanager)])
+                                                              dockermanager,
+                                                              warm_pool,
+                                                              int(config_fetch('warm_pool_min_free_memory', '512')))])
                         #Here you can add the example resource. (You have to delete STATE_FILENAME to reload resources)
                 #self._agg.add_resources([ResourceExample(str(uuid.uuid4()), "127.0.0.1")])
-            self.dumpState()
             if self.public_url is None:
                 self.public_url = self._url
                 self.logger.warn("Warning: no public_url in docker_am_config. Will use '%s' as URL", self.public_url)
@@ -242,6 +291,43 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                 self.logger.info("Enabling Terms and Conditions site")
                 self.custom_request_handler_class = SecureXMLRPCAndTermsAndConditionsSiteRequestHandler
 
+        self.journal = StateJournal(JOURNAL_FILENAME)
+        self.journal.register(self.journalResources())
+        if restored:
+            self.logger.info("Replayed %d records of \"%s\"", self.journal.replay(self._slices, self._agg), JOURNAL_FILENAME)
+            for dockermaster in self.dockerMasters():
+                dockermaster.rebuildPool()
+        #Start from a compact state: the journal is emptied
+        self.dumpState()
+        self.state_writer = StateWriter(self.journal, self.state_write_interval)
+        atexit.register(self.state_writer.flush)
+        self.allocation_index = AllocationIndex(self._agg.catalog())
+        #(inventory version, dict (available only, compressed) => advertisement RSpec)
+        self.advert_cache = (None, dict())
+        #slice urn => lock held by the Allocate calls of the slice
+        self.slice_locks = dict()
+        self.teardown = TeardownQueue()
+        for dockermaster in self.dockerMasters():
+            #Teardowns interrupted by the restart of the AM
+            stale = [c for c in dockermaster.containers if c.tearing_down]
+            for i in range(0, len(stale), TEARDOWN_BATCH):
+                self.submitRemoval(dockermaster, stale[i:i+TEARDOWN_BATCH])
+        self.expiration = ExpirationScheduler(self.expire_due_slivers)
+        for slyce in self._slices.values():
+            self.expiration.schedule(slyce.slivers())
+        thread_snapshot_daemon = threading.Thread(target=self.snapshotDaemon)
+        thread_snapshot_daemon.daemon=True
+        thread_snapshot_daemon.start()
+
+        thread_warm_pool_daemon = threading.Thread(target=self.warmPoolDaemon)
+        thread_warm_pool_daemon.daemon=True
+        thread_warm_pool_daemon.start()
+
+        for dockermaster in self.dockerMasters():
+            thread_inventory_daemon = threading.Thread(target=self.inventoryDaemon, args=[dockermaster])
+            thread_inventory_daemon.daemon=True
+            thread_inventory_daemon.start()
+
         self.logger.info("Running %s AM v%d code version %s", self._am_type, self._api_version, GCF_VERSION)
 
     # The list of credentials are options - some single cred
@@ -254,7 +340,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         then only report available resources. If geni_compressed
         option is specified, then compress the result.'''
         self.logger.info('ListResources(%r)' % (options))
-        self.expire_slivers()
 
         # Note this list of privileges is really the name of an operation
         # from the privilege_table in sfa/trust/rights.py
@@ -310,22 +395,36 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             msg += ' Use "Describe" instead.'
             return self.errorResult(am3.AM_API.BAD_ARGS, msg)
 
-        all_resources = self._agg.catalog(None)
-        show_only_available = 'geni_available' in options and options['geni_available']
-        adv_header = self.advert_header()
-        for resource in all_resources:
-            if show_only_available and not resource.available:
-                continue
-            adv_header.append(resource.genAdvertNode(self._urn_authority, self._my_urn))
-        result = etree.tostring(adv_header, pretty_print=True, xml_declaration=True, encoding='utf-8')
-        # Optionally compress the result
-        if 'geni_compressed' in options and options['geni_compressed']:
-            try:
-                result = base64.b64encode(zlib.compress(result))
-            except Exception as exc:
-                self.logger.error("Error compressing and encoding resource list: %s", traceback.format_exc())
-                raise Exception("Server error compressing resource list", exc)
-        return self.successResult(result)
+        show_only_available = bool('geni_available' in options and options['geni_available'])
+        compressed = bool('geni_compressed' in options and options['geni_compressed'])
+        return self.successResult(self.advertisement(show_only_available, compressed))
+
+    #The advertisement RSpec, generated once for each version of the inventory (see AllocationIndex.version())
+    def advertisement(self, show_only_available, compressed):
+        version = self.allocation_index.version()
+        with ADVERT_LOCK:
+            if self.advert_cache[0] != version:
+                self.advert_cache = (version, dict())
+            cache = self.advert_cache[1]
+            if (show_only_available, compressed) in cache:
+                return cache[(show_only_available, compressed)]
+            if (show_only_available, False) not in cache:
+                adv_header = self.advert_header()
+                for resource in self._agg.catalog(None):
+                    if show_only_available and not resource.available:
+                        continue
+                    adv_header.append(resource.genAdvertNode(self._urn_authority, self._my_urn))
+                cache[(show_only_available, False)] = etree.tostring(adv_header, pretty_print=True, xml_declaration=True, encoding='utf-8')
+            result = cache[(show_only_available, False)]
+            # Optionally compress the result
+            if compressed:
+                try:
+                    result = base64.b64encode(zlib.compress(result))
+                except Exception as exc:
+                    self.logger.error("Error compressing and encoding resource list: %s", traceback.format_exc())
+                    raise Exception("Server error compressing resource list", exc)
+                cache[(show_only_available, True)] = result
+            return result
 
     # The list of credentials are options - some single cred
     # must give the caller required permissions.
@@ -346,7 +445,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         """
 
         self.logger.info('Allocate(%r)' % (slice_urn))
-        self.expire_slivers()
         # Note this list of privileges is really the name of an operation
         # from the privilege_table in sfa/trust/rights.py
         # Credentials will specify a list of privileges, each of which
@@ -398,170 +496,175 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         if rspec_element.getAttribute("type") != "request":
             return self.errorResult(am3.AM_API.BAD_ARGS, 'Bad Args: rspec element has type "'+rspec_element.getAttribute("type")+'" instead of "request"')
 
-        ALLOCATE_LOCK.acquire()
-        available = self.resources(available=True)
-        available = sorted(available, key=lambda a: a.size(), reverse=True)
-                
-        # Note: We only care about nodes for this component manager.
-        #       nodes without component_manager_id or with a component_manager_id of another AM are ignored
-        local_nodes = list()
-        for node_elem in rspec_dom.documentElement.getElementsByTagName('node'):
-            if node_elem.getAttribute("component_manager_id") == self._my_urn:
-                local_nodes.append(node_elem)
-
-        # If there are no nodes in the RSpec that we should handle, the AM specification does not tell us what to do.
-        # In general, it is best to throw the SEARCH_FAILED error, because silently doing nothing is potentially too confusing.
-        if len(local_nodes)==0:
-            ALLOCATE_LOCK.release()
-            return self.errorResult(am3.AM_API.SEARCH_FAILED, "No requested resource can be allocated on this AM. "
-                                                              "Check your request (usually bad component_manager_id)")
-
-        resources = list()
-        images_to_delete = list()
-
-        def abort_resource_allocation():
-            for r in resources:
-                r.deallocate()
-            ALLOCATE_LOCK.release()
-
-        proxy_resource = None
-        if self.proxy_dockermaster is not None:
-            proxy_resource = self.proxy_dockermaster.matchResource()
-            if proxy_resource is None:
-                abort_resource_allocation()
-                return self.errorResult(am3.AM_API.TOO_BIG, 'Too Big: insufficient resources to fulfill request (not enough resources to create proxy)')
-            proxy_resource.is_proxy = True
-            proxy_resource.external_id = None
-            proxy_resource.available = False
-            proxy_resource.chosen_sliver_type='docker-container'
-            proxy_resource.image = None
-            resources.append(proxy_resource)
-
-        for node_elem in local_nodes:
-            client_id = node_elem.getAttribute('client_id')
-            if client_id == "" or client_id is None:
-                abort_resource_allocation()
-                return self.errorResult(am3.AM_API.BAD_ARGS, "A node does not have a client_id")
-            if len(node_elem.getElementsByTagName('sliver_type')) < 1:
-                abort_resource_allocation()
-                return self.errorResult(am3.AM_API.BAD_ARGS,
-                                        "The node '{}' does not have a sliver_type".format(client_id))
-            sliver_type = node_elem.getElementsByTagName('sliver_type')[0]
-            image = None
-            if sliver_type != "":
-                if len(sliver_type.getElementsByTagName("disk_image")) == 1:
-                    image = sliver_type.getElementsByTagName("disk_image")[0].getAttribute("name")
-                    images_to_delete.append(image)
-                sliver_type = sliver_type.getAttribute('name')
-                # notE: basestring handles both str and unicode
-            if sliver_type is None \
-                    or not isinstance(sliver_type, basestring) \
-                    or sliver_type == "":
-                self.logger.info('Bad sliver_type="%s" (%r) (type=%s)', sliver_type, sliver_type, type(sliver_type))
-                abort_resource_allocation()
-                return self.errorResult(am3.AM_API.BAD_ARGS,
-                                        "The node '{}' does not have a valid sliver_type".format(client_id))
-            self.logger.info('Checking node with sliver_type="%s"', sliver_type)
-            component_id = node_elem.getAttribute('component_id')
-            if component_id == "": component_id=None
-            exclusive = node_elem.getAttribute('exclusive') # type : string
-            if exclusive == "": exclusive=None
-            if exclusive is not None:
-                exclusive = exclusive.lower() in ['true', '1', 't', 'y', 'yes']
-            resource = None # type: ExtendedResource
-            for r in available:
-                resource = r.matchResource(sliver_type, component_id, exclusive)
-                if resource is None:
-                    # Search next available resource
-                        continue
-                else:
-                    #resource found
-                    if component_id is not None and (resource.id != component_id):
-                        abort_resource_allocation()
-                        return self.errorResult(5, #5 = SERVERERROR
-                                                "Server ERROR: {} != {}".format(resource.id, component_id))
-                    try:
-                        #Resource returned by a resource pool are not listed in "available" list,
-                        # so ignore Exception
-                        available.remove(resource)
-                    except:
-                        pass
-                    break
-            if resource is None: # There aren't enough resources
-                self.logger.error('Too big: not enought %s available',sliver_type)
-                abort_resource_allocation()
-                return self.errorResult(am3.AM_API.TOO_BIG, 'Too Big: insufficient resources to fulfill request')
-            resource.external_id = client_id
-            resource.available = False
-            resource.chosen_sliver_type=sliver_type
-            resource.image=image
-            resource.proxy_resource = proxy_resource
-            resources.append(resource)
-
-        ALLOCATE_LOCK.release()
-
-        # determine the start time as bounded by slice expiration and 'now'
-        now = datetime.datetime.utcnow()
-        start_time = now
-        if 'geni_start_time' in options:
-            # # Need to parse this into datetime
-            # start_time_raw = options['geni_start_time']
-            # start_time = self._naiveUTC(dateutil.parser.parse(start_time_raw))
-            return self.errorResult(am3.AM_API.BAD_ARGS, 
-                                    "geni_start_time is not supported")
-
-        # determine max expiration time from credentials
-        # do not create a sliver that will outlive the slice!
-        expiration = self.min_expire(creds, self.max_alloc,
-                                     ('geni_end_time' in options
-                                      and options['geni_end_time']))
-
-        # determine end time as min of the slice
-        # and the requested time (if any)
-        end_time = self.min_expire(creds, None,
-                                   ('geni_end_time' in options
-                                    and options['geni_end_time']))
-
-        # if slice exists, check accept only if no  existing sliver overlaps
-        # with requested start/end time. If slice doesn't exist, create it
-        if slice_urn in self._slices:
-            newslice = self._slices[slice_urn]
-            # Check if any current slivers overlap with requested start/end
-            one_slice_overlaps = False
-            for sliver in newslice.slivers():
-                if sliver.startTime() < end_time and \
-                            sliver.endTime() > start_time:
-                        one_slice_overlaps = True
+        #Only the Allocate calls of the same slice wait for each other
+        slice_lock = self.acquireSliceLock(slice_urn)
+        try:
+            self.placement.refresh(self.allocation_index.dockermasters)
+            placement = self.placement.newRequest([s.resource() for s in self._slices[slice_urn].slivers()]
+                                                  if slice_urn in self._slices else [])
+
+            # Note: We only care about nodes for this component manager.
+            #       nodes without component_manager_id or with a component_manager_id of another AM are ignored
+            local_nodes = list()
+            for node_elem in rspec_dom.documentElement.getElementsByTagName('node'):
+                if node_elem.getAttribute("component_manager_id") == self._my_urn:
+                    local_nodes.append(node_elem)
+
+            # If there are no nodes in the RSpec that we should handle, the AM specification does not tell us what to do.
+            # In general, it is best to throw the SEARCH_FAILED error, because silently doing nothing is potentially too confusing.
+            if len(local_nodes)==0:
+                return self.errorResult(am3.AM_API.SEARCH_FAILED, "No requested resource can be allocated on this AM. "
+                                                                  "Check your request (usually bad component_manager_id)")
+
+            resources = list()
+            images_to_delete = list()
+            #The claimed resources, given back if the allocation fails
+            reservation = self.allocation_index.newReservation()
+
+            def abort_resource_allocation():
+                reservation.rollback()
+
+            proxy_resource = None
+            if self.proxy_dockermaster is not None:
+                proxy_resource = self.proxy_dockermaster.matchResource()
+                if proxy_resource is None:
+                    abort_resource_allocation()
+                    return self.errorResult(am3.AM_API.TOO_BIG, 'Too Big: insufficient resources to fulfill request (not enough resources to create proxy)')
+                reservation.add(proxy_resource)
+                proxy_resource.is_proxy = True
+                proxy_resource.external_id = None
+                proxy_resource.available = False
+                proxy_resource.chosen_sliver_type='docker-container'
+                proxy_resource.image = None
+                resources.append(proxy_resource)
+
+            for node_elem in local_nodes:
+                client_id = node_elem.getAttribute('client_id')
+                if client_id == "" or client_id is None:
+                    abort_resource_allocation()
+                    return self.errorResult(am3.AM_API.BAD_ARGS, "A node does not have a client_id")
+                if len(node_elem.getElementsByTagName('sliver_type')) < 1:
+                    abort_resource_allocation()
+                    return self.errorResult(am3.AM_API.BAD_ARGS,
+                                            "The node '{}' does not have a sliver_type".format(client_id))
+                sliver_type = node_elem.getElementsByTagName('sliver_type')[0]
+                image = None
+                if sliver_type != "":
+                    if len(sliver_type.getElementsByTagName("disk_image")) == 1:
+                        image = sliver_type.getElementsByTagName("disk_image")[0].getAttribute("name")
+                        images_to_delete.append(image)
+                    sliver_type = sliver_type.getAttribute('name')
+                    # notE: basestring handles both str and unicode
+                if sliver_type is None \
+                        or not isinstance(sliver_type, basestring) \
+                        or sliver_type == "":
+                    self.logger.info('Bad sliver_type="%s" (%r) (type=%s)', sliver_type, sliver_type, type(sliver_type))
+                    abort_resource_allocation()
+                    return self.errorResult(am3.AM_API.BAD_ARGS,
+                                            "The node '{}' does not have a valid sliver_type".format(client_id))
+                self.logger.info('Checking node with sliver_type="%s"', sliver_type)
+                component_id = node_elem.getAttribute('component_id')
+                if component_id == "": component_id=None
+                exclusive = node_elem.getAttribute('exclusive') # type : string
+                if exclusive == "": exclusive=None
+                if exclusive is not None:
+                    exclusive = exclusive.lower() in ['true', '1', 't', 'y', 'yes']
+                affinity = node_elem.getAttributeNS(PLACEMENT_NAMESPACE, 'affinity') or None
+                anti_affinity = node_elem.getAttributeNS(PLACEMENT_NAMESPACE, 'anti_affinity') or None
+                resource = None # type: ExtendedResource
+                for r in placement.candidates(self.allocation_index.candidates(sliver_type, component_id),
+                                              affinity, anti_affinity):
+                    resource = reservation.claim(r, sliver_type, component_id, exclusive)
+                    if resource is None:
+                        # Search next available resource
+                            continue
+                    else:
+                        #resource found
+                        if component_id is not None and (resource.id != component_id):
+                            abort_resource_allocation()
+                            return self.errorResult(5, #5 = SERVERERROR
+                                                    "Server ERROR: {} != {}".format(resource.id, component_id))
                         break
-
-            if one_slice_overlaps:
-                ALLOCATE_LOCK.acquire()
+                if resource is None: # There aren't enough resources
+                    self.logger.error('Too big: not enought %s available',sliver_type)
+                    abort_resource_allocation()
+                    if affinity is not None or anti_affinity is not None:
+                        return self.errorResult(am3.AM_API.TOO_BIG, "Too Big: insufficient resources to fulfill request "
+                                                "with the affinity of node '{}'".format(client_id))
+                    return self.errorResult(am3.AM_API.TOO_BIG, 'Too Big: insufficient resources to fulfill request')
+                resource.affinity = affinity
+                resource.anti_affinity = anti_affinity
+                placement.record(resource)
+                resource.external_id = client_id
+                resource.available = False
+                resource.chosen_sliver_type=sliver_type
+                resource.image=image
+                resource.proxy_resource = proxy_resource
+                resources.append(resource)
+
+            # determine the start time as bounded by slice expiration and 'now'
+            now = datetime.datetime.utcnow()
+            start_time = now
+            if 'geni_start_time' in options:
+                # # Need to parse this into datetime
+                # start_time_raw = options['geni_start_time']
+                # start_time = self._naiveUTC(dateutil.parser.parse(start_time_raw))
+                abort_resource_allocation()
+                return self.errorResult(am3.AM_API.BAD_ARGS, 
+                                        "geni_start_time is not supported")
+
+            # determine max expiration time from credentials
+            # do not create a sliver that will outlive the slice!
+            expiration = self.min_expire(creds, self.max_alloc,
+                                         ('geni_end_time' in options
+                                          and options['geni_end_time']))
+
+            # determine end time as min of the slice
+            # and the requested time (if any)
+            end_time = self.min_expire(creds, None,
+                                       ('geni_end_time' in options
+                                        and options['geni_end_time']))
+
+            # if slice exists, check accept only if no  existing sliver overlaps
+            # with requested start/end time. If slice doesn't exist, create it
+            if slice_urn in self._slices:
+                newslice = self._slices[slice_urn]
+                # Check if any current slivers overlap with requested start/end
+                one_slice_overlaps = False
                 for sliver in newslice.slivers():
-                    sliver.resource().deallocate()
-                ALLOCATE_LOCK.release()
-                # template = "Slice %s already has slivers at requested time"
-                template = "Slice %s already has slivers"
-                self.logger.error(template % (slice_urn))
-                return self.errorResult(am3.AM_API.ALREADY_EXISTS,
-                                        template % (slice_urn))
-        else:
-            newslice = Slice(slice_urn)
-            
-        for resource in resources:
-            sliver = newslice.add_resource(resource)
-            if resource.image is not None:
-                resource.image = slice_urn+"::"+resource.image
-            sliver.setExpiration(expiration)
-            sliver.setStartTime(start_time)
-            sliver.setEndTime(end_time)
-            sliver.setAllocationState(STATE_GENI_ALLOCATED)
-        for i in images_to_delete:
-            if i.startswith("http://") or i.startswith("https://") and i not in newslice.images_to_delete:
-                newslice.images_to_delete.append(i)
-        self._agg.allocate(slice_urn, newslice.resources())
-        self._agg.allocate(user_urn, newslice.resources())
-        newslice.request_rspec = rspec
-        self._slices[slice_urn] = newslice
+                    if sliver.startTime() < end_time and \
+                                sliver.endTime() > start_time:
+                            one_slice_overlaps = True
+                            break
+
+                if one_slice_overlaps:
+                    abort_resource_allocation()
+                    # template = "Slice %s already has slivers at requested time"
+                    template = "Slice %s already has slivers"
+                    self.logger.error(template % (slice_urn))
+                    return self.errorResult(am3.AM_API.ALREADY_EXISTS,
+                                            template % (slice_urn))
+            else:
+                newslice = Slice(slice_urn)
+
+            for resource in resources:
+                sliver = newslice.add_resource(resource)
+                if resource.image is not None:
+                    resource.image = slice_urn+"::"+resource.image
+                sliver.setExpiration(expiration)
+                sliver.setStartTime(start_time)
+                sliver.setEndTime(end_time)
+                sliver.setAllocationState(STATE_GENI_ALLOCATED)
+            for i in images_to_delete:
+                if i not in newslice.images_to_delete:
+                    newslice.images_to_delete.append(i)
+            self._agg.allocate(slice_urn, resources)
+            self._agg.allocate(user_urn, resources)
+            newslice.request_rspec = rspec
+            newslice.service_plan = compileServicePlan(local_nodes)
+            self._slices[slice_urn] = newslice
+        finally:
+            slice_lock.release()
 
         # Log the allocation
         self.logger.info("Allocated new slice %s" % slice_urn)
@@ -569,80 +672,243 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             self.logger.info("Allocated resource %s to slice %s as sliver %s",
                              sliver.resource().id, slice_urn, sliver.urn())
 
+        #The custom images are prepared while the user gets ready to call Provision
+        self.prepareImages(newslice, [s for s in newslice.slivers() if s.resource() in resources])
         manifest = self.manifest_rspec(slice_urn)
-        self.dumpState()
+        self.saveSlice(slice_urn, containers=[user_urn])
+        self.expiration.schedule(newslice.slivers())
         result = dict(geni_rspec=manifest,
                       geni_slivers=[s.status() for s in newslice.slivers()])
         return self.successResult(result)
 
-    def provision_install_execute_sliver(self, the_slice, sliver):
-        def getXmlNode(client_id, manifest=the_slice.request_rspec):
-            assert the_slice is not None
-            assert manifest is not None
-            for node in etree.parse(StringIO(manifest)).getroot().getchildren():
-                if node.get("client_id")==client_id:
-                    return node
-            return None
-
-        def getServiceInstall(etreeNode):
-            ns="{"+etreeNode.nsmap.get(None)+"}"
-            services =  etreeNode.find(ns+"services")
-            if services is None:
-                return []
+    #Start the builds of the custom images of the slivers on their docker host, without waiting for them
+    #Provision then only waits for what is left of the builds (see DockerMaster.provisionContainers())
+    #The builds are started by a provisioning job of each docker host (see provisioning.py)
+    def prepareImages(self, the_slice, slivers):
+        def prepare(job, dockermaster, slivers):
+            job.setPhase("preparing images")
+            images = collections.OrderedDict() #image => slivers
+            for sliver in slivers:
+                images.setdefault(sliver.resource().image, list()).append(sliver)
+            for image, group in images.items():
+                try:
+                    dockermaster.dockermanager.prepareImage(image)
+                except Exception as e:
+                    self.logger.error("Failed to start the preparation of image %s: %s", image, e)
+                    for sliver in group:
+                        sliver.resource().error = "Failed to start the preparation of image %s: %s" % (image.split("::")[1], e)
+                    self.saveSlivers(group)
+        for dockermaster, group in self.slivers_by_dockermaster(slivers):
+            group = [sliver for sliver in group if getattr(sliver.resource(), 'image', None) is not None]
+            if dockermaster is None or len(group) == 0:
+                continue
+            self.provisioning.submit(dockermaster.host, the_slice.urn, [sliver.urn() for sliver in group],
+                                     lambda job, dockermaster=dockermaster, group=group: prepare(job, dockermaster, group),
+                                     self.provisioningPriority(the_slice))
+
+    #The state of the image preparation of the allocated slivers with a custom image
+    #Returns a dict sliver urn => dict(image_state, image_progress)
+    def imageStatuses(self, slivers):
+        statuses = dict() #(DockerManager id, image) => status of the build
+        ret = dict()
+        for sliver in slivers:
+            resource = sliver.resource()
+            dockermanager = getattr(resource, 'DockerManager', None)
+            if sliver.allocationState() != STATE_GENI_ALLOCATED or resource.image is None or dockermanager is None:
+                continue
+            key = (id(dockermanager), resource.image)
+            if key not in statuses:
+                try:
+                    statuses[key] = dockermanager.imageStatus(resource.image)
+                except Exception as e:
+                    self.logger.error("Failed to get the status of image %s: %s", resource.image, e)
+                    statuses[key] = None
+            status = statuses[key]
+            if status is None:
+                continue
+            if status["state"] in ["failed", "cancelled"]:
+                progress = status["error"] or ""
             else:
-                ret = list()
-                for install in services.findall(ns+'install'):
-                    ret.append([install.get('url'), install.get('install_path')])
-                return ret
-
-        def getServiceExecute(etreeNode):
-            ns="{"+etreeNode.nsmap.get(None)+"}"
-            services =  etreeNode.find(ns+"services")
-            if services is None:
-                return []
+                progress = status["progress"][-1] if len(status["progress"]) > 0 else ""
+            ret[sliver.urn()] = dict(image_state=status["state"], image_progress=progress)
+        return ret
+
+    #Group the slivers by DockerMaster, to use its bulk methods
+    #Returns a list of (DockerMaster, slivers), the DockerMaster is None for the other resources
+    def slivers_by_dockermaster(self, slivers):
+        groups = dict()
+        for sliver in slivers:
+            dockermaster = getattr(sliver.resource(), 'dockermaster', None)
+            groups.setdefault(id(dockermaster), (dockermaster, list()))[1].append(sliver)
+        return groups.values()
+
+    #slivers_keys : list of (sliver, user_keys_dict)
+    #The DockerMasters are called in parallel
+    def preprovision_slivers(self, slivers_keys):
+        keys = dict([(sliver.urn(), user_keys_dict) for sliver, user_keys_dict in slivers_keys])
+        futures = list()
+        for dockermaster, slivers in self.slivers_by_dockermaster([sliver for sliver, _ in slivers_keys]):
+            if dockermaster is None:
+                for sliver in slivers:
+                    sliver.resource().preprovision(keys[sliver.urn()])
             else:
-                ret = list()
-                for install in services.findall(ns+'execute'):
-                    ret.append([install.get('shell'), install.get('command')])
-                return ret
-
-        if sliver.resource().provision() is not True:
+                futures.append(callAsync(dockermaster, "preprovisionContainers",
+                                         [(sliver.resource(), keys[sliver.urn()]) for sliver in slivers]))
+        for future in futures:
+            future.value #Raises the exception of the call, if any
+
+    #The host whose provisioning workers handle the sliver (see provisioning.py), None if it isn't a docker container
+    def provisioningHost(self, sliver):
+        dockermaster = getattr(sliver.resource(), 'dockermaster', None)
+        return dockermaster.host if dockermaster is not None else None
+
+    #The priority of the provisioning jobs of a slice: small slices first
+    def provisioningPriority(self, the_slice):
+        return PRIORITY_SMALL if len(the_slice.slivers()) <= SMALL_SLICE else PRIORITY_LARGE
+
+    #Queue the install and execute services of a sliver (and its start, unless provisioned is given)
+    def submitProvisioning(self, the_slice, sliver, provisioned=None, priority=None):
+        if priority is None:
+            priority = self.provisioningPriority(the_slice)
+        self.provisioning.submit(self.provisioningHost(sliver), the_slice.urn, [sliver.urn()],
+                                 lambda job: self.provision_install_execute_sliver(the_slice, sliver, provisioned, job),
+                                 priority)
+
+    #Start the slivers with one job for each DockerMaster, then install and execute the services of each sliver
+    def provision_slivers(self, the_slice, slivers):
+        priority = self.provisioningPriority(the_slice)
+        def provision_group(job, dockermaster, slivers):
+            job.setPhase("starting")
+            try:
+                results = dockermaster.provisionContainers([sliver.resource() for sliver in slivers])
+            except Exception as e:
+                self.logger.error("Provision failed: %s", e)
+                results = [False for _ in slivers]
+                for sliver in slivers:
+                    sliver.resource().error = str(e)
+            for sliver, provisioned in zip(slivers, results):
+                self.submitProvisioning(the_slice, sliver, provisioned, priority)
+        for dockermaster, group in self.slivers_by_dockermaster(slivers):
+            if dockermaster is None:
+                for sliver in group:
+                    self.submitProvisioning(the_slice, sliver, priority=priority)
+            else:
+                self.provisioning.submit(dockermaster.host, the_slice.urn, [sliver.urn() for sliver in group],
+                                         lambda job, dockermaster=dockermaster, group=group:
+                                             provision_group(job, dockermaster, group),
+                                         priority)
+
+    #Delete slivers right away, and remove their containers in the background (see teardown.py)
+    #The containers are removed in batches, and go back to the pool of their DockerMaster once removed
+    #containers : the containers of the aggregate to which the resources were allocated, besides their slice
+    def teardown_slivers(self, slivers, containers=()):
+        for dockermaster, group in self.slivers_by_dockermaster(slivers):
+            resources = [sliver.resource() for sliver in group]
+            if dockermaster is None:
+                for resource in resources:
+                    def deprovision(resource=resource):
+                        resource.deprovision()
+                        return True
+                    self.teardown.submit(resource.id, deprovision)
+                continue
+            for resource in resources:
+                resource.tearing_down = True
+            for i in range(0, len(resources), TEARDOWN_BATCH):
+                self.submitRemoval(dockermaster, resources[i:i+TEARDOWN_BATCH])
+        slices = collections.OrderedDict()
+        for sliver in slivers:
+            slices.setdefault(sliver.slice().urn, (sliver.slice(), list()))[1].append(sliver)
+        for slyce, group in slices.values():
+            resources = [sliver.resource() for sliver in group]
+            for container in [slyce.urn] + list(containers):
+                self._agg.deallocate(container, resources)
+            self.allocation_index.changed()
+            for sliver in group:
+                slyce.delete_sliver(sliver)
+            self.saveSlivers(group, deleted=True)
+            # If slice is now empty, delete it.
+            if len(slyce.slivers()) == 0 and self._slices.get(slyce.urn) is slyce:
+                self.logger.debug("Deleting empty slice %r", slyce.urn)
+                del self._slices[slyce.urn]
+                self.forgetSliceLock(slyce.urn)
+                self.teardown.submit("images of "+slyce.urn, lambda slyce=slyce: self.releaseImages(slyce),
+                                     priority=PRIORITY_IMAGES)
+            self.saveSlice(slyce.urn, containers)
+
+    #Queue the removal of the docker containers of containers being torn down
+    def submitRemoval(self, dockermaster, containers):
+        names, ports = dockermaster.removalSpec(containers)
+        def remove():
+            out = dockermaster.removeContainers(names, list(ports))
+            del ports[:] #Released by the first attempt, they may be reserved again before a retry
+            return out
+        def done():
+            for container in containers:
+                container.tearing_down = False
+                container.onDeprovisioned()
+                dockermaster.onResetChild(container)
+                self.saveResource(container)
+        self.teardown.submit("containers of "+dockermaster.host, remove, done)
+
+    #Suspend job until the SSH server of the sliver answers, then call then(job, ready) on a provisioning worker
+    #The readiness watcher only queues the job again, no worker waits for the SSH server (see readiness.py)
+    def whenSshReady(self, job, sliver, then):
+        job.suspend("waiting for ssh")
+        sliver.resource().watchSshConnection(lambda ready: self.provisioning.resume(job, lambda job: then(job, ready)))
+
+    #provisioned : result of the provision of the resource if it has already been done (see provision_slivers())
+    #job : the ProvisioningJob running this, whose phase is updated
+    def provision_install_execute_sliver(self, the_slice, sliver, provisioned, job):
+        if provisioned is None:
+            job.setPhase("starting")
+            provisioned = sliver.resource().provision()
+        if provisioned is not True:
             sliver.setOperationalState(OPSTATE_GENI_FAILED)
             sliver.resource().deprovision()
+            self.saveSlivers([sliver])
             return
-        if sliver.resource().waitForSshConnection() is not True:
+        self.whenSshReady(job, sliver, lambda job, ready: self.install_execute_sliver(the_slice, sliver, ready, job))
+
+    #Second part of provision_install_execute_sliver(), once the SSH server of the sliver answers (or not: ready is False)
+    def install_execute_sliver(self, the_slice, sliver, ready, job):
+        if not ready:
             sliver.setOperationalState(OPSTATE_GENI_FAILED)
             sliver.resource().deprovision()
+            self.saveSlivers([sliver])
             return
         sliver.setOperationalState(OPSTATE_GENI_READY_BUSY)
-        self.dumpState()
+        self.saveSlivers([sliver])
         client_id = sliver.resource().external_id
         if client_id is not None:
             assert client_id is not None
             assert isinstance(client_id, basestring)
-            node_xml = getXmlNode(client_id)
-            assert node_xml is not None
-            # assert isinstance(node_xml, etree.Node)
-            for i in getServiceInstall(node_xml):
-                ret = sliver.resource().installCommand(i[0], i[1])
+            steps = the_slice.service_plan.get(client_id)
+            assert steps is not None
+            job.setPhase("installing")
+            #The installs run at the same time (see serviceplan.py), installed() is called for one of them at a time
+            def installed(step, ret):
                 if ret is not True:
                     sliver.setOperationalState(OPSTATE_GENI_FAILED)
                     sliver.resource().error = ret
-                else:
+                elif sliver.operationalState() != OPSTATE_GENI_FAILED:
                     sliver.resource().error = ""
-                self.dumpState()
-            sliver.setOperationalState(OPSTATE_GENI_READY)
-            for i in getServiceExecute(node_xml):
-                sliver.resource().executeCommand(i[0], i[1])
+                self.saveSlivers([sliver])
+            if runInstalls(steps, sliver.resource(), installed) is True:
+                sliver.setOperationalState(OPSTATE_GENI_READY)
+            #The executes are only started: they don't hold the provisioning worker
+            job.setPhase("executing")
+            ret = runExecutes(steps, sliver.resource())
+            if ret is not True:
+                self.logger.warn("Execute services of %s: %s", sliver.urn(), ret)
         else:
             sliver.setOperationalState(OPSTATE_GENI_READY)
+        self.saveSlivers([sliver])
 
     def Provision(self, urns, credentials, options):
         """Allocate slivers to the given slice according to the given RSpec.
         Return an RSpec of the actually allocated resources.
         """
         self.logger.info('Provision(%r)' % (urns))
-        self.expire_slivers()
 
         the_slice, slivers = self.decode_urns(urns)
         # Note this list of privileges is really the name of an operation
@@ -715,26 +981,27 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                     user_keys_dict[urn.URN(urn=user['urn']).getName()] = user['keys']
 
         if user_keys_dict:
+            to_provision = list()
             for sliver in slivers:
                 if sliver.operationalState() == OPSTATE_GENI_CONFIGURING:
                     continue
                 sliver.setOperationalState(OPSTATE_GENI_CONFIGURING)
-                #pre-provision should be fast, so we don't do it on a seperate thread
                 if sliver.resource().is_proxy:
                     allkeys = []
                     for userurn, keylist in user_keys_dict.items():
                         allkeys.extend(keylist)
                     new_user_keys_dict = { FIXED_PROXY_USER : allkeys }
-                    sliver.resource().preprovision(new_user_keys_dict)
+                    to_provision.append((sliver, new_user_keys_dict))
                 else:
-                    sliver.resource().preprovision(user_keys_dict)
-
-                #provision might be slow, so we do it on a seperate thread
-                threading.Thread(target=self.provision_install_execute_sliver,
-                                 args=[the_slice, sliver]).start()
+                    to_provision.append((sliver, user_keys_dict))
+            #pre-provision should be fast, so we don't do it on a seperate thread
+            self.preprovision_slivers(to_provision)
+            #provision might be slow, so it is queued (see provisioning.py)
+            self.provision_slivers(the_slice, [sliver for sliver, _ in to_provision])
         else:
             return self.errorResult(am3.AM_API.BAD_ARGS, "No user (with SSH key) provided")
-        self.dumpState()
+        self.saveSlivers(slivers)
+        self.expiration.schedule(slivers)
         result = dict(geni_rspec=self.manifest_rspec(the_slice.urn, provision=True),
                       geni_slivers=[s.status() for s in slivers])
         return self.successResult(result)
@@ -777,7 +1044,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         urns.
         """
         self.logger.info('PerformOperationalAction(%r)' % (urns))
-        self.expire_slivers()
 
         the_slice, slivers = self.decode_urns(urns)
         # Note this list of privileges is really the name of an operation
@@ -833,18 +1099,24 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             raise ApiErrorException(am3.AM_API.UNSUPPORTED,
                                     "\n".join(errors.values()))
 
-        def thread_restart(sliver):
+        def thread_restart(job, sliver):
+            job.setPhase("restarting")
             ret = sliver.resource().restart()
             if not ret:
                 sliver.setOperationalState(OPSTATE_GENI_FAILED)
+                self.saveSlivers([sliver])
                 return
             #now wait until container is up again
-            if sliver.resource().waitForSshConnection() is not True:
+            self.whenSshReady(job, sliver, lambda job, ready: restarted(sliver, ready))
+
+        def restarted(sliver, ready):
+            if not ready:
                 sliver.setOperationalState(OPSTATE_GENI_FAILED)
                 sliver.resource().deprovision()
+                self.saveSlivers([sliver])
                 return
             sliver.setOperationalState(OPSTATE_GENI_READY)
-            self.dumpState()
+            self.saveSlivers([sliver])
 
         # Perform the state changes:
         for sliver in slivers:
@@ -856,13 +1128,13 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                 if (sliver.allocationState() in astates
                     and sliver.operationalState() in ostates):
                     sliver.setOperationalState(OPSTATE_GENI_CONFIGURING)
-                    threading.Thread(target=self.provision_install_execute_sliver,
-                                     args=[the_slice, sliver]).start()
+                    self.submitProvisioning(the_slice, sliver)
             elif (action == 'geni_restart'):
                 if (sliver.allocationState() in astates
                     and sliver.operationalState() in ostates):
                     sliver.setOperationalState(OPSTATE_GENI_CONFIGURING)
-                    threading.Thread(target=thread_restart, args=[sliver]).start()
+                    self.provisioning.submit(self.provisioningHost(sliver), the_slice.urn, [sliver.urn()],
+                                             lambda job, sliver=sliver: thread_restart(job, sliver), PRIORITY_RESTART)
             elif (action == 'geni_stop'):
                 if (sliver.allocationState() in astates
                     and sliver.operationalState() in ostates):
@@ -873,6 +1145,8 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                         #ignore errors when deprovisioning
                         pass
                     sliver.setOperationalState(OPSTATE_GENI_NOT_READY)
+                    #Stopped on purpose, not a failure noticed by inventoryDaemon()
+                    sliver.resource().error = ""
             elif (action == 'geni_update_users'):
                 user_keys_dict = dict()
                 if 'geni_users' in options:
@@ -898,7 +1172,7 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                 # This should have been caught above
                 msg = "Unsupported: action %s is not supported" % (action)
                 raise ApiErrorException(am3.AM_API.UNSUPPORTED, msg)
-        self.dumpState()
+        self.saveSlivers(slivers)
         return self.successResult([s.status(errors[s.urn()])
                                    for s in slivers])
 
@@ -906,7 +1180,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         """Generate a manifest RSpec for the given resources.
         """
         self.logger.info('Describe(%r)' % (urns))
-        self.expire_slivers()
         # APIv3 spec says that a slice with nothing local should
         # give an empty manifest, not an error
         try:
@@ -969,7 +1242,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
     def Delete(self, urns, credentials, options):
         """Stop and completely delete the named slivers and/or slice."""
         self.logger.info('Delete(%r)' % (urns))
-        self.expire_slivers()
 
         the_slice, slivers = self.decode_urns(urns)
         privileges = (DELETESLIVERPRIV,)
@@ -987,32 +1259,9 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             return self.errorResult(am3.AM_API.UNAVAILABLE,
                                     ("Unavailable: Slice %s is unavailable."
                                      % (the_slice.urn)))
-        resources = [sliver.resource() for sliver in slivers]
-        self._agg.deallocate(the_slice.urn, resources)
-        self._agg.deallocate(user_urn, resources)
-
-        delete_ev = threading.Event()
-
-        def thread_delete(slivers):
-            for sliver in slivers:
-                slyce = sliver.slice()
-                slyce.delete_sliver(sliver)
-            delete_ev.set()
-            # If slice is now empty, delete it.
-            if not slyce.slivers():
-                try:
-                    for i in self._slices[slyce.urn].images_to_delete:
-                        self.DockerManager.deleteImage(slyce.urn+"::"+i)
-                except:
-                    pass
-                self.logger.debug("Deleting empty slice %r", slyce.urn)
-                del self._slices[slyce.urn]
-            self.dumpState()
-
-        threading.Thread(target=thread_delete, args=[slivers]).start()
-
-        #Wait, unless it takes too long (0.5 seconds)
-        delete_ev.wait(timeout=0.5)
+        self.expiration.cancel(slivers)
+        #The slivers are deleted now, their containers are removed in the background
+        self.teardown_slivers(slivers, [user_urn])
 
         return self.successResult([s.status() for s in slivers])
 
@@ -1024,7 +1273,6 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
 
         # Loop over the resources in a sliver gathering status.
         self.logger.info('Status(%r)' % (urns))
-        self.expire_slivers()
         the_slice, slivers = self.decode_urns(urns)
         privileges = (SLIVERSTATUSPRIV,)
         self.getVerifiedCredentials(the_slice.urn, credentials, options, privileges)
@@ -1043,8 +1291,18 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
                                      geni_allocation_status=allocation_state,
                                      geni_operational_status=operational_state,
                                      geni_error=''))
+        #Slivers waiting for or being provisioned: their phase, and their position in the queue of their host
+        provisioning = self.provisioning.status([s.urn() for s in slivers])
+        #Allocated slivers: the preparation of their image
+        images = self.imageStatuses(slivers)
+        statuses = list()
+        for s in slivers:
+            status = s.status(s.resource().error)
+            for k, v in provisioning.get(s.urn(), {}).items() + images.get(s.urn(), {}).items():
+                status["docker_am_"+k] = v
+            statuses.append(status)
         result = dict(geni_urn=the_slice.urn,
-                      geni_slivers=[s.status(s.resource().error) for s in slivers])
+                      geni_slivers=statuses)
         return self.successResult(result)
 
     def Renew(self, urns, credentials, expiration_time, options):
@@ -1054,7 +1312,12 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         Return False on any error, True on success.'''
 
         out = super(DockerAggregateManager,self).Renew(urns, credentials, expiration_time, options)
-        self.dumpState()
+        try:
+            slivers = self.decode_urns(urns)[1]
+            self.saveSlivers(slivers)
+            self.expiration.schedule(slivers)
+        except ApiErrorException:
+            pass #Unknown slice or sliver: nothing has been renewed
         return out
 
     # See https://www.protogeni.net/trac/protogeni/wiki/RspecAdOpState
@@ -1090,42 +1353,27 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         return adv_header
 
     def manifest_rspec(self, slice_urn, provision=False):
-        rspec = etree.parse(StringIO(self._slices[slice_urn].request_rspec))
-        rspec.getroot().set("type", "manifest")
-        ns=rspec.getroot().nsmap.get(None)
-        
-        services = rspec.getroot().xpath("x:node/x:services", namespaces={'x':ns})
-        i_exec = 0
-        for s in services:
-            executes= s.xpath("x:execute", namespaces={'x':ns})
-            if len(executes) > 0:
-                for e in executes:
-                    tmp = etree.Element("{http://www.fed4fire.eu/docker_am}execute_logs")
-                    tmp.set("log","/tmp/startup-"+str(i_exec)+".txt")
-                    tmp.set("status","/tmp/startup-"+str(i_exec)+".status")
-                    tmp.set("command","/tmp/startup-"+str(i_exec)+".sh")
-                    # e.getparent().remove(e)
-                    s.append(tmp)
-                    i_exec+=1
-        for node in rspec.getroot().getchildren():
-            for s in self._slices[slice_urn].slivers():
-                if node.get("client_id") == s.resource().external_id and node.get("component_manager_id") == self._my_urn:
-                    node.set("component_id", s.resource().urn(self._urn_authority))
-                    node.set("sliver_id", s.urn())
-                    if provision:
-                        services = None
-                        for c in node.getchildren():
-                            if c.tag == "{"+ns+"}"+"services":
-                                services = c
-                                break
-                        if services is None:
-                            services = etree.Element("services")
-                        services.extend(s.resource().manifestAuth())
-                        s.resource().addManifestProxyServiceElements(services)
-                        node.append(services)
-        return etree.tostring(rspec, pretty_print=True, xml_declaration=True, encoding='utf-8')
-            
-        
+        return self._slices[slice_urn].manifest(self._my_urn, self._urn_authority, provision)
+
+
+    #Acquire the lock of the Allocate calls of a slice, and return it
+    def acquireSliceLock(self, slice_urn):
+        while True:
+            with SLICE_LOCKS_LOCK:
+                lock = self.slice_locks.setdefault(slice_urn, threading.Lock())
+            lock.acquire()
+            with SLICE_LOCKS_LOCK:
+                if self.slice_locks.get(slice_urn) is lock:
+                    return lock
+            lock.release() #Forgotten meanwhile (see forgetSliceLock())
+
+    #Forget the lock of a deleted slice, unless an Allocate call holds it
+    def forgetSliceLock(self, slice_urn):
+        with SLICE_LOCKS_LOCK:
+            lock = self.slice_locks.get(slice_urn)
+            if lock is not None and lock.acquire(False):
+                del self.slice_locks[slice_urn]
+                lock.release()
 
     def resources(self, available=None):
         """Get the list of managed resources. If available is not None,
@@ -1138,45 +1386,33 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
         return result
 
     def expire_slivers(self):
-        """Look for expired slivers and clean them up. Ultimately this
-        should be run by a daemon, but until then, it is called at the
-        beginning of all methods.
+        """Expired slivers are cleaned up by the expiration scheduler as soon
+        as they expire (see expire_due_slivers()), so the calls of the am3
+        methods have nothing to scan.
+        """
+        pass
+
+    def expire_due_slivers(self, slivers):
+        """Clean up expired slivers. Called by the expiration scheduler
+        as soon as slivers reach their expiration time.
         """
-        if EXPIRE_LOCK.locked():
-            return None
-        EXPIRE_LOCK.acquire()
         expired = list()
-        now = datetime.datetime.utcnow()
-        for slyce in self._slices.values():
-            for sliver in slyce.slivers():
-                self.logger.debug('Checking sliver %s (expiration = %r) at %r',
-                                  sliver.urn(), sliver.expiration(), now)
-                if sliver.expiration() < now:
-                    self.logger.debug('Expring sliver %s (expiration = %r) at %r',
-                                      sliver.urn(), sliver.expiration(), now)
-                    expired.append(sliver)
-        dump=False
+        for sliver in slivers:
+            slyce = sliver.slice()
+            #Skip the slivers deleted meanwhile
+            if self._slices.get(slyce.urn) is slyce and sliver.urn() in [s.urn() for s in slyce.slivers()]:
+                self.logger.debug('Expring sliver %s (expiration = %r)', sliver.urn(), sliver.expiration())
+                expired.append(sliver)
         if len(expired)>0:
             self.logger.info('Expiring %d slivers', len(expired))
-            dump=True
-        for sliver in expired:
-            slyce = sliver.slice()
-            slyce.delete_sliver(sliver)
-            # If slice is now empty, delete it.
-            if len(slyce.slivers()) == 0:
-                self.logger.debug("Deleting empty slice %r", slyce.urn)
-                try:
-                    for i in self._slices[slyce.urn].images_to_delete:
-                        self.DockerManager.deleteImage(slyce.urn+"::"+i)
-                except:
-                    pass
-                del self._slices[slyce.urn]
-        if dump: #If something has changed, save data
-            self.dumpState()
-        EXPIRE_LOCK.release()
+            self.teardown_slivers(expired)
         
             
+    #Write a snapshot of the whole state and empty the journal
     def dumpState(self):
+        self.journal.snapshot(self.writeSnapshot)
+
+    def writeSnapshot(self):
         DUMP_LOCK.acquire()
         try:
             TMP_STATE_FILENAME = STATE_FILENAME+".tmp"
@@ -1189,20 +1425,277 @@ class DockerAggregateManager(am3.ReferenceAggregateManager):
             p.dump(self.public_url)
             p.dump(self.terms_and_conditions_site_enabled)
             p.dump(self.disallow_users_if_terms_and_conditions_not_accepted)
+            s.flush()
+            os.fsync(s.fileno())
             s.close()
-            copyfile(TMP_STATE_FILENAME, STATE_FILENAME)
+            os.rename(TMP_STATE_FILENAME, STATE_FILENAME)
+            return True
         except RuntimeError:
-            print 'error in DumpState'
-            pass
-        DUMP_LOCK.release()
+            #The state changed during the dump: the journal is kept, the next snapshot will be retried
+            self.logger.warn("The state changed during its snapshot, it will be retried")
+            return False
+        finally:
+            DUMP_LOCK.release()
+
+    #The save* methods only mark what has changed: the state writer journals it in the background (see statejournal.py)
+
+    #A new, changed or deleted slice: its slivers, their resources and the allocations of the aggregate
+    #containers : the other containers of the aggregate that have changed (the user of the slice for example)
+    def saveSlice(self, slice_urn, containers=()):
+        def entries():
+            slyce = self._slices.get(slice_urn)
+            return [sliceEntry(slice_urn, slyce)]
+        self.state_writer.mark(("slice", slice_urn), entries)
+        if slice_urn in self._slices:
+            for resource in self._slices[slice_urn].resources():
+                self.saveResource(resource)
+        for container in [slice_urn] + list(containers):
+            self.state_writer.mark(("agg", container),
+                                   lambda container=container: [aggregateEntry(container, self._agg.catalog(container))])
+
+    #The state of slivers and of their resources
+    #deleted : the slivers have been deleted from their slice
+    def saveSlivers(self, slivers, deleted=False):
+        for sliver in slivers:
+            if deleted:
+                entry = sliverEntry(sliver, deleted=True)
+                #Not the key of the updates: a late update of the sliver must not replace its deletion
+                self.state_writer.mark(("deleted", sliver.urn()), lambda entry=entry: [entry])
+            else:
+                self.state_writer.mark(("sliver", sliver.urn()), lambda sliver=sliver: [sliverEntry(sliver)])
+            self.saveResource(sliver.resource())
+
+    #A resource, and the warm pool of its DockerMaster (the resource may have claimed a warm container)
+    def saveResource(self, resource):
+        self.state_writer.mark(("resource", resource.id), lambda: [resourceEntry(resource)])
+        dockermaster = getattr(resource, 'dockermaster', None)
+        if dockermaster is not None:
+            self.saveWarmPool(dockermaster)
+
+    def saveWarmPool(self, dockermaster):
+        self.state_writer.mark(("warm", dockermaster.id), lambda: [resourceEntry(dockermaster, ['warm'])])
+
+    #The resources referenced by the journal records: the DockerMasters, their containers and the other resources
+    def journalResources(self):
+        resources = list(self._agg.catalog())
+        for dockermaster in self.dockerMasters():
+            if dockermaster not in resources:
+                resources.append(dockermaster)
+            resources.extend(dockermaster.containers)
+        return resources
+
+    def snapshotDaemon(self):
+        while True:
+            self.journal.waitFull(SNAPSHOT_INTERVAL)
+            if self.journal.records > 0:
+                try:
+                    self.dumpState()
+                except Exception as e:
+                    #The journal is kept, the next snapshot will be retried
+                    self.logger.error("Failed to write a snapshot of the state: %s", e)
+                    continue
+                self.logger.info("State writer: %s", self.state_writer.metrics())
 
-    def expireSliversDaemon(self):
+    #All the DockerMasters of the AM, including the proxy one
+    def dockerMasters(self):
+        dockermasters = [r for r in self._agg.catalog() if isinstance(r, DockerMaster)]
+        if self.proxy_dockermaster is not None:
+            dockermasters.append(self.proxy_dockermaster)
+        return dockermasters
+
+    #Release the images of a deleted slice on all the docker hosts (they stay cached until evicted)
+    #Returns True, or the errors
+    def releaseImages(self, slyce):
+        errors = list()
+        for dockermaster in self.dockerMasters():
+            for i in slyce.images_to_delete:
+                try:
+                    dockermaster.dockermanager.deleteImage(slyce.urn+"::"+i)
+                except Exception as e:
+                    errors.append("Failed to release image %s on %s: %s" % (i, dockermaster.host, e))
+        if len(errors) > 0:
+            return "\n".join(errors)
+        return True
+
+    #Keep the warm pools of the DockerMasters filled
+    def warmPoolDaemon(self):
         while True:
-            time.sleep(300)
-            self.expire_slivers()
-    
+            for dockermaster in self.dockerMasters():
+                try:
+                    if dockermaster.refillWarmPool():
+                        self.saveWarmPool(dockermaster)
+                except Exception as e:
+                    self.logger.error("Failed to refill the warm pool: %s", e)
+            time.sleep(WARM_POOL_INTERVAL)
+
+    #Follow the changes of the containers of a DockerMaster, pushed by the inventory of its docker host (see inventory.py)
+    def inventoryDaemon(self, dockermaster):
+        epoch, seq = None, 0
+        while True:
+            try:
+                out = dockermaster.dockermanager.waitEvents(seq, INVENTORY_WAIT, epoch)
+            except Exception as e:
+                self.logger.warn("Failed to get the container changes of %s: %s", dockermaster.host, e)
+                epoch, seq = None, 0
+                time.sleep(INVENTORY_RETRY_DELAY)
+                continue
+            epoch, seq = out["epoch"], out["seq"]
+            if not out["synced"]:
+                continue
+            try:
+                self.onContainerChanges(dockermaster, out["changes"], out["full"])
+            except Exception as e:
+                self.logger.error("Failed to apply the container changes of %s: %s", dockermaster.host, e)
+
+    def onContainerChanges(self, dockermaster, changes, full):
+        """
+            Update the operational state of the ready slivers whose container has stopped: geni_failed if it was killed
+            for lack of memory, exited with an error or disappeared, geni_notready if it exited normally or is paused.
+            The slivers being provisioned, restarted or stopped by the AM are left to the operation in progress.
+
+            :param changes: the inventory entries of the containers that have changed
+            :param full: changes has all the containers of the host, the other ones don't exist anymore
+        """
+        entries = dict([(e["name"], e) for e in changes])
+        containers = [c for c in dockermaster.containers if (full or c.id in entries) and not c.tearing_down]
+        if len(containers) == 0:
+            return
+        slivers = dict()
+        for slyce in self._slices.values():
+            for sliver in slyce.slivers():
+                slivers[sliver.resource().id] = sliver
+        candidates = list()
+        for container in containers:
+            sliver = slivers.get(container.id)
+            entry = entries.get(container.id)
+            if sliver is None or (entry is not None and entry["running"] and entry["state"] != "paused"):
+                continue
+            if sliver.allocationState() != STATE_GENI_PROVISIONED:
+                continue
+            if sliver.operationalState() in [OPSTATE_GENI_READY, OPSTATE_GENI_READY_BUSY]:
+                candidates.append((sliver, entry))
+        busy = self.provisioning.status([sliver.urn() for sliver, _ in candidates])
+        changed = list()
+        for sliver, entry in candidates:
+            if sliver.urn() in busy:
+                continue
+            if entry is None or entry["state"] == "removed":
+                state, error = OPSTATE_GENI_FAILED, "The container has been removed"
+            elif entry["oom_killed"]:
+                state, error = OPSTATE_GENI_FAILED, "The container was killed: out of memory (exit code %d)" % entry["exit_code"]
+            elif entry["state"] == "paused":
+                state, error = OPSTATE_GENI_NOT_READY, "The container is paused"
+            elif entry["exit_code"] == 0:
+                state, error = OPSTATE_GENI_NOT_READY, "The container has stopped"
+            else:
+                state, error = OPSTATE_GENI_FAILED, "The container has stopped (exit code %d)" % entry["exit_code"]
+            self.logger.info("Sliver %s is now %s: %s", sliver.urn(), state, error)
+            sliver.setOperationalState(state)
+            sliver.resource().error = error
+            changed.append(sliver)
+        self.saveSlivers(changed)
+
 class Slice(am3.Slice):
     def __init__(self, urn):
         super(Slice,self).__init__(urn)
         self.request_rspec = None
+        self.service_plan = dict() #client_id => install and execute steps of the node (see serviceplan.py)
         self.images_to_delete = list()
+        self._resetCaches()
+
+    #The caches are not saved with the slice (dumpState() and the state journal)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_request_cache', '_slivers_cache', '_manifest_cache'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._resetCaches()
+
+    def _resetCaches(self):
+        self._request_cache = None #(request_rspec, parsed tree)
+        self._slivers_cache = None #client_id => sliver
+        self._manifest_cache = dict() #provision => (fingerprint, manifest)
+
+    def add_resource(self, resource):
+        sliver = super(Slice, self).add_resource(resource)
+        self._slivers_cache = None
+        return sliver
+
+    def delete_sliver(self, sliver):
+        super(Slice, self).delete_sliver(sliver)
+        self._slivers_cache = None
+
+    def _request(self):
+        """
+            The request RSpec parsed once (and again only when request_rspec is replaced), with the execute_logs
+            elements of the execute steps of the service plan already added
+        """
+        cache = self._request_cache
+        if cache is not None and cache[0] is self.request_rspec:
+            return cache
+        rspec = etree.parse(StringIO(self.request_rspec))
+        rspec.getroot().set("type", "manifest")
+        ns=rspec.getroot().nsmap.get(None)
+
+        for node in rspec.getroot().getchildren():
+            steps = self.service_plan.get(node.get("client_id"), [])
+            services = node.find("{"+ns+"}services")
+            if services is None:
+                continue
+            for step in steps:
+                if step.kind == EXECUTE:
+                    tmp = etree.Element("{http://www.fed4fire.eu/docker_am}execute_logs")
+                    tmp.set("log","/tmp/startup-"+str(step.index)+".txt")
+                    tmp.set("status","/tmp/startup-"+str(step.index)+".status")
+                    tmp.set("command","/tmp/startup-"+str(step.index)+".sh")
+                    services.append(tmp)
+        cache = (self.request_rspec, rspec)
+        self._request_cache = cache
+        return cache
+
+    def sliverByClientId(self, client_id):
+        slivers = self._slivers_cache
+        if slivers is None:
+            slivers = dict()
+            for s in self.slivers():
+                slivers.setdefault(s.resource().external_id, s)
+            self._slivers_cache = slivers
+        return slivers.get(client_id)
+
+    def manifest(self, my_urn, urn_authority, provision=False):
+        """
+            The manifest RSpec of the slice. It is only generated again when the request, the slivers or the
+            login information of their resources (see ExtendedResource.manifestFingerprint()) have changed.
+        """
+        request, rspec = self._request()
+        slivers = self.slivers()
+        fingerprint = (request, tuple(sorted([(s.urn(), s.resource().id, s.resource().external_id) +
+                                              (s.resource().manifestFingerprint() if provision else ())
+                                              for s in slivers])))
+        cached = self._manifest_cache.get(provision)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        rspec = copy.deepcopy(rspec)
+        ns=rspec.getroot().nsmap.get(None)
+        for node in rspec.getroot().getchildren():
+            s = self.sliverByClientId(node.get("client_id"))
+            if s is not None and node.get("component_manager_id") == my_urn:
+                node.set("component_id", s.resource().urn(urn_authority))
+                node.set("sliver_id", s.urn())
+                if provision:
+                    services = None
+                    for c in node.getchildren():
+                        if c.tag == "{"+ns+"}"+"services":
+                            services = c
+                            break
+                    if services is None:
+                        services = etree.Element("services")
+                    services.extend(s.resource().manifestAuth())
+                    s.resource().addManifestProxyServiceElements(services)
+                    node.append(services)
+        manifest = etree.tostring(rspec, pretty_print=True, xml_declaration=True, encoding='utf-8')
+        self._manifest_cache[provision] = (fingerprint, manifest)
+        return manifest
@@ -0,0 +1,96 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    from allocation import AllocationIndex
+    from dockermaster import DockerMaster
+    from extendedresource import ExtendedResource
+except ImportError as e: #gcf, Pyro4 and lxml are needed by the resources
+    AllocationIndex = None
+    missing = str(e)
+
+class FakeDockerManager(object):
+    """
+        The DockerManager calls made when a DockerMaster is created
+    """
+    def checkDocker(self):
+        pass
+
+    def randomMacAddress(self):
+        return "02:42:ac:11:00:01"
+
+@unittest.skipIf(AllocationIndex is None, "missing dependency")
+class ReservationTest(unittest.TestCase):
+    def setUp(self):
+        self.dockermaster = DockerMaster(3, host="h1", dockermanager=FakeDockerManager())
+        self.node = ExtendedResource("node1", ["raw-pc"])
+        self.index = AllocationIndex([self.node, self.dockermaster])
+
+    def test_candidates(self):
+        self.assertEqual(self.index.candidates("docker-container"), [self.dockermaster])
+        self.assertEqual(self.index.candidates("raw-pc"), [self.node])
+        container = self.dockermaster.containers[1]
+        self.assertEqual(self.index.candidates("docker-container", container.id), [self.dockermaster])
+        self.assertEqual(self.index.candidates("docker-container", "unknown"), [])
+
+    def test_claimed_resources_are_taken(self):
+        reservation = self.index.newReservation()
+        containers = [reservation.claim(self.dockermaster, "docker-container") for _ in range(3)]
+        self.assertEqual(len(set([c.id for c in containers])), 3)
+        self.assertIsNone(reservation.claim(self.dockermaster, "docker-container"))
+        self.assertIs(reservation.claim(self.node, "raw-pc"), self.node)
+        self.assertFalse(self.node.available)
+        self.assertIsNone(self.index.newReservation().claim(self.node, "raw-pc"))
+
+    def test_claim_by_component_id(self):
+        container = self.dockermaster.containers[2]
+        reservation = self.index.newReservation()
+        self.assertIs(reservation.claim(self.dockermaster, "docker-container", container.id), container)
+        self.assertIsNone(reservation.claim(self.dockermaster, "docker-container", container.id))
+        self.assertNotEqual(reservation.claim(self.dockermaster, "docker-container").id, container.id)
+
+    def test_rollback_gives_everything_back(self):
+        version = self.index.version()
+        reservation = self.index.newReservation()
+        reservation.claim(self.dockermaster, "docker-container")
+        reservation.claim(self.dockermaster, "docker-container", self.dockermaster.containers[2].id)
+        reservation.claim(self.node, "raw-pc")
+        self.assertEqual(self.dockermaster.size(), 1)
+        reservation.rollback()
+        self.assertEqual(reservation.resources, [])
+        self.assertEqual(self.dockermaster.size(), 3)
+        self.assertTrue(self.node.available)
+        self.assertNotEqual(self.index.version(), version)
+        #The resources can be claimed again, each container once
+        again = self.index.newReservation()
+        self.assertEqual(len(set([again.claim(self.dockermaster, "docker-container").id for _ in range(3)])), 3)
+        self.assertIsNone(again.claim(self.dockermaster, "docker-container"))
+        self.assertIs(again.claim(self.node, "raw-pc"), self.node)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from artifactcache import ArtifactCache, INDEX_FILE
+
+class Server(BaseHTTPServer.HTTPServer):
+    """
+        Serves the files of a dict path => content, with an ETag if etag is set
+    """
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.files = dict()
+        self.etag = None
+        self.downloads = list() #paths of the GET requests
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def headers_only(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return None
+        self.send_response(200)
+        if self.server.etag is not None:
+            self.send_header("ETag", self.server.etag)
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        return content
+
+    def do_HEAD(self):
+        self.headers_only()
+
+    def do_GET(self):
+        self.server.downloads.append(self.path)
+        content = self.headers_only()
+        if content is not None:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.server.etag = '"1"'
+        self.server.files["/a.tar.gz"] = "a" * 100
+        self.server.files["/b.tar.gz"] = "b" * 100
+        self.directory = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self.directory, "artifacts"), 1000, 5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def read(self, path, owner):
+        f = self.cache.open(self.server.url(path), owner)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def files(self):
+        return sorted([f for f in os.listdir(self.cache.directory) if f != INDEX_FILE])
+
+    def test_downloaded_once(self):
+        self.assertEqual(self.read("/a.tar.gz", "sliver1"), "a" * 100)
+        self.assertEqual(self.read("/a.tar.gz", "sliver2"), "a" * 100)
+        self.assertEqual(self.server.downloads, ["/a.tar.gz"])
+        self.assertEqual(len(self.files()), 1)
+
+    def test_downloaded_again_when_the_validators_change(self):
+        self.read("/a.tar.gz", "sliver1")
+        self.server.etag = '"2"'
+        self.server.files["/a.tar.gz"] = "A" * 100
+        self.assertEqual(self.read("/a.tar.gz", "sliver2"), "A" * 100)
+        self.assertEqual(self.server.downloads, ["/a.tar.gz", "/a.tar.gz"])
+        #The old copy is still owned by sliver1
+        self.assertEqual(len(self.files()), 2)
+
+    def test_eviction_respects_the_owners(self):
+        self.cache.setBudget(150)
+        self.read("/a.tar.gz", "sliver1")
+        self.read("/b.tar.gz", "sliver2")
+        #Over the budget, but both files are in use
+        self.assertEqual(len(self.files()), 2)
+        self.cache.release("sliver1")
+        self.server.files["/c.tar.gz"] = "c" * 10
+        self.read("/c.tar.gz", "sliver3")
+        #a, no longer used, is evicted; b is kept for sliver2
+        self.assertEqual(len(self.files()), 2)
+        self.read("/b.tar.gz", "sliver4")
+        self.assertEqual(self.server.downloads, ["/a.tar.gz", "/b.tar.gz", "/c.tar.gz"])
+        self.read("/a.tar.gz", "sliver5")
+        self.assertEqual(self.server.downloads[-1], "/a.tar.gz")
+
+    def test_without_validators(self):
+        self.server.etag = None
+        self.assertEqual(self.read("/a.tar.gz", "sliver1"), "a" * 100)
+        self.assertEqual(self.read("/a.tar.gz", "sliver2"), "a" * 100)
+        #Downloaded for each install, and deleted once read
+        self.assertEqual(self.server.downloads, ["/a.tar.gz", "/a.tar.gz"])
+        self.assertEqual(self.files(), [])
+
+    def test_failed_download_leaves_no_file(self):
+        self.server.etag = None
+        self.assertRaises(IOError, self.cache.open, self.server.url("/missing.tar.gz"), "sliver1")
+        self.assertEqual(self.files(), [])
+        self.server.etag = '"1"'
+        self.read("/a.tar.gz", "sliver1")
+        self.assertRaises(IOError, self.cache.open, self.server.url("/missing.tar.gz"), "sliver1")
+        self.assertEqual(len(self.files()), 1)
+
+    def test_index_survives_restart(self):
+        self.read("/a.tar.gz", "sliver1")
+        self.cache = ArtifactCache(self.cache.directory, 1000, 5)
+        self.assertEqual(self.read("/a.tar.gz", "sliver2"), "a" * 100)
+        self.assertEqual(self.server.downloads, ["/a.tar.gz"])
+
+if __name__ == '__main__':
+    unittest.main()
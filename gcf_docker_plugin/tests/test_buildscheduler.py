@@ -0,0 +1,99 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from buildscheduler import BuildScheduler
+
+class BuildSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = BuildScheduler(max_concurrent=2, timeout=10)
+        self.release = threading.Event()
+        self.calls = list()
+
+    #A build waiting for self.release, or for its cancellation
+    def target(self, build):
+        self.calls.append(build.key)
+        while not self.release.wait(0.05):
+            build.check()
+        build.result = "gcf_" + build.key
+        return True
+
+    def test_builds_of_the_same_key_are_shared(self):
+        first = self.scheduler.submit("img", "s1::img", self.target)
+        second = self.scheduler.submit("img", "s2::img", self.target)
+        self.assertIs(first, second)
+        self.assertEqual(first.owners, set(["s1::img", "s2::img"]))
+        self.release.set()
+        self.assertTrue(first.wait(5))
+        self.assertEqual(first.status()["state"], "ready")
+        self.assertEqual(first.status()["name"], "gcf_img")
+        self.assertEqual(self.calls, ["img"])
+        self.assertIs(self.scheduler.get("img"), first)
+
+    def test_finished_build_is_started_again(self):
+        self.release.set()
+        first = self.scheduler.submit("img", None, self.target)
+        self.assertTrue(first.wait(5))
+        second = self.scheduler.submit("img", None, self.target)
+        self.assertIsNot(first, second)
+        self.assertTrue(second.wait(5))
+        self.assertEqual(self.calls, ["img", "img"])
+
+    def test_build_is_cancelled_when_its_last_owner_leaves(self):
+        build = self.scheduler.submit("img", "s1::img", self.target)
+        self.scheduler.submit("img", "s2::img", self.target)
+        self.scheduler.cancelOwner("s1::img")
+        self.assertFalse(build.wait(0.3))
+        self.scheduler.cancelOwner("s2::img")
+        self.assertTrue(build.wait(5))
+        self.assertEqual(build.status()["state"], "cancelled")
+
+    def test_failed_build_keeps_its_error(self):
+        build = self.scheduler.submit("img", None, lambda build: "Error : no Dockerfile")
+        self.assertTrue(build.wait(5))
+        self.assertEqual(build.status()["state"], "failed")
+        self.assertEqual(build.status()["error"], "Error : no Dockerfile")
+
+    def test_exception_fails_the_build(self):
+        def target(build):
+            raise IOError("disk full")
+        build = self.scheduler.submit("img", None, target)
+        self.assertTrue(build.wait(5))
+        self.assertEqual(build.status()["state"], "failed")
+        self.assertIn("disk full", build.status()["error"])
+
+    def test_builds_beyond_the_limit_are_queued(self):
+        builds = [self.scheduler.submit("img%d" % i, None, self.target) for i in range(3)]
+        self.assertFalse(builds[2].wait(0.3))
+        self.assertEqual(sorted([b.status()["state"] for b in builds]), ["building", "building", "queued"])
+        self.release.set()
+        for build in builds:
+            self.assertTrue(build.wait(5))
+
+if __name__ == "__main__":
+    unittest.main()
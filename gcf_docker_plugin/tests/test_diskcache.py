@@ -0,0 +1,129 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import diskcache
+from diskcache import BudgetedCache
+
+class BudgetedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "index.json")
+        self.removed = list()
+        self.refused = set() #keys that remove() fails to delete
+        self.cache = self.newCache(100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def newCache(self, budget):
+        return BudgetedCache(self.state_file, budget, self.remove)
+
+    def remove(self, key, value):
+        if key in self.refused:
+            return False
+        self.removed.append(key)
+        return True
+
+    def saved(self):
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", "file-a", 10, "slice1")
+        self.assertEqual(self.cache.get("a", "slice2"), "file-a")
+        self.assertEqual(self.cache.keyOf("slice2"), "a")
+        self.assertIsNone(self.cache.keyOf("slice3"))
+        self.assertEqual(self.cache.usage(), 10)
+        self.cache.discard("a")
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_eviction_least_recently_used_first(self):
+        for key in ("a", "b", "c"):
+            self.cache.put(key, "file-" + key, 40)
+        self.cache.get("a")
+        self.cache.evict()
+        #b is the least recently used
+        self.assertEqual(self.removed, ["b"])
+        self.assertEqual(self.cache.usage(), 80)
+
+    def test_eviction_respects_the_owners(self):
+        self.cache.put("a", "file-a", 60, "slice1")
+        self.cache.put("b", "file-b", 60, "slice2")
+        self.cache.evict()
+        self.assertEqual(self.removed, [])
+        self.cache.release("slice2")
+        self.cache.evict()
+        self.assertEqual(self.removed, ["b"])
+        self.assertEqual(self.cache.get("a"), "file-a")
+
+    def test_entry_kept_when_remove_fails(self):
+        self.cache.put("a", "file-a", 60)
+        self.cache.put("b", "file-b", 60)
+        self.refused.add("a")
+        self.cache.evict()
+        self.assertEqual(self.removed, ["b"])
+        self.assertEqual(self.cache.get("a"), "file-a")
+
+    def test_index_persistence(self):
+        self.cache.put("a", "file-a", 10, "slice1")
+        #Entries added and new owners are saved at once
+        self.assertEqual(self.saved()["a"]["owners"], ["slice1"])
+        self.cache.get("a", "slice2")
+        self.assertEqual(self.saved()["a"]["owners"], ["slice1", "slice2"])
+        #Released owners wait for the next save
+        self.cache.release("slice1")
+        self.assertEqual(self.saved()["a"]["owners"], ["slice1", "slice2"])
+        self.cache.flush()
+        self.assertEqual(self.saved()["a"]["owners"], ["slice2"])
+        cache = self.newCache(100)
+        self.assertEqual(cache.get("a"), "file-a")
+        self.assertEqual(cache.keyOf("slice2"), "a")
+
+    def test_deferred_save_after_interval(self):
+        self.cache.put("a", "file-a", 10, "slice1")
+        self.cache.release("slice1")
+        self.assertEqual(self.saved()["a"]["owners"], ["slice1"])
+        interval = diskcache.SAVE_INTERVAL
+        diskcache.SAVE_INTERVAL = 0
+        try:
+            self.cache.get("a")
+        finally:
+            diskcache.SAVE_INTERVAL = interval
+        self.assertEqual(self.saved()["a"]["owners"], [])
+
+    def test_corrupt_index(self):
+        with open(self.state_file, "w") as f:
+            f.write("{")
+        self.assertEqual(self.newCache(100).entries, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dockerapi import DockerClient, DockerAPIError
+try:
+    import gcf_to_docker
+except ImportError as e: #Pyro4 is needed by the DockerManager
+    gcf_to_docker = None
+    missing = str(e)
+
+class FakeDocker(object):
+    """
+        A docker daemon on a unix socket, answering each request with handler(method, path, headers, body)
+        which returns (status, headers, body, close): body is a string, or a list of chunks sent with the
+        chunked transfer encoding; close closes the connection after the reply (without telling the client)
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.connections = 0
+        self.requests = list() #(method, path, headers, body)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "docker.sock")
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(5)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._serve, args=[conn])
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        f = conn.makefile("rb")
+        try:
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                method, path, _ = line.split(" ", 2)
+                headers = dict()
+                for line in iter(f.readline, "\r\n"):
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = ""
+                if headers.get("transfer-encoding") == "chunked":
+                    while True:
+                        size = int(f.readline().split(";")[0], 16)
+                        data = f.read(size)
+                        f.read(2)
+                        if size == 0:
+                            break
+                        body += data
+                elif "content-length" in headers:
+                    body = f.read(int(headers["content-length"]))
+                self.requests.append((method, path, headers, body))
+                status, reply_headers, reply, close = self.handler(method, path, headers, body)
+                out = "HTTP/1.1 %d X\r\n" % status
+                for name, value in reply_headers.items():
+                    out += "%s: %s\r\n" % (name, value)
+                if isinstance(reply, list):
+                    out += "Transfer-Encoding: chunked\r\n\r\n"
+                    for chunk in reply:
+                        out += "%x\r\n%s\r\n" % (len(chunk), chunk)
+                    out += "0\r\n\r\n"
+                else:
+                    out += "Content-Length: %d\r\n\r\n%s" % (len(reply), reply)
+                conn.sendall(out)
+                if close:
+                    return
+        finally:
+            f.close()
+            conn.close()
+
+def jsonReply(obj, status=200, close=False):
+    return (status, {"Content-Type": "application/json"}, json.dumps(obj), close)
+
+class DockerClientTest(unittest.TestCase):
+    def start(self, handler):
+        self.daemon = FakeDocker(handler)
+        self.addCleanup(self.daemon.close)
+        return DockerClient(self.daemon.path, timeout=5)
+
+    def test_keep_alive_connection_is_reused(self):
+        client = self.start(lambda method, path, headers, body: jsonReply({"path": path}))
+        self.assertEqual(client.get("/containers/json"), {"path": "/v1.24/containers/json"})
+        self.assertEqual(client.get("/info"), {"path": "/v1.24/info"})
+        self.assertEqual(self.daemon.connections, 1)
+
+    def test_closed_idle_connection_is_retried_on_a_new_one(self):
+        #The daemon closes the connection after each reply, the pooled connection is stale at the next request
+        client = self.start(lambda method, path, headers, body: jsonReply({"ok": True}, close=True))
+        self.assertEqual(client.get("/info"), {"ok": True})
+        self.assertEqual(client.get("/info"), {"ok": True})
+        self.assertEqual(self.daemon.connections, 2)
+        self.assertEqual(len(self.daemon.requests), 2)
+
+    def test_error_reply_raises(self):
+        client = self.start(lambda method, path, headers, body: jsonReply({"message": "No such container: x"}, 404))
+        with self.assertRaises(DockerAPIError) as cm:
+            client.inspectContainer("x")
+        self.assertEqual(cm.exception.status, 404)
+        self.assertEqual(cm.exception.explanation, "No such container: x")
+
+    def test_iterable_body_is_uploaded_chunked(self):
+        client = self.start(lambda method, path, headers, body: jsonReply({"size": len(body)}))
+        chunks = ["a" * 10, "", "b" * 70000, "c"]
+        self.assertEqual(client.post("/build", body=iter(chunks), headers={"Content-Type": "application/x-tar"}),
+                         {"size": 70011})
+        method, path, headers, body = self.daemon.requests[0]
+        self.assertEqual(headers["transfer-encoding"], "chunked")
+        self.assertEqual(body, "".join(chunks))
+
+    def test_file_body_is_uploaded_chunked(self):
+        client = self.start(lambda method, path, headers, body: jsonReply({}))
+        f = tempfile.TemporaryFile()
+        f.write("x" * 200000)
+        f.seek(0)
+        client.putArchive("c1", "/opt", f)
+        method, path, headers, body = self.daemon.requests[0]
+        self.assertEqual((method, path), ("PUT", "/v1.24/containers/c1/archive?path=%2Fopt"))
+        self.assertEqual(body, "x" * 200000)
+
+    def test_frames_are_demultiplexed(self):
+        frames = struct.pack(">BxxxL", 1, 4) + "out\n" + struct.pack(">BxxxL", 2, 4) + "err\n" + \
+                 struct.pack(">BxxxL", 1, 5) + "done\n"
+        #Frames split across the chunks of the reply
+        reply = [frames[:3], frames[3:13], frames[13:]]
+        client = self.start(lambda method, path, headers, body: (200, {}, reply, False))
+        stream = client.post("/exec/e1/start", body={"Detach": False}, stream=True)
+        self.assertEqual(list(stream.iterFrames()), [(1, "out\n"), (2, "err\n"), (1, "done\n")])
+        #The fully read stream gives its connection back to the pool
+        client.get("/info")
+        self.assertEqual(self.daemon.connections, 1)
+
+    def test_exec_run_returns_exit_code_and_output(self):
+        def handler(method, path, headers, body):
+            if path.endswith("/exec"):
+                return jsonReply({"Id": "e1"})
+            if path.endswith("/start"):
+                return (200, {}, [struct.pack(">BxxxL", 1, 2) + "hi"], False)
+            return jsonReply({"ExitCode": 3})
+        client = self.start(handler)
+        self.assertEqual(client.execRun("c1", ["true"]), (3, "hi"))
+
+@unittest.skipIf(gcf_to_docker is None, "missing dependency")
+class DockerManagerErrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.docker_client = gcf_to_docker.docker_client
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "docker.sock")
+        self.manager = gcf_to_docker.DockerManager.__new__(gcf_to_docker.DockerManager)
+
+    def tearDown(self):
+        gcf_to_docker.docker_client = self.docker_client
+        shutil.rmtree(self.directory)
+
+    def test_daemon_not_running(self):
+        #socket.error
+        gcf_to_docker.docker_client = DockerClient(self.path, timeout=5)
+        self.assertFalse(self.manager.stopContainer("c1"))
+        self.assertFalse(self.manager.restartContainer("c1"))
+
+    def test_connection_closed_without_reply(self):
+        #httplib.HTTPException
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(5)
+        def accept():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.error:
+                    return
+                conn.recv(65536)
+                conn.close()
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+        gcf_to_docker.docker_client = DockerClient(self.path, timeout=5)
+        self.assertFalse(self.manager.stopContainer("c1"))
+        self.assertFalse(self.manager.restartContainer("c1"))
+        server.close()
+
+if __name__ == "__main__":
+    unittest.main()
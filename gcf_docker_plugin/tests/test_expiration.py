@@ -0,0 +1,85 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import datetime
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from expiration import ExpirationScheduler
+
+class FakeSliver(object):
+    def __init__(self, urn, seconds):
+        self._urn = urn
+        self.setExpiration(seconds)
+
+    def urn(self):
+        return self._urn
+
+    def expiration(self):
+        return self._expiration
+
+    def setExpiration(self, seconds):
+        self._expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+class ExpirationSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.expired = list()
+        self.cond = threading.Condition()
+        self.scheduler = ExpirationScheduler(self.expire)
+
+    def expire(self, slivers):
+        with self.cond:
+            self.expired.extend([s.urn() for s in slivers])
+            self.cond.notify()
+
+    def waitExpired(self, count, timeout=5):
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=timeout)
+        with self.cond:
+            while len(self.expired) < count and datetime.datetime.utcnow() < deadline:
+                self.cond.wait(0.05)
+            return list(self.expired)
+
+    def test_slivers_expire_in_order(self):
+        self.scheduler.schedule([FakeSliver("b", 0.3), FakeSliver("a", 0.1), FakeSliver("past", -10)])
+        self.assertEqual(self.waitExpired(3), ["past", "a", "b"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_renewed_sliver_expires_later(self):
+        sliver = FakeSliver("a", 0.2)
+        self.scheduler.schedule([sliver, FakeSliver("b", 0.4)])
+        sliver.setExpiration(0.8)
+        self.scheduler.schedule([sliver])
+        self.assertEqual(self.waitExpired(1), ["b"])
+        self.assertEqual(self.waitExpired(2), ["b", "a"])
+
+    def test_cancelled_sliver_does_not_expire(self):
+        sliver = FakeSliver("a", 0.1)
+        self.scheduler.schedule([sliver, FakeSliver("b", 0.3)])
+        self.scheduler.cancel([sliver])
+        self.assertEqual(self.waitExpired(2, timeout=1), ["b"])
+
+if __name__ == "__main__":
+    unittest.main()
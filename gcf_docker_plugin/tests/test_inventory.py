@@ -0,0 +1,165 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dockerapi import DockerAPIError
+from inventory import ContainerInventory, STATE_REMOVED
+
+def info(name, running=True, exit_code=0, port=None):
+    ports = {"22/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(port)}]} if port is not None else {}
+    return {"Name": "/" + name, "Id": "id-" + name,
+            "State": {"Status": "running" if running else "exited", "Running": running, "ExitCode": exit_code},
+            "NetworkSettings": {"Ports": ports}}
+
+class FakeClient(object):
+    """
+        Answers the listing and the inspection of the containers from a dict container name => info
+    """
+    def __init__(self):
+        self.containers = dict()
+
+    def get(self, path, params=None, **kwargs):
+        assert path == "/containers/json"
+        return [{"Id": c["Id"]} for c in self.containers.values()]
+
+    def inspectContainer(self, container_id):
+        for c in self.containers.values():
+            if c["Id"] == container_id:
+                return c
+        raise DockerAPIError(404, "No such container: " + container_id)
+
+class ContainerInventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.client.containers["a"] = info("a", port=2222)
+        self.client.containers["b"] = info("b", running=False, exit_code=1)
+        self.inventory = ContainerInventory(self.client)
+        #The events are fed by the tests, not by a follower thread
+        self.inventory._started = True
+
+    def event(self, action, name, container_id=None, **attributes):
+        attributes["name"] = name
+        self.inventory._onEvent({"Action": action, "Actor": {"ID": container_id or "id-" + name,
+                                                             "Attributes": attributes}})
+
+    def names(self, changes):
+        return sorted([entry["name"] for entry in changes])
+
+    def test_not_synced(self):
+        out = self.inventory.waitChanges(0, 0.05)
+        self.assertFalse(out["synced"])
+        self.assertIsNone(self.inventory.lookup("a"))
+        self.assertIsNone(self.inventory.runningCount())
+
+    def test_first_call_gets_everything(self):
+        self.inventory._sync()
+        out = self.inventory.waitChanges(0, 0)
+        self.assertTrue(out["synced"])
+        self.assertTrue(out["full"])
+        self.assertEqual(out["epoch"], self.inventory.epoch)
+        self.assertEqual(self.names(out["changes"]), ["a", "b"])
+        self.assertEqual(self.inventory.lookup("a")["ssh_port"], 2222)
+        self.assertEqual(self.inventory.lookup("b")["exit_code"], 1)
+        self.assertEqual(self.inventory.runningCount(), 1)
+
+    def test_changes_since(self):
+        self.inventory._sync()
+        seq = self.inventory.waitChanges(0, 0)["seq"]
+        self.client.containers["c"] = info("c")
+        self.event("start", "c")
+        del self.client.containers["a"]
+        self.event("destroy", "a")
+        out = self.inventory.waitChanges(seq, 0, epoch=self.inventory.epoch)
+        self.assertFalse(out["full"])
+        self.assertEqual(out["seq"], seq + 2)
+        self.assertEqual([(e["name"], e["state"]) for e in out["changes"]], [("c", "running"), ("a", STATE_REMOVED)])
+        #Nothing new: waits for the timeout and returns no change
+        out = self.inventory.waitChanges(out["seq"], 0.05, epoch=self.inventory.epoch)
+        self.assertFalse(out["full"])
+        self.assertEqual(out["changes"], [])
+
+    def test_wakes_up_on_change(self):
+        self.inventory._sync()
+        seq = self.inventory.waitChanges(0, 0)["seq"]
+        self.client.containers["b"] = info("b")
+        timer = threading.Timer(0.1, self.event, ("start", "b"))
+        timer.start()
+        start = time.time()
+        out = self.inventory.waitChanges(seq, 5, epoch=self.inventory.epoch)
+        timer.join()
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual([e["name"] for e in out["changes"]], ["b"])
+        self.assertTrue(out["changes"][0]["running"])
+
+    def test_full_after_resync(self):
+        self.inventory._sync()
+        seq = self.inventory.waitChanges(0, 0)["seq"]
+        self.event("start", "a")
+        epoch = self.inventory.epoch
+        #The events stream was lost, and container b removed in the meantime
+        with self.inventory._cond:
+            self.inventory.synced = False
+        del self.client.containers["b"]
+        self.inventory._sync()
+        out = self.inventory.waitChanges(seq + 1, 0, epoch=epoch)
+        #Same epoch, but the changes since seq+1 are gone: all the containers, without the removed one
+        self.assertEqual(out["epoch"], epoch)
+        self.assertTrue(out["full"])
+        self.assertEqual(out["seq"], seq + 2)
+        self.assertEqual(self.names(out["changes"]), ["a"])
+        #The changes after the resync are incremental again
+        self.event("die", "a")
+        out = self.inventory.waitChanges(out["seq"], 0, epoch=epoch)
+        self.assertFalse(out["full"])
+        self.assertEqual(out["seq"], seq + 3)
+        self.assertEqual([e["name"] for e in out["changes"]], ["a"])
+
+    def test_other_epoch(self):
+        self.inventory._sync()
+        seq = self.inventory.waitChanges(0, 0)["seq"]
+        out = self.inventory.waitChanges(seq, 0, epoch="previous process")
+        self.assertTrue(out["full"])
+        self.assertEqual(self.names(out["changes"]), ["a", "b"])
+        #A sequence number ahead of the inventory (from a previous process) gets everything as well
+        out = self.inventory.waitChanges(seq + 10, 0, epoch=self.inventory.epoch)
+        self.assertTrue(out["full"])
+
+    def test_rename(self):
+        self.inventory._sync()
+        seq = self.inventory.waitChanges(0, 0)["seq"]
+        self.client.containers["d"] = dict(self.client.containers.pop("a"), Name="/d")
+        #A renamed container keeps its id
+        self.event("rename", "d", container_id="id-a", oldName="/a")
+        out = self.inventory.waitChanges(seq, 0, epoch=self.inventory.epoch)
+        self.assertEqual([(e["name"], e["state"]) for e in out["changes"]], [("a", STATE_REMOVED), ("d", "running")])
+        self.assertIsNone(self.inventory.lookup("a"))
+        self.assertEqual(self.inventory.lookup("d")["ssh_port"], 2222)
+
+if __name__ == '__main__':
+    unittest.main()
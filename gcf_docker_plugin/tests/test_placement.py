@@ -0,0 +1,122 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    import placement
+    from placement import Placement
+    from dockermaster import DockerMaster
+    from extendedresource import ExtendedResource
+except ImportError as e: #gcf, Pyro4 and lxml are needed by the resources
+    placement = None
+
+class FakeDockerManager(object):
+    """
+        A docker host with fixed statistics
+    """
+    def __init__(self, running=0, load=0.0, mem_free=4096, cpus=4):
+        self.stats = dict(running=running, load=load, mem_free=mem_free, cpus=cpus)
+
+    def checkDocker(self):
+        pass
+
+    def randomMacAddress(self):
+        return "02:42:ac:11:00:01"
+
+    def getHostStats(self):
+        if self.stats is None:
+            raise IOError("host down")
+        return self.stats
+
+def dockerMaster(host, slots=4, **stats):
+    return DockerMaster(slots, host=host, dockermanager=FakeDockerManager(**stats))
+
+@unittest.skipIf(placement is None, "missing dependency")
+class PlacementTest(unittest.TestCase):
+    def hosts(self, policy, hosts):
+        p = Placement(policy)
+        p.refresh(hosts)
+        return p
+
+    def test_spread_uses_the_host_running_the_fewest_containers(self):
+        busy, idle = dockerMaster("busy", running=5), dockerMaster("idle", running=1)
+        request = self.hosts("spread", [busy, idle]).newRequest([])
+        self.assertEqual(request.candidates([busy, idle])[0], idle)
+        #The containers placed by the request count
+        for _ in range(5):
+            request.record(idle.matchResource())
+        self.assertEqual(request.candidates([busy, idle])[0], busy)
+
+    def test_spread_counts_warm_containers_as_free(self):
+        warm, other = dockerMaster("warm", running=4), dockerMaster("other", running=2)
+        warm.warm['docker-container'] = [dict(name="warm-%d" % i, port=12000+i, mac=None) for i in range(4)]
+        request = self.hosts("spread", [warm, other]).newRequest([])
+        self.assertEqual(request.candidates([other, warm])[0], warm)
+
+    def test_binpack_fills_a_host_first(self):
+        small, big = dockerMaster("small", slots=2), dockerMaster("big", slots=8)
+        request = self.hosts("binpack", [small, big]).newRequest([])
+        self.assertEqual(request.candidates([big, small])[0], small)
+
+    def test_least_loaded_uses_the_host_with_the_lowest_load(self):
+        loaded, quiet = dockerMaster("loaded", load=3.0), dockerMaster("quiet", load=0.5)
+        request = self.hosts("least_loaded", [loaded, quiet]).newRequest([])
+        self.assertEqual(request.candidates([loaded, quiet])[0], quiet)
+
+    def test_hosts_without_statistics_come_last(self):
+        down, up = dockerMaster("down", slots=8), dockerMaster("up", running=50)
+        down.dockermanager.stats = None
+        request = self.hosts("spread", [down, up]).newRequest([])
+        self.assertEqual(request.candidates([down, up]), [up, down])
+
+    def test_other_resources_come_after_the_dockermasters(self):
+        host, node = dockerMaster("h1"), ExtendedResource("node1", ["docker-container"])
+        request = self.hosts("spread", [host]).newRequest([])
+        self.assertEqual(request.candidates([node, host]), [host, node])
+
+    def test_affinity_keeps_a_group_on_one_host(self):
+        h1, h2 = dockerMaster("h1", running=0), dockerMaster("h2", running=10)
+        request = self.hosts("spread", [h1, h2]).newRequest([])
+        container = h2.matchResource()
+        container.affinity = "db"
+        request.record(container)
+        self.assertEqual(request.candidates([h1, h2], affinity="db"), [h2])
+        self.assertEqual(request.candidates([h1, h2], affinity="web")[0], h1)
+
+    def test_anti_affinity_spreads_a_group(self):
+        h1, h2 = dockerMaster("h1", running=0), dockerMaster("h2", running=10)
+        container = h1.matchResource()
+        container.anti_affinity = "replicas"
+        #Containers already allocated to the slice count too
+        request = self.hosts("spread", [h1, h2]).newRequest([container])
+        self.assertEqual(request.candidates([h1, h2], anti_affinity="replicas"), [h2])
+
+    def test_unknown_policy_is_rejected(self):
+        self.assertRaises(Exception, Placement, "random")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import portpool
+from portpool import PortPool
+
+class PortPoolTest(unittest.TestCase):
+    def pool(self, starting_port, host_ports=()):
+        pool = PortPool(starting_port)
+        pool.reconcile(set(host_ports))
+        return pool
+
+    def test_reserves_the_lowest_free_ports(self):
+        pool = self.pool(20000)
+        self.assertEqual([pool.reserve() for _ in range(3)], [20000, 20001, 20002])
+        self.assertTrue(pool.isReserved(20001))
+
+    def test_skips_the_ports_used_on_the_host(self):
+        pool = self.pool(20000, [20000, 20002, 19999])
+        self.assertEqual(pool.peek(), 20001)
+        self.assertEqual([pool.reserve() for _ in range(2)], [20001, 20003])
+
+    def test_peek_does_not_reserve(self):
+        pool = self.pool(20000)
+        self.assertEqual(pool.peek(), 20000)
+        self.assertEqual(pool.reserve(), 20000)
+
+    def test_released_port_is_reused(self):
+        pool = self.pool(20000)
+        ports = [pool.reserve() for _ in range(3)]
+        pool.release(ports[1])
+        self.assertFalse(pool.isReserved(ports[1]))
+        self.assertEqual(pool.reserve(), ports[1])
+
+    def test_reconcile_keeps_reservations(self):
+        pool = self.pool(20000)
+        port = pool.reserve()
+        pool.reconcile(set())
+        self.assertNotEqual(pool.reserve(), port)
+
+    def test_exhausted_pool_raises(self):
+        pool = self.pool(portpool.LAST_PORT - 1)
+        pool.reserve()
+        pool.reserve()
+        self.assertRaises(Exception, pool.reserve)
+
+    def test_read_host_ports(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.remove, f.name)
+        f.write("  sl  local_address rem_address   st tx_queue rx_queue\n"
+                "   0: 00000000:0016 00000000:0000 0A 00000000:00000000\n"
+                "   1: 0100007F:2EE0 0100007F:C350 01 00000000:00000000\n")
+        f.close()
+        old = portpool.PROC_NET_TCP
+        portpool.PROC_NET_TCP = [f.name, f.name + ".missing"]
+        try:
+            self.assertEqual(portpool.readHostPorts(), set([22, 12000]))
+            self.assertEqual(portpool.readHostPorts(listening_only=True), set([22]))
+        finally:
+            portpool.PROC_NET_TCP = old
+
+if __name__ == "__main__":
+    unittest.main()
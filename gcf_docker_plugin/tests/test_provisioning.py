@@ -0,0 +1,129 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import Queue
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from provisioning import ProvisioningExecutor, PRIORITY_RESTART, PRIORITY_SMALL, PRIORITY_LARGE, PHASE_QUEUED
+
+class ProvisioningExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ProvisioningExecutor(workers=1)
+        self.ran = Queue.Queue()
+
+    #Hold the worker of host until the returned event is set
+    def block(self, host):
+        gate = threading.Event()
+        started = threading.Event()
+        def run(job):
+            job.setPhase("blocking")
+            started.set()
+            gate.wait(5)
+        self.executor.submit(host, "gate", ["gate-" + host], run)
+        started.wait(5)
+        return gate
+
+    def submit(self, host, slice_urn, sliver_urn, priority=PRIORITY_LARGE):
+        return self.executor.submit(host, slice_urn, [sliver_urn], lambda job: self.ran.put(sliver_urn), priority)
+
+    def runOrder(self, count):
+        return [self.ran.get(timeout=5) for _ in range(count)]
+
+    def test_hosts_have_their_own_workers(self):
+        gate = self.block("h1")
+        self.submit("h1", "s1", "a")
+        self.submit("h2", "s1", "b")
+        self.assertEqual(self.ran.get(timeout=5), "b")
+        self.assertTrue(self.ran.empty())
+        gate.set()
+        self.assertEqual(self.ran.get(timeout=5), "a")
+
+    def test_slices_take_turns(self):
+        gate = self.block("h1")
+        for urn in ["a1", "a2", "a3"]:
+            self.submit("h1", "big", urn)
+        for urn in ["b1", "b2"]:
+            self.submit("h1", "other", urn)
+        gate.set()
+        self.assertEqual(self.runOrder(5), ["a1", "b1", "a2", "b2", "a3"])
+
+    def test_priority_classes(self):
+        gate = self.block("h1")
+        self.submit("h1", "big", "large", PRIORITY_LARGE)
+        self.submit("h1", "small", "small", PRIORITY_SMALL)
+        self.submit("h1", "big", "restart", PRIORITY_RESTART)
+        gate.set()
+        self.assertEqual(self.runOrder(3), ["restart", "small", "large"])
+
+    def test_status(self):
+        gate = self.block("h1")
+        for urn in ["a1", "a2"]:
+            self.submit("h1", "big", urn)
+        self.submit("h1", "other", "b1")
+        status = self.executor.status(["gate-h1", "a1", "a2", "b1", "unknown"])
+        self.assertEqual(status, {"gate-h1": dict(phase="blocking"),
+                                  "a1": dict(phase=PHASE_QUEUED, queue_position=0),
+                                  "b1": dict(phase=PHASE_QUEUED, queue_position=1),
+                                  "a2": dict(phase=PHASE_QUEUED, queue_position=2)})
+        gate.set()
+        self.runOrder(3)
+        deadline = time.time() + 5
+        while len(self.executor.status(["a1", "a2", "b1"])) > 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.executor.status(["a1", "a2", "b1"]), dict())
+
+    def test_suspended_job_frees_its_worker(self):
+        waiting = Queue.Queue()
+        def run(job):
+            job.suspend("waiting for ssh")
+            waiting.put(job)
+        self.executor.submit("h1", "s1", ["a"], run)
+        job = waiting.get(timeout=5)
+        #The single worker runs the next job meanwhile
+        self.submit("h1", "s1", "b")
+        self.assertEqual(self.ran.get(timeout=5), "b")
+        self.assertEqual(self.executor.status(["a"]), {"a": dict(phase="waiting for ssh")})
+        self.executor.resume(job, lambda job: self.ran.put("a"))
+        self.assertEqual(self.ran.get(timeout=5), "a")
+
+    def test_resumed_before_the_end_of_run(self):
+        def run(job):
+            job.suspend("waiting for ssh")
+            self.executor.resume(job, lambda job: self.ran.put("resumed"))
+        self.executor.submit("h1", "s1", ["a"], run)
+        self.assertEqual(self.ran.get(timeout=5), "resumed")
+
+    def test_failing_job_does_not_stop_the_worker(self):
+        def run(job):
+            raise IOError("docker host down")
+        self.executor.submit("h1", "s1", ["a"], run)
+        self.submit("h1", "s1", "b")
+        self.assertEqual(self.ran.get(timeout=5), "b")
+
+if __name__ == '__main__':
+    unittest.main()
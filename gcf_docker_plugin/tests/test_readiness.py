@@ -0,0 +1,135 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import readiness
+from readiness import ReadinessWatcher
+
+class FakeSshd(object):
+    """
+        Listens on a port of localhost; sends an SSH banner to each connection, or closes it at once if banner is None
+        (the docker proxy of a container whose sshd has exited)
+    """
+    def __init__(self, banner="SSH-2.0-OpenSSH_7.4\r\n", port=0):
+        self.banner = banner
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            if self.banner is not None:
+                conn.sendall(self.banner)
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+def freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class ReadinessTest(unittest.TestCase):
+    def setUp(self):
+        self.retry_interval = readiness.RETRY_INTERVAL
+        readiness.RETRY_INTERVAL = 0.05
+        self.watcher = ReadinessWatcher()
+        self.results = Queue.Queue()
+
+    def tearDown(self):
+        readiness.RETRY_INTERVAL = self.retry_interval
+
+    def watch(self, port, timeout):
+        self.watcher.watch("127.0.0.1", port, timeout, self.results.put)
+
+    def test_port_open(self):
+        sshd = FakeSshd()
+        start = time.time()
+        self.watch(sshd.port, 10)
+        self.assertTrue(self.results.get(timeout=5))
+        self.assertLess(time.time() - start, 5)
+        sshd.close()
+
+    def test_timeout(self):
+        start = time.time()
+        self.watch(freePort(), 0.5)
+        self.assertFalse(self.results.get(timeout=5))
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+    def test_container_exit(self):
+        #The proxy accepts the connections, but no sshd answers behind it
+        sshd = FakeSshd(banner=None)
+        self.watch(sshd.port, 0.5)
+        self.assertFalse(self.results.get(timeout=5))
+        self.assertGreater(sshd.connections, 1)
+        sshd.close()
+
+    def test_sshd_started_late(self):
+        port = freePort()
+        self.watch(port, 10)
+        time.sleep(0.2)
+        self.assertTrue(self.results.empty())
+        sshd = FakeSshd(port=port)
+        self.assertTrue(self.results.get(timeout=5))
+        sshd.close()
+
+    def test_many_probes_at_once(self):
+        sshds = [FakeSshd() for _ in range(20)]
+        closed = freePort()
+        for sshd in sshds:
+            self.watch(sshd.port, 10)
+        self.watch(closed, 0.5)
+        results = [self.results.get(timeout=5) for _ in range(21)]
+        self.assertEqual(sorted(results), [False] + [True] * 20)
+        for sshd in sshds:
+            sshd.close()
+
+    def test_wait_for(self):
+        sshd = FakeSshd()
+        self.assertTrue(self.watcher.waitFor("127.0.0.1", sshd.port, 5))
+        sshd.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import time
+import unittest
+import xml.dom.minidom as minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serviceplan import ServiceStep, compileServicePlan, runInstalls, runExecutes, INSTALL, EXECUTE
+
+REQUEST = """<rspec xmlns="http://www.geni.net/resources/rspec/3" xmlns:docker="http://www.fed4fire.eu/docker_am" type="request">
+  <node client_id="n1">
+    <services>
+      <execute shell="sh" command="echo 1"/>
+      <install url="http://example.org/b.tar.gz" install_path="/opt" docker:stage="1"/>
+      <install url="http://example.org/a.tar.gz" install_path="/opt"/>
+      <install url="http://example.org/c.tar.gz" install_path="/opt" docker:stage="x"/>
+      <execute shell="bash" command="echo 2"/>
+    </services>
+  </node>
+  <node client_id="n2"/>
+</rspec>"""
+
+def nodes():
+    return minidom.parseString(REQUEST).getElementsByTagName("node")
+
+class FakeResource(object):
+    """
+        Runs each install in delay seconds, and records the installs running at the same time
+    """
+    def __init__(self, delay=0.05, failing=()):
+        self.delay = delay
+        self.failing = failing
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.events = list() #("start" or "end", url)
+        self.commands = None
+
+    def installCommand(self, url, install_path):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.events.append(("start", url))
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.events.append(("end", url))
+        if url in self.failing:
+            return "Failed to download " + url
+        return True
+
+    def executeCommands(self, commands):
+        self.commands = commands
+        return True
+
+class CompileServicePlanTest(unittest.TestCase):
+    def test_plan(self):
+        plan = compileServicePlan(nodes())
+        self.assertEqual(sorted(plan.keys()), ["n1", "n2"])
+        self.assertEqual(plan["n2"], [])
+        steps = plan["n1"]
+        self.assertEqual([s.kind for s in steps], [INSTALL, INSTALL, INSTALL, EXECUTE, EXECUTE])
+        self.assertEqual([s.args for s in steps],
+                         [("http://example.org/b.tar.gz", "/opt"), ("http://example.org/a.tar.gz", "/opt"),
+                          ("http://example.org/c.tar.gz", "/opt"), ("sh", "echo 1"), ("bash", "echo 2")])
+        self.assertEqual([s.index for s in steps], [0, 1, 2, 0, 1])
+        #An invalid stage is ignored
+        self.assertEqual([s.stage for s in steps[:3]], [1, None, None])
+
+class RunInstallsTest(unittest.TestCase):
+    def steps(self, count, stage=None):
+        return [ServiceStep(INSTALL, ("http://example.org/%s%d.tar.gz" % (stage, i), "/opt"), i, stage)
+                for i in range(count)]
+
+    def test_stages_run_one_after_the_other(self):
+        resource = FakeResource()
+        steps = self.steps(2, stage=1) + self.steps(3) + self.steps(1, stage=2)
+        self.assertTrue(runInstalls(steps, resource, lambda step, out: None))
+        urls = [url for event, url in resource.events]
+        def last(stage, event):
+            return max([i for i, (e, url) in enumerate(resource.events) if e == event and "/%s" % stage in url])
+        def first(stage, event):
+            return min([i for i, (e, url) in enumerate(resource.events) if e == event and "/%s" % stage in url])
+        #Stage 0 (no stage) first, then stage 1, then stage 2
+        self.assertLess(last(None, "end"), first(1, "start"))
+        self.assertLess(last(1, "end"), first(2, "start"))
+        self.assertEqual(len(urls), 12)
+
+    def test_steps_of_a_stage_overlap_up_to_the_limit(self):
+        resource = FakeResource(delay=0.1)
+        self.assertTrue(runInstalls(self.steps(6), resource, lambda step, out: None, limit=3))
+        self.assertEqual(resource.max_running, 3)
+
+    def test_errors_and_done_calls(self):
+        steps = self.steps(4)
+        resource = FakeResource(failing=[steps[1].args[0], steps[3].args[0]])
+        calls = list()
+        active = list()
+        def done(step, out):
+            #One call at a time
+            active.append(step)
+            self.assertEqual(len(active), 1)
+            time.sleep(0.01)
+            calls.append((step.index, out))
+            active.remove(step)
+        out = runInstalls(steps, resource, done)
+        self.assertEqual(sorted(out.split("\n")), sorted(["Failed to download " + steps[1].args[0],
+                                                          "Failed to download " + steps[3].args[0]]))
+        self.assertEqual(sorted(calls), [(0, True), (1, "Failed to download " + steps[1].args[0]),
+                                         (2, True), (3, "Failed to download " + steps[3].args[0])])
+
+    def test_executes(self):
+        resource = FakeResource()
+        self.assertTrue(runExecutes(compileServicePlan(nodes())["n1"], resource))
+        self.assertEqual(resource.commands, [("sh", "echo 1", 0), ("bash", "echo 2", 1)])
+        self.assertTrue(runExecutes([], resource))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from statejournal import StateJournal, StateWriter, aggregateEntry
+
+class FakeAggregate(object):
+    def __init__(self):
+        self.containers = dict()
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "state.journal")
+        self.journal = StateJournal(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self):
+        aggregate = FakeAggregate()
+        count = StateJournal(self.filename).replay(dict(), aggregate)
+        return count, aggregate.containers
+
+    def test_replay(self):
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        self.journal.append([aggregateEntry("slice2", ["r2"]), aggregateEntry("slice1", [])])
+        self.assertEqual(self.replay(), (2, dict(slice2=["r2"])))
+
+    def test_replay_after_a_snapshot(self):
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        self.assertTrue(self.journal.snapshot(lambda: True))
+        self.assertEqual(self.journal.records, 0)
+        self.journal.append([aggregateEntry("slice2", ["r2"])])
+        self.assertEqual(self.replay(), (1, dict(slice2=["r2"])))
+        self.assertFalse(os.path.exists(self.journal.previous))
+
+    def test_records_appended_during_a_snapshot(self):
+        def write():
+            #The journal is not locked while the snapshot is written
+            self.journal.append([aggregateEntry("slice2", ["r2"])])
+            return True
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        self.assertTrue(self.journal.snapshot(write))
+        self.assertEqual(self.journal.records, 1)
+        self.assertEqual(self.replay(), (1, dict(slice2=["r2"])))
+
+    def test_failed_snapshot_keeps_the_records(self):
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        self.assertFalse(self.journal.snapshot(lambda: False))
+        self.journal.append([aggregateEntry("slice1", ["r1", "r3"])])
+        self.assertEqual(self.journal.records, 2)
+        self.assertEqual(self.replay(), (2, dict(slice1=["r1", "r3"])))
+        #A second failure appends the new records after the kept ones
+        self.assertFalse(self.journal.snapshot(lambda: False))
+        self.journal.append([aggregateEntry("slice2", ["r2"])])
+        self.assertEqual(self.replay(), (3, dict(slice1=["r1", "r3"], slice2=["r2"])))
+        self.assertTrue(self.journal.snapshot(lambda: True))
+        self.assertEqual(self.replay(), (0, dict()))
+
+    def test_torn_last_record_is_ignored(self):
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        self.journal.append([aggregateEntry("slice2", ["r2"])])
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 3)
+        self.assertEqual(self.replay(), (1, dict(slice1=["r1"])))
+
+    def test_truncated_header_is_ignored(self):
+        self.journal.append([aggregateEntry("slice1", ["r1"])])
+        with open(self.filename, "ab") as f:
+            f.write("\x00\x00")
+        self.assertEqual(self.replay(), (1, dict(slice1=["r1"])))
+
+class FakeJournal(object):
+    def __init__(self):
+        self.records = list()
+        self.syncs = 0
+        self.fail = False
+
+    def append(self, entries):
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("dictionary changed size during iteration")
+        self.records.append(entries)
+
+    def sync(self):
+        self.syncs += 1
+
+class StateWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.journal = FakeJournal()
+        self.writer = StateWriter(self.journal, interval=3600)
+        self.state = dict()
+        #The first change is written at once, the next ones wait for the interval
+        self.mark("first", 0)
+        deadline = time.time() + 5
+        while len(self.journal.records) == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.journal.records, [[("first", 0)]])
+
+    def mark(self, key, value):
+        self.state[key] = value
+        self.writer.mark(key, lambda: [(key, self.state[key])])
+
+    def test_changes_are_coalesced(self):
+        for i in range(5):
+            self.mark("a", i)
+        self.mark("b", 0)
+        self.assertEqual(len(self.journal.records), 1)
+        self.writer.flush()
+        #One record, with the last state of each object
+        self.assertEqual(self.journal.records[1], [("a", 4), ("b", 0)])
+        self.assertEqual(self.journal.syncs, 1)
+
+    def test_metrics(self):
+        for i in range(3):
+            self.mark("a", i)
+        self.assertEqual(self.writer.metrics()['pending'], 1)
+        self.writer.flush()
+        metrics = self.writer.metrics()
+        self.assertEqual((metrics['marks'], metrics['writes'], metrics['written'], metrics['coalesced'], metrics['pending']),
+                         (4, 2, 2, 2, 0))
+        self.assertGreaterEqual(metrics['max_latency_ms'], metrics['avg_latency_ms'])
+
+    def test_failed_write_keeps_the_changes(self):
+        self.mark("a", 1)
+        self.journal.fail = True
+        self.writer.flush()
+        self.assertEqual(len(self.journal.records), 1)
+        self.assertEqual(self.writer.metrics()['pending'], 1)
+        self.writer.flush()
+        self.assertEqual(self.journal.records[1], [("a", 1)])
+
+if __name__ == '__main__':
+    unittest.main()
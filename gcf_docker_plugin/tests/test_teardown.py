@@ -0,0 +1,150 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import Queue
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from teardown import TeardownQueue, PRIORITY_CONTAINERS, PRIORITY_IMAGES
+try:
+    from testbed import DockerAggregateManager
+except ImportError as e: #gcf, Pyro4 and lxml are needed by the AM
+    DockerAggregateManager = None
+    missing = str(e)
+
+class FlakyTask(object):
+    """
+        Fails failures times, then succeeds
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            return "Docker API error 500: device or resource busy"
+        return True
+
+class TeardownQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = TeardownQueue(workers=1, retries=4, retry_delay=0.01)
+        self.done = Queue.Queue()
+
+    def test_retried_until_it_succeeds(self):
+        task = FlakyTask(2)
+        self.queue.submit("containers", task, lambda: self.done.put(task.calls))
+        self.assertEqual(self.done.get(timeout=5), 3)
+        self.assertRaises(Queue.Empty, self.done.get, timeout=0.2)
+
+    def test_given_up_after_the_retries(self):
+        task = FlakyTask(10)
+        self.queue.submit("containers", task, lambda: self.done.put(task.calls))
+        self.assertEqual(self.done.get(timeout=5), 4)
+        self.assertRaises(Queue.Empty, self.done.get, timeout=0.2)
+
+    def test_exception_is_a_failure(self):
+        calls = list()
+        def task():
+            calls.append(1)
+            if len(calls) == 1:
+                raise IOError("connection refused")
+            return True
+        self.queue.submit("images", task, lambda: self.done.put(len(calls)))
+        self.assertEqual(self.done.get(timeout=5), 2)
+
+    def test_containers_before_images(self):
+        blocked = threading.Event()
+        self.queue.submit("first", lambda: blocked.wait(5) or True)
+        order = list()
+        self.queue.submit("images", lambda: order.append("images") or True, priority=PRIORITY_IMAGES)
+        self.queue.submit("containers1", lambda: order.append("containers1") or True, priority=PRIORITY_CONTAINERS)
+        self.queue.submit("containers2", lambda: order.append("containers2") or True)
+        self.queue.submit("last", lambda: True, lambda: self.done.put(True), priority=PRIORITY_IMAGES)
+        blocked.set()
+        self.done.get(timeout=5)
+        self.assertEqual(order, ["containers1", "containers2", "images"])
+
+class FakeContainer(object):
+    def __init__(self, id, dockermaster):
+        self.id = id
+        self.dockermaster = dockermaster
+        self.tearing_down = True
+        self.deprovisioned = 0
+
+    def onDeprovisioned(self):
+        self.deprovisioned += 1
+
+class FakeDockerMaster(object):
+    """
+        Its removeContainers() fails failures times, then succeeds
+    """
+    def __init__(self, failures):
+        self.id = "dm1"
+        self.host = "h1"
+        self.failures = failures
+        self.removals = list() #(names, ports) of each call
+        self.reset = list()
+
+    def removalSpec(self, containers):
+        return [c.id for c in containers], [12000 + i for i in range(len(containers))]
+
+    def removeContainers(self, names, ports):
+        self.removals.append((list(names), list(ports)))
+        if len(self.removals) <= self.failures:
+            return "Docker API error 500: device or resource busy"
+        return True
+
+    def onResetChild(self, container):
+        self.reset.append(container.id)
+
+class FakeStateWriter(object):
+    def mark(self, key, entries):
+        pass
+
+@unittest.skipIf(DockerAggregateManager is None, "missing dependency")
+class SubmitRemovalTest(unittest.TestCase):
+    def test_containers_are_given_back_once(self):
+        am = DockerAggregateManager.__new__(DockerAggregateManager)
+        am.state_writer = FakeStateWriter()
+        am.teardown = TeardownQueue(workers=2, retries=5, retry_delay=0.01)
+        dockermaster = FakeDockerMaster(failures=2)
+        containers = [FakeContainer("c%d" % i, dockermaster) for i in range(3)]
+        am.submitRemoval(dockermaster, containers)
+        deadline = time.time() + 5
+        while len(dockermaster.reset) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(len(dockermaster.removals), 3)
+        #The ports are released by the first attempt only
+        self.assertEqual([ports for _, ports in dockermaster.removals], [[12000, 12001, 12002], [], []])
+        self.assertEqual(sorted(dockermaster.reset), ["c0", "c1", "c2"])
+        self.assertEqual([c.deprovisioned for c in containers], [1, 1, 1])
+        self.assertEqual([c.tearing_down for c in containers], [False, False, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import datetime
+import logging
+import os
+import Queue
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    import testbed
+    from testbed import DockerAggregateManager, Slice
+    from expiration import ExpirationScheduler
+    from provisioning import ProvisioningExecutor
+    from extendedresource import ExtendedResource
+    from gcf.geni.am.api_error_exception import ApiErrorException
+except ImportError as e: #gcf, Pyro4 and lxml are needed by the AM
+    testbed = None
+    missing = str(e)
+
+SLICE_URN = "urn:publicid:IDN+example.org+slice+test"
+
+class FakeStateWriter(object):
+    def __init__(self):
+        self.marked = list()
+
+    def mark(self, key, entries):
+        self.marked.append(key)
+
+def newAggregateManager():
+    """
+        A DockerAggregateManager with a slice of one sliver, without config, certificates nor docker host
+    """
+    am = DockerAggregateManager.__new__(DockerAggregateManager)
+    am.logger = logging.getLogger('gcf.am3')
+    am._slices = dict()
+    am.max_lease = datetime.timedelta(minutes=testbed.REFAM_MAXLEASE_MINUTES)
+    am.state_writer = FakeStateWriter()
+    am.torn_down = Queue.Queue()
+    am.teardown_slivers = lambda slivers, containers=(): am.torn_down.put(slivers)
+    #Every credential is valid for a day
+    am.getVerifiedCredentials = lambda *args, **kwargs: []
+    am.min_expire = lambda *args, **kwargs: datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    am.expiration = ExpirationScheduler(am.expire_due_slivers)
+    slyce = Slice(SLICE_URN)
+    sliver = slyce.add_resource(ExtendedResource("node1", ["raw-pc"]))
+    sliver.setExpiration(datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+    sliver.setAllocationState(testbed.STATE_GENI_PROVISIONED)
+    am._slices[SLICE_URN] = slyce
+    am.expiration.schedule(slyce.slivers())
+    return am, sliver
+
+def rfc3339(t):
+    return t.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+@unittest.skipIf(testbed is None, "missing dependency")
+class RenewTest(unittest.TestCase):
+    def test_renew(self):
+        am, sliver = newAggregateManager()
+        requested = datetime.datetime.utcnow() + datetime.timedelta(hours=2)
+        out = am.Renew([SLICE_URN], [], rfc3339(requested), dict())
+        self.assertEqual(out['code']['geni_code'], 0)
+        self.assertEqual(sliver.expiration(), requested)
+        self.assertIn(("sliver", sliver.urn()), am.state_writer.marked)
+        self.assertTrue(am.torn_down.empty())
+
+    def test_renewed_sliver_expires_at_its_new_time(self):
+        am, sliver = newAggregateManager()
+        requested = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        out = am.Renew([sliver.urn()], [], rfc3339(requested), dict())
+        self.assertEqual(out['code']['geni_code'], 0)
+        self.assertEqual(am.torn_down.get(timeout=5), [sliver])
+
+    def test_renew_unknown_slice(self):
+        am, sliver = newAggregateManager()
+        requested = datetime.datetime.utcnow() + datetime.timedelta(hours=2)
+        self.assertRaises(ApiErrorException, am.Renew, ["urn:publicid:IDN+example.org+slice+unknown"], [],
+                          rfc3339(requested), dict())
+        self.assertLess(sliver.expiration(), requested)
+
+    def test_expire_due_slivers_skips_deleted_slivers(self):
+        am, sliver = newAggregateManager()
+        am._slices[SLICE_URN].delete_sliver(sliver)
+        am.expire_due_slivers([sliver])
+        self.assertTrue(am.torn_down.empty())
+
+class FakeDockerManager(object):
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.prepared = Queue.Queue()
+
+    def prepareImage(self, image):
+        if image in self.failing:
+            raise IOError("connection refused")
+        self.prepared.put(image)
+
+class FakeDockerMaster(object):
+    def __init__(self, host, dockermanager):
+        self.host = host
+        self.dockermanager = dockermanager
+
+@unittest.skipIf(testbed is None, "missing dependency")
+class PrepareImagesTest(unittest.TestCase):
+    def test_images_are_prepared_by_provisioning_jobs(self):
+        am, sliver = newAggregateManager()
+        am.provisioning = ProvisioningExecutor(workers=1)
+        dockermanager = FakeDockerManager(failing=[SLICE_URN+"::bad"])
+        dockermaster = FakeDockerMaster("h1", dockermanager)
+        slyce = am._slices[SLICE_URN]
+        slivers = list()
+        for i, image in enumerate(["good", "good", "bad", None]):
+            resource = ExtendedResource("container%d" % i, ["docker-container"])
+            resource.image = SLICE_URN+"::"+image if image is not None else None
+            resource.dockermaster = dockermaster
+            slivers.append(slyce.add_resource(resource))
+        am.prepareImages(slyce, slivers)
+        #One preparation for each image
+        self.assertEqual(dockermanager.prepared.get(timeout=5), SLICE_URN+"::good")
+        deadline = time.time() + 5
+        while len(am.provisioning.status([s.urn() for s in slivers])) > 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(dockermanager.prepared.empty())
+        self.assertEqual([s.resource().error for s in slivers],
+                         ["", "", "Failed to start the preparation of image bad: connection refused", ""])
+        self.assertIn(("sliver", slivers[2].urn()), am.state_writer.marked)
+
+#A started resource whose SSH server answers when the test calls the callback put in watchers
+def slowSshResource(id, watchers):
+    resource = ExtendedResource(id, ["docker-container"])
+    resource.external_id = id
+    resource.watchSshConnection = watchers.put
+    return resource
+
+@unittest.skipIf(testbed is None, "missing dependency")
+class ProvisionTest(unittest.TestCase):
+    def test_workers_are_not_held_while_waiting_for_ssh(self):
+        am, _ = newAggregateManager()
+        am.provisioning = ProvisioningExecutor(workers=1)
+        slyce = am._slices[SLICE_URN]
+        watchers = Queue.Queue()
+        slivers = [slyce.add_resource(slowSshResource("container%d" % i, watchers)) for i in range(3)]
+        for sliver in slivers:
+            slyce.service_plan[sliver.resource().external_id] = [] #No services
+        for sliver in slivers:
+            am.submitProvisioning(slyce, sliver, provisioned=True)
+        #A single worker, but the three slivers wait for their SSH server at the same time
+        callbacks = [watchers.get(timeout=5) for _ in slivers]
+        self.assertEqual([status['phase'] for status in am.provisioning.status([s.urn() for s in slivers]).values()],
+                         ["waiting for ssh"] * 3)
+        callbacks[0](True)
+        callbacks[1](False)
+        callbacks[2](True)
+        deadline = time.time() + 5
+        while len(am.provisioning.status([s.urn() for s in slivers])) > 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([s.operationalState() for s in slivers],
+                         [testbed.OPSTATE_GENI_READY, testbed.OPSTATE_GENI_FAILED, testbed.OPSTATE_GENI_READY])
+
+AM_URN = "urn:publicid:IDN+example.org+authority+am"
+
+REQUEST = """<rspec xmlns="http://www.geni.net/resources/rspec/3" type="request">
+  <node client_id="node1" component_manager_id="%s"><services/></node>
+  <node client_id="node2" component_manager_id="urn:publicid:IDN+other.org+authority+am"/>
+</rspec>""" % AM_URN
+
+@unittest.skipIf(testbed is None, "missing dependency")
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.slice = Slice(SLICE_URN)
+        self.slice.request_rspec = REQUEST
+        resource = ExtendedResource("node1", ["raw-pc"])
+        resource.external_id = "node1"
+        self.sliver = self.slice.add_resource(resource)
+
+    def manifest(self, provision=True):
+        return self.slice.manifest(AM_URN, "example.org", provision=provision)
+
+    def test_cached_until_something_changes(self):
+        manifest = self.manifest()
+        self.assertIn('sliver_id="%s"' % self.sliver.urn(), manifest)
+        self.assertIs(self.manifest(), manifest)
+        #Login information of a resource
+        self.sliver.resource().users["alice"] = None
+        changed = self.manifest()
+        self.assertIn('username="alice"', changed)
+        self.assertIs(self.manifest(), changed)
+        self.sliver.resource().ssh_port = 2222
+        self.assertIn('port="2222"', self.manifest())
+        #Slivers
+        manifest = self.manifest()
+        resource = ExtendedResource("node2", ["raw-pc"])
+        resource.external_id = "node2"
+        self.slice.add_resource(resource)
+        self.assertIsNot(self.manifest(), manifest)
+        #Request
+        manifest = self.manifest()
+        self.slice.request_rspec = REQUEST.replace('<services/>', '<services/><sliver_type name="raw-pc"/>')
+        changed = self.manifest()
+        self.assertIsNot(changed, manifest)
+        self.assertIn("raw-pc", changed)
+
+    def test_provision_and_allocate_are_cached_apart(self):
+        self.sliver.resource().users["alice"] = None
+        provisioned = self.manifest()
+        allocated = self.manifest(provision=False)
+        self.assertIn('username="alice"', provisioned)
+        self.assertNotIn('username="alice"', allocated)
+        #Without provision, the login information is not part of the manifest
+        self.sliver.resource().users["bob"] = None
+        self.assertIs(self.manifest(provision=False), allocated)
+        self.assertIn('username="bob"', self.manifest())
+
+    def test_caches_are_not_saved(self):
+        self.manifest()
+        state = self.slice.__getstate__()
+        self.assertNotIn('_manifest_cache', state)
+        self.assertNotIn('_request_cache', state)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#----------------------------------------------------------------------
+# Copyright (c) 2016 Inria/iMinds by Arthur Garnier
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and/or hardware specification (the "Work") to
+# deal in the Work without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Work, and to permit persons to whom the Work
+# is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Work.
+#
+# THE WORK IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE WORK OR THE USE OR OTHER DEALINGS
+# IN THE WORK.
+#----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    import dockermaster
+    from dockermaster import DockerMaster
+except ImportError as e: #gcf, Pyro4 and lxml are needed by the resources
+    dockermaster = None
+    missing = str(e)
+
+class FakeDockerManager(object):
+    """
+        Starts and removes containers in memory
+    """
+    def __init__(self, free_memory=4096):
+        self.free_memory = free_memory
+        self.running = list()
+        self.next_port = 12000
+
+    def checkDocker(self):
+        pass
+
+    def randomMacAddress(self):
+        return "02:42:ac:11:00:01"
+
+    def reserveNextPort(self, starting_port):
+        self.next_port += 1
+        return self.next_port
+
+    def startNew(self, container_id, sliver_type, ssh_port, mac_address):
+        self.running.append(container_id)
+        return True
+
+    def removeContainers(self, names, ports):
+        for name in names:
+            self.running.remove(name)
+        return [True for _ in names]
+
+    def getFreeMemory(self):
+        return self.free_memory
+
+@unittest.skipIf(dockermaster is None, "missing dependency")
+class WarmPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.waitForSsh = dockermaster.readiness.waitForSsh
+        dockermaster.readiness.waitForSsh = lambda host, port: True
+        self.dockermanager = FakeDockerManager()
+        self.dockermaster = DockerMaster(4, host="h1", dockermanager=self.dockermanager,
+                                         warm_pool={'docker-container': 2})
+
+    def tearDown(self):
+        dockermaster.readiness.waitForSsh = self.waitForSsh
+
+    def test_refill_up_to_the_target_size(self):
+        self.assertTrue(self.dockermaster.refillWarmPool())
+        self.assertEqual(len(self.dockermaster.warm['docker-container']), 2)
+        self.assertEqual(len(self.dockermanager.running), 2)
+        self.assertFalse(self.dockermaster.refillWarmPool())
+
+    def test_claim_hit(self):
+        self.dockermaster.refillWarmPool()
+        names = [w['name'] for w in self.dockermaster.warm['docker-container']]
+        warm = self.dockermaster.claimWarmContainer('docker-container')
+        self.assertEqual(warm['name'], names[0])
+        self.assertEqual(self.dockermaster.warmCount(), 1)
+
+    def test_claim_miss(self):
+        self.dockermaster.refillWarmPool()
+        self.assertIsNone(self.dockermaster.claimWarmContainer('docker-container_100M'))
+        self.assertEqual(self.dockermaster.warmCount(), 2)
+
+    def test_refill_after_a_claim(self):
+        self.dockermaster.refillWarmPool()
+        claimed = self.dockermaster.claimWarmContainer('docker-container')
+        self.assertTrue(self.dockermaster.refillWarmPool())
+        names = [w['name'] for w in self.dockermaster.warm['docker-container']]
+        self.assertEqual(len(names), 2)
+        self.assertNotIn(claimed['name'], names)
+
+    def test_shrink_to_the_target_size(self):
+        self.dockermaster.refillWarmPool()
+        self.dockermaster.warm_pool_size['docker-container'] = 1
+        self.assertTrue(self.dockermaster.refillWarmPool())
+        self.assertEqual(self.dockermaster.warmCount(), 1)
+        self.assertEqual(len(self.dockermanager.running), 1)
+        #Removed from the config
+        self.dockermaster.warm_pool_size.clear()
+        self.assertTrue(self.dockermaster.refillWarmPool())
+        self.assertEqual(self.dockermanager.running, [])
+
+    def test_warm_pool_stays_within_the_free_slots(self):
+        self.dockermaster.refillWarmPool()
+        for _ in range(3):
+            self.dockermaster.matchResource()
+        self.assertEqual(self.dockermaster.size(), 1)
+        self.dockermaster.refillWarmPool()
+        self.assertEqual(self.dockermaster.warmCount(), 1)
+
+    def test_shrink_when_short_of_memory(self):
+        self.dockermaster.refillWarmPool()
+        self.dockermanager.free_memory = 100
+        self.assertTrue(self.dockermaster.refillWarmPool())
+        self.assertEqual(self.dockermaster.warmCount(), 0)
+
+if __name__ == '__main__':
+    unittest.main()